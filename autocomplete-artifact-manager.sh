@@ -9,19 +9,21 @@ __artifact_manager()
     cur="${COMP_WORDS[COMP_CWORD]}"
     if [[ "${COMP_CWORD}" == "1" ]]; then
 	# command completion
-	opts="list diff download get upload branches getoptions setoptions rename-branch getlog setlog"
+	opts="list diff download get upload branches getoptions setoptions rename-branch getlog setlog compact-index repack"
         COMPREPLY=( $(compgen -W "${opts}" -- ${cur}) )
         return 0
     elif [[ "${cur:0:2}" = '--' ]]; then
 	# long option completion
-	if   test "${COMP_WORDS[1]}" = "upload";   then add=" overwrite"
-	elif test "${COMP_WORDS[1]}" = "download"; then add=" delete-local"
+	if   test "${COMP_WORDS[1]}" = "upload";   then add=" overwrite object-folders"
+	elif test "${COMP_WORDS[1]}" = "download"; then add=" delete-local link-mode"
 	elif test "${COMP_WORDS[1]}" = "diff";     then add=" show-all"
 	elif test "${COMP_WORDS[1]}" = "list";     then add=" show-all"
 	elif test "${COMP_WORDS[1]}" = "get";      then add=" outname"
 	elif test "${COMP_WORDS[1]}" = "branches"; then add=" log"
+	elif test "${COMP_WORDS[1]}" = "repack";   then add=" max-object-size"
+	elif test "${COMP_WORDS[1]}" = "setoptions"; then add=" index-format journal-size compression chunk-size"
 	fi
-	opts="verbose dry-run server-url repo-name branch subdir project-dir extensions files min-size git-ignored$add"
+	opts="verbose dry-run server-url repo-name branch subdir project-dir extensions files min-size git-ignored jobs async-transfers cache-dir cache-size profile profile-trace$add"
         COMPREPLY=( $(compgen -P "--" -W "${opts}" -- "${cur:2}") )
 	return 0
     elif [[ -n "${cur}" ]]; then
@@ -0,0 +1,291 @@
+"""
+A script to benchmark artifact-manager operations over synthetic
+repositories. It will be called when Python tries to 'execute' this
+directory, which must be done from the folder holding the built
+artifact-manager script (see "make bench")
+
+**Usage:**
+
+  * run all benchmarks with the default repository parameters
+       python bench
+
+  * run some operations, over some transports, saving the results
+       python bench [options] --transports local,http --output <file> <op> ..
+
+  * compare against the results for another revision
+       python bench [options] --compare <file>
+
+Use -h for the list of options.
+"""
+
+import os
+import sys
+import time
+import json
+import ast
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+
+sys.path.insert( 0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 os.pardir, 'test') )
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args
+from testaux.server import TmpServer
+from testaux.httpserver import TmpHttpServer
+from synth import SynthProject
+
+
+# Operations that can be timed, in the order they are run
+OPERATIONS = ( 'upload', 'upload-delta', 'branches', 'list', 'diff', 'status',
+               'download', 'download-delta' )
+# Transports to read the repository with
+TRANSPORTS = ( 'local', 'http', 'http-async' )
+# Slowdowns smaller than this (in seconds) are taken as noise
+MIN_SLOWDOWN = 0.01
+
+
+# -------------------------------------------------------------------
+
+def parse_options():
+    parser = argparse.ArgumentParser( description='Benchmark artifact-manager operations over synthetic repositories' )
+    parser.add_argument( 'operations', metavar='operation', nargs='*', help='operations to time (default: all). Choose from: ' + ', '.join(OPERATIONS) )
+    parser.add_argument( '--objects', '-n', type=int, default=200, help='number of different artifacts in the project (default: %(default)d)' )
+    parser.add_argument( '--min-size', type=int, default=1024, help='minimum size of an artifact in bytes (default: %(default)d)' )
+    parser.add_argument( '--max-size', type=int, default=1024*1024, help='maximum size of an artifact in bytes; sizes are distributed log-uniformly (default: %(default)d)' )
+    parser.add_argument( '--duplicates', type=float, default=0.1, help='additional artifacts duplicating another one, as a ratio to the number of artifacts (default: %(default)s)' )
+    parser.add_argument( '--branches', '-b', type=int, default=3, help='number of branches to upload (default: %(default)d)' )
+    parser.add_argument( '--changes', type=float, default=0.1, help='ratio of the artifacts changed in each branch (default: %(default)s)' )
+    parser.add_argument( '--seed', type=int, default=1, help='seed for the generation of artifacts (default: %(default)d)' )
+    parser.add_argument( '--transports', '-t', default='local,http', help='transports to read the repository with, among ' + ','.join(TRANSPORTS) + ' (default: %(default)s)' )
+    parser.add_argument( '--jobs', '-j', type=int, default=am_mod.DEFAULT_JOBS, help='number of parallel jobs (and of asynchronous transfers) (default: %(default)d)' )
+    parser.add_argument( '--repo-option', '-o', metavar='NAME=VALUE', action='append', default=[], help='repository option to set on creation, as a Python literal (e.g. index_format="binary", chunk_size=65536)' )
+    parser.add_argument( '--repeat', '-r', type=int, default=3, help='number of times to run each operation, each over a new repository (default: %(default)d)' )
+    parser.add_argument( '--output', help='file to write the results to, as JSON (default: standard output)' )
+    parser.add_argument( '--compare', metavar='FILE', help='results of a previous run to compare to' )
+    parser.add_argument( '--threshold', type=float, default=0.2, help='slowdown over the previous results to report as a regression (default: %(default)s)' )
+    opt = parser.parse_args()
+    for o in opt.operations:
+        if o not in OPERATIONS:
+            parser.error( 'unknown operation: ' + o )
+    opt.operations = [ o for o in OPERATIONS if o in opt.operations ] \
+                     if opt.operations else list(OPERATIONS)
+    opt.transports = opt.transports.split(',')
+    for t in opt.transports:
+        if t not in TRANSPORTS:
+            parser.error( 'unknown transport: ' + t )
+    options = {}
+    for o in opt.repo_option:
+        try:
+            name, value = o.split( '=', 1 )
+            options[name] = ast.literal_eval( value )
+        except (SyntaxError,ValueError):
+            parser.error( 'invalid repository option: ' + o )
+        if name not in am_mod.DEFAULT_OPTIONS:
+            parser.error( 'unknown repository option: ' + name )
+    opt.repo_option = options
+    return opt
+
+
+def revision():
+    """Find out the git revision of the code being benchmarked"""
+    try:
+        r = subprocess.Popen( ['git','describe','--always','--dirty'],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE ).communicate()[0]
+        return r.strip() or None
+    except OSError:
+        return None
+
+
+def parameters( opt ):
+    """Get the parameters that define a benchmark run"""
+    return dict( (k,getattr(opt,k)) for k in ('objects','min_size',
+                                               'max_size','duplicates',
+                                               'branches','changes','seed',
+                                               'jobs','repeat','repo_option') )
+
+
+# -------------------------------------------------------------------
+
+class Benchmark( object ):
+    """
+    Run the operations over a repository & project created anew, and
+    collect the time each one takes
+    """
+
+    def __init__( self, opt ):
+        self.opt = opt
+        self.times = {}                 # (transport,operation) : [seconds]
+
+    def args( self, server_url ):
+        """Create the options for the ArtifactManager/Reader classes"""
+        args = am_args( { 'server_url' : server_url,
+                          'repo_name' : REPO_NAME,
+                          'project_dir' : self.project.dir,
+                          'jobs' : self.opt.jobs } )
+        for name, value in self.opt.repo_option.iteritems():
+            setattr( args, name, value )
+        return args
+
+    def timed( self, transport, operation, func, *args ):
+        """
+        Run an operation, and record the time it takes if it is selected.
+        Anything it prints out is discarded
+        """
+        stdout = sys.stdout
+        sys.stdout = open( os.devnull, 'w' )
+        try:
+            start = time.time()
+            r = func( *args )
+            elapsed = time.time() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        if operation in self.opt.operations:
+            self.times.setdefault( (transport,operation), [] ).append(
+                elapsed )
+        return r
+
+    def branch( self, n ):
+        return BRANCH_NAME + str(n)
+
+    def upload( self, args, n ):
+        mgr = am_mod.ArtifactManager( args )
+        return mgr.upload_artifacts( args.project_dir, self.branch(n) )
+
+    def reader( self, args, method, *params ):
+        return getattr( am_mod.ArtifactReader(args), method )( *params )
+
+    def download( self, args, n ):
+        rdr = am_mod.ArtifactReader( args )
+        return rdr.download_artifacts( self.branch(n), args.project_dir, True )
+
+    def run_writes( self, args ):
+        """Upload all branches, changing the project for each one"""
+        self.timed( 'local', 'upload', self.upload, args, 0 )
+        for n in range(1,self.opt.branches):
+            self.project.change( self.opt.changes )
+            self.timed( 'local', 'upload-delta', self.upload, args, n )
+
+    def run_reads( self, transport, args ):
+        """Run read operations, leaving the project as the last branch"""
+        last = self.opt.branches - 1
+        self.timed( transport, 'branches', self.reader, args,
+                    'list_branches' )
+        self.timed( transport, 'list', self.reader, args, 'list_artifacts',
+                    self.branch(last), args.project_dir )
+        self.timed( transport, 'diff', self.reader, args, 'diff',
+                    self.branch(0), self.branch(last), False )
+        self.timed( transport, 'status', self.reader, args,
+                    'local_print_changes', args.project_dir,
+                    self.branch(last), False )
+        if 'download' in self.opt.operations or \
+           'download-delta' in self.opt.operations:
+            self.project.clear()
+            self.timed( transport, 'download', self.download, args, 0 )
+            self.timed( transport, 'download-delta', self.download, args,
+                        last )
+
+    def run( self ):
+        """Run all operations once, over a new repository"""
+        self.server = TmpServer( REPO_NAME )
+        self.project = SynthProject( self.opt.objects, self.opt.min_size,
+                                     self.opt.max_size, self.opt.duplicates,
+                                     self.opt.seed )
+        try:
+            self.files, self.size = self.project.files, self.project.size
+            self.run_writes( self.args(self.server.dir) )
+            for transport in self.opt.transports:
+                if transport == 'local':
+                    self.run_reads( transport, self.args(self.server.dir) )
+                    continue
+                http = TmpHttpServer( self.server.dir )
+                try:
+                    args = self.args( http.url )
+                    if transport == 'http-async':
+                        args.async_transfers = self.opt.jobs
+                    self.run_reads( transport, args )
+                finally:
+                    http.delete()
+        finally:
+            self.server.delete()
+            self.project.delete()
+
+    def results( self ):
+        """Compose the results, in a form that can be stored as JSON"""
+        opt = self.opt
+        results = []
+        for transport in ['local'] + [ t for t in opt.transports
+                                       if t != 'local' ]:
+            for operation in opt.operations:
+                times = sorted( self.times.get((transport,operation),()) )
+                if times:
+                    results.append( { 'transport' : transport,
+                                      'operation' : operation,
+                                      'times' : times,
+                                      'min' : times[0],
+                                      'median' : times[len(times)//2] } )
+        return { 'revision' : revision(),
+                 'version' : am_mod.APP_VERSION,
+                 'date' : datetime.now().isoformat(),
+                 'python' : platform.python_version(),
+                 'platform' : platform.platform(),
+                 'parameters' : parameters( opt ),
+                 'files' : self.files,
+                 'size' : self.size,
+                 'results' : results }
+
+
+# -------------------------------------------------------------------
+
+def print_results( data, previous, threshold, out=sys.stderr ):
+    """
+    Print out a summary of the results, compared to previous ones
+      @return (int): the number of operations slower than the threshold
+    """
+    old = dict( ((r['transport'],r['operation']),r['min'])
+                for r in previous['results'] ) if previous else {}
+    regressions = 0
+    print >>out, "\n# %d files, %.1f MB  (revision %s)" % (
+        data['files'], data['size']/1048576.0, data['revision'] )
+    print >>out, '  %-12s %-16s %9s %9s' % ('transport','operation','min',
+                                            'median'),
+    print >>out, ' %9s' % 'previous' if previous else ''
+    for r in data['results']:
+        print >>out, '  %-12s %-16s %8.3fs %8.3fs' % (
+            r['transport'], r['operation'], r['min'], r['median'] ),
+        key = (r['transport'],r['operation'])
+        if key not in old:
+            print >>out, ''
+            continue
+        change = r['min'] / old[key] - 1 if old[key] else 0
+        slower = change > threshold and r['min'] - old[key] > MIN_SLOWDOWN
+        regressions += slower
+        print >>out, ' %8.3fs %+5.0f%%%s' % (old[key], change*100,
+                                             '  <== SLOWER' if slower else '')
+    return regressions
+
+
+if __name__ == '__main__':
+    opt = parse_options()
+    previous = None
+    if opt.compare:
+        with open(opt.compare) as f:
+            previous = json.load( f )
+        if previous['parameters'] != json.loads(json.dumps(parameters(opt))):
+            print >>sys.stderr, "Warning: comparing results for different parameters"
+    bench = Benchmark( opt )
+    for n in range(opt.repeat):
+        bench.run()
+    data = bench.results()
+    if opt.output:
+        with open(opt.output,'w') as f:
+            json.dump( data, f, indent=2, sort_keys=True )
+    else:
+        json.dump( data, sys.stdout, indent=2, sort_keys=True )
+        print
+    regressions = print_results( data, previous, opt.threshold )
+    sys.exit( 1 if regressions else 0 )
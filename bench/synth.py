@@ -0,0 +1,106 @@
+"""
+Create synthetic projects with artifacts, for benchmarking
+"""
+
+import os
+import math
+import shutil
+import random
+import tempfile
+
+
+# Size of the block of random data artifact contents are taken from
+POOL_SIZE = 1024*1024
+# Number of artifacts per folder
+FOLDER_SIZE = 100
+
+
+# -------------------------------------------------------------------
+
+class SynthProject( object ):
+    """
+    A local project populated with artifacts generated from a random seed,
+    so that the same parameters always produce the same project. Artifact
+    sizes follow a log-uniform distribution between a minimum and a
+    maximum, and a fraction of the artifacts may be copies of other ones.
+    Branches are made by changing the contents of a fraction of the
+    artifacts.
+    """
+
+    def __init__( self, objects, min_size=1024, max_size=1024*1024,
+                  duplicates=0.0, seed=1 ):
+        """
+          @param objects (int): number of different artifacts
+          @param duplicates (float): number of additional artifacts that
+            duplicate another one, as a ratio to \c objects
+        """
+        self.dir = tempfile.mkdtemp()
+        self._rnd = random.Random( seed )
+        self._pool = ''.join( chr(self._rnd.getrandbits(8))
+                              for n in range(POOL_SIZE) )
+        self._sizes = []                                # artifact : size
+        self._names = []                                # artifact : [paths]
+        self.version = 0
+        lmin, lmax = math.log( min_size ), math.log( max(min_size,max_size) )
+        for n in range(objects):
+            self._sizes.append( int(math.exp(self._rnd.uniform(lmin,lmax))) )
+            self._names.append( [ self._path(n) ] )
+        for n in range(int(round(objects*duplicates))):
+            self._names[ self._rnd.randrange(objects) ].append(
+                self._path(objects+n) )
+        for n in range(objects):
+            self._write( n )
+
+    def _path( self, n ):
+        return os.path.join( 'dir%03d' % (n // FOLDER_SIZE),
+                             'artifact%05d.dump' % n )
+
+    def _write( self, n ):
+        """Write the current contents of an artifact into all its files"""
+        size = self._sizes[n]
+        data = 'artifact {0} version {1}\n'.format( n, self.version )
+        start = self._rnd.randrange( POOL_SIZE )
+        blocks = [ data[:size], self._pool[start:start+size-len(data)] ]
+        size -= sum( len(b) for b in blocks )
+        while size > 0:
+            blocks.append( self._pool[:size] )
+            size -= len(blocks[-1])
+        data = ''.join( blocks )
+        for name in self._names[n]:
+            name = os.path.join( self.dir, name )
+            if not os.path.isdir( os.path.dirname(name) ):
+                os.makedirs( os.path.dirname(name) )
+            with open(name,'wb') as f:
+                f.write( data )
+
+    @property
+    def files( self ):
+        """Number of artifact files in the project"""
+        return sum( len(n) for n in self._names )
+
+    @property
+    def size( self ):
+        """Total size of the artifact files in the project"""
+        return sum( s*len(n) for s, n in zip(self._sizes,self._names) )
+
+    def change( self, ratio ):
+        """
+        Change the contents of a fraction of the artifacts, as a new
+        version of the project
+          @return (int): the number of artifacts changed
+        """
+        self.version += 1
+        changed = self._rnd.sample( range(len(self._sizes)),
+                                    int(round(len(self._sizes)*ratio)) )
+        for n in changed:
+            self._write( n )
+        return len(changed)
+
+    def clear( self ):
+        """Remove all files in the project"""
+        for name in os.listdir( self.dir ):
+            shutil.rmtree( os.path.join(self.dir,name) )
+
+    def delete( self ):
+        """Delete the project"""
+        shutil.rmtree( self.dir )
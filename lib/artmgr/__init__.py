@@ -8,17 +8,76 @@ import sys
 DOMAIN = 'HI'
 
 # Repository configuration: names of management files/dirs
-BACKEND_VERSION = 3
+BACKEND_VERSION = 4
 OPTIONS = 'options'
 INDEX = 'index'
+BINARY_INDEX = 'index.bin'
+INDEX_JOURNAL = 'index.journal'
+INDEX_SHARDS = 'index.d'
 REFS = 'refs'
 BRANCHES = 'branches'
 LOGS = 'logs'
+LOG_STORE = 'logs.store'
 OBJECTS = 'objects'
+CHUNKS = 'chunks'
+PACKS = 'packs'
+PACK_INDEX = 'packs/index'
+PACK_INDEX_SUFFIX = '.idx'
+TMP = 'tmp'
 OPTIONS_SECTION = 'general'
 
+# Default number of parallel jobs for hashing & transfers
+DEFAULT_JOBS = 4
+
+# Number of times to try a download whose contents do not match its hash
+DOWNLOAD_ATTEMPTS = 2
+
+# Repository version needed by each index format, and by the index journal
+INDEX_FORMAT_VERSION = { 'text' : 3,
+                         'binary' : 4,
+                         'sharded' : 4 }
+INDEX_JOURNAL_VERSION = 4
+
+# Object compression: available methods, repository version needed to use
+# them, suffix for compressed objects and compression level
+COMPRESSION_METHODS = ( 'none', 'zlib' )
+COMPRESSION_VERSION = 4
+COMPRESSED_SUFFIX = '.z'
+COMPRESSION_LEVEL = 6
+# Extensions of files already compressed, which are stored as they are
+COMPRESSED_EXTENSIONS = ( 'zip', 'gz', 'tgz', 'bz2', 'xz', 'rar', '7z', 'jar',
+                          'rpm', 'deb', 'mpg', 'mp3', 'mp4', 'jpg', 'jpeg',
+                          'png', 'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp' )
+
+# Chunked objects: repository version needed, suffix for the chunk
+# manifests stored in place of the objects, and how many times the average
+# chunk size a file must be to get chunked
+CHUNKING_VERSION = 4
+CHUNKED_SUFFIX = '.chunks'
+CHUNKED_MIN_CHUNKS = 4
+
+# Repository version needed to keep all branch logs in a single file (older
+# versions of the script would leave it out of date), and times to write it
+# again when changes are lost to other writers
+LOG_STORE_VERSION = 4
+LOG_STORE_RETRIES = 3
+
+# Packs: repository version needed, maximum size of the objects to pack by
+# default, approximate size of each pack, and for reading packed objects
+# at once, maximum distance between them and maximum size of each read
+PACKS_VERSION = 4
+PACK_OBJECT_SIZE = 1024*1024
+PACK_SIZE = 32*1024*1024
+PACK_READ_GAP = 64*1024
+PACK_READ_SIZE = 8*1024*1024
+
 # Default options
-DEFAULT_OPTIONS = { 'version' : BACKEND_VERSION,
+DEFAULT_OPTIONS = { 'version' : INDEX_FORMAT_VERSION['text'],
+                    'index_format' : 'text',
+                    'journal_size' : 0,
+                    'compression' : 'none',
+                    'chunk_size' : 0,
+                    'packed' : False,
                     'git_ignored' : False,
                     'min_size' : 0,
                     'files' : (),
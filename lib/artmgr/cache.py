@@ -0,0 +1,325 @@
+# ********************************************************************** <====
+
+from artmgr.transport import mkpath_recursive, link_or_copy, replace_file
+
+# ********************************************************************** ====>
+
+import os
+import errno
+import time
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None        # no inter-process locking (e.g. on Windows)
+
+
+# Version tag for the hash cache file format
+HASH_CACHE_VERSION = 1
+# Files modified less than this number of seconds before being hashed are
+# not cached: their mtime could still change without us noticing
+HASH_CACHE_RACY = 2
+# When the object cache grows beyond its limit, it is trimmed down to this
+# fraction of it, so that eviction does not happen on every download
+OBJECT_CACHE_TRIM = 0.9
+
+
+# ---------------------------------------------------------------------
+
+def default_cache_dir():
+    """Return the default base folder for all local caches"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join( base, 'artifact-manager' )
+
+
+# ---------------------------------------------------------------------
+
+class HashCache( object ):
+    """
+    A persistent cache for the SHA1 hashes of local artifact files, so that
+    only files that have changed need to be read & hashed again.
+    Entries are keyed by path, and validated against the size, modification
+    time & inode of the file.
+    """
+
+    def __init__( self, cache_dir, project_dir ):
+        """
+          @param cache_dir (str): base folder for local caches
+          @param project_dir (str): local project folder this cache is for
+        """
+        key = hashlib.sha1( os.path.abspath(project_dir) ).hexdigest()
+        self._dir = os.path.join( cache_dir, 'hashes' )
+        self._name = os.path.join( self._dir, key )
+        self._entries = {}              # path : (size, mtime, inode, sha)
+        self._seen = set()
+        self._dirty = False
+        self._load()
+
+    def _load( self ):
+        """Read the cache file. An unreadable cache is just an empty one"""
+        try:
+            with open(self._name,'rb') as f:
+                if f.readline().rstrip('\n') != 'v%d' % HASH_CACHE_VERSION:
+                    return
+                for line in f:
+                    data = line.rstrip('\n').split(' ',4)
+                    self._entries[data[4]] = ( int(data[1]), float(data[2]),
+                                               int(data[3]), data[0] )
+        except (IOError,OSError,ValueError,IndexError):
+            self._entries = {}
+
+    def lookup( self, path, st ):
+        """
+        Find the hash of a file
+          @param path (str): name of the file
+          @param st (stat_result): current stat data for the file
+          @return (str): the cached hash, or \c None if not cached or stale
+        """
+        self._seen.add( path )
+        e = self._entries.get( path )
+        if e is None or e[:3] != (st.st_size, st.st_mtime, st.st_ino):
+            return None
+        return e[3]
+
+    def store( self, path, st, sha ):
+        """
+        Add (or replace) the hash for a file. Files with a line break in
+        their names are not cached, since they do not fit the file format
+        """
+        self._seen.add( path )
+        if st.st_mtime > time.time() - HASH_CACHE_RACY or '\n' in path:
+            self._entries.pop( path, None )
+        else:
+            self._entries[path] = (st.st_size, st.st_mtime, st.st_ino, sha)
+        self._dirty = True
+
+    def save( self, prune=False ):
+        """
+        Write the cache back to disk, if modified
+          @param prune (bool): remove all entries not used in this session
+          @return (bool): \c False if the cache could not be written (e.g.
+            its folder is read-only), which just means it will not be used
+        """
+        if prune:
+            stale = [ p for p in self._entries if p not in self._seen ]
+            for p in stale:
+                del self._entries[p]
+            self._dirty = self._dirty or bool(stale)
+        if not self._dirty:
+            return True
+        tmpname = '%s.%d.tmp' % (self._name, os.getpid())
+        try:
+            mkpath_recursive( self._dir )
+            with open(tmpname,'wb') as f:
+                f.write( 'v%d\n' % HASH_CACHE_VERSION )
+                for path, e in self._entries.iteritems():
+                    f.write( '%s %d %r %d %s\n' % (e[3], e[0], e[1], e[2],
+                                                   path) )
+            replace_file( tmpname, self._name )
+        except (IOError,OSError):
+            try:
+                os.unlink( tmpname )
+            except OSError:
+                pass
+            return False
+        self._dirty = False
+        return True
+
+
+# ---------------------------------------------------------------------
+
+class ObjectCache( object ):
+    """
+    A host-wide cache of repository objects, keyed by object SHA1 (and
+    therefore shared among all projects, repositories & branches), with
+    a size limit enforced by evicting the least recently used objects.
+    Objects are laid out as in the repository: \c objects/xx/yyyy...
+    Cache filling is serialized per object through file locks, so that
+    parallel jobs & processes in the same host can share it safely.
+    """
+
+    def __init__( self, cache_dir, max_size ):
+        """
+          @param cache_dir (str): base folder for local caches
+          @param max_size (int): maximum size of the cache, in bytes
+        """
+        self._dir = os.path.join( cache_dir, 'objects' )
+        self._max_size = max_size
+        mkpath_recursive( self._dir )
+        # POSIX record locks are per process, so they are complemented with
+        # thread locks; and they go away when any descriptor for the file
+        # gets closed, so we keep this one open
+        self._lockfile = open( os.path.join(cache_dir,'objects.lock'), 'a+' )
+        self._thread_locks = [ threading.Lock() for n in range(64) ]
+
+    def path( self, sha ):
+        """Return the local path of an object in the cache"""
+        return os.path.join( self._dir, sha[:2], sha[2:] )
+
+    @contextmanager
+    def _locked( self, sha ):
+        """Lock a cache object for this thread & process"""
+        tlock = self._thread_locks[ int(sha[:2],16) % len(self._thread_locks) ]
+        with tlock:
+            if fcntl is None:
+                yield
+                return
+            offset = 1 + int( sha[:6], 16 )
+            fcntl.lockf( self._lockfile, fcntl.LOCK_EX, 1, offset )
+            try:
+                yield
+            finally:
+                fcntl.lockf( self._lockfile, fcntl.LOCK_UN, 1, offset )
+
+    def _copy_cached( self, sha, outname, link_mode ):
+        """
+        Copy an object from the cache into a local file, and mark it as used
+          @return (bool): \c False if the object was not in the cache
+        """
+        name = self.path( sha )
+        try:
+            link_or_copy( name, outname, link_mode )
+        except (IOError,OSError) as e:
+            if e.errno == errno.ENOENT and not os.path.exists( name ):
+                return False
+            raise
+        try:
+            os.utime( name, None )
+        except OSError:
+            pass            # evicted in the meantime by another process
+        return True
+
+    def get( self, sha, outname, download, link_mode='copy' ):
+        """
+        Put an object into a local file, from the cache if present there, or
+        else downloading it and adding it to the cache
+          @param sha (str): object id
+          @param outname (str): name of the local file to write
+          @param download (callable): a function receiving a file name, that
+            will download the object into that file
+          @param link_mode (str): how to place the cached object into the
+            local file (see link_or_copy). Hard links are never made, since
+            a change to the local file would corrupt the cached object for
+            everyone else: a copy-on-write clone is tried instead
+          @return (bool): \c True if the object was served from the cache
+        """
+        if link_mode == 'hardlink':
+            link_mode = 'reflink'
+        with self._locked( sha ):
+            if self._copy_cached( sha, outname, link_mode ):
+                return True
+            name = self.path( sha )
+            mkpath_recursive( os.path.dirname(name) )
+            download( name )
+            link_or_copy( name, outname, link_mode )
+        return False
+
+    def trim( self ):
+        """
+        If the cache is over its size limit, delete the least recently used
+        objects. If another process is already doing it, do nothing.
+        """
+        if fcntl is not None:
+            try:
+                fcntl.lockf( self._lockfile, fcntl.LOCK_EX|fcntl.LOCK_NB, 1, 0 )
+            except IOError:
+                return
+        try:
+            entries = []
+            total = 0
+            for root, dirs, files in os.walk( self._dir ):
+                for f in files:
+                    if f.endswith( '.part' ):
+                        continue        # being filled right now
+                    name = os.path.join( root, f )
+                    try:
+                        st = os.stat( name )
+                    except OSError:
+                        continue
+                    entries.append( (st.st_mtime, st.st_size, name) )
+                    total += st.st_size
+            if total <= self._max_size:
+                return
+            entries.sort()
+            for mtime, size, name in entries:
+                if total <= self._max_size * OBJECT_CACHE_TRIM:
+                    break
+                try:
+                    os.unlink( name )
+                except OSError:
+                    continue
+                total -= size
+        finally:
+            if fcntl is not None:
+                fcntl.lockf( self._lockfile, fcntl.LOCK_UN, 1, 0 )
+
+
+# ---------------------------------------------------------------------
+
+class MetadataCache( object ):
+    """
+    A persistent cache for the metadata files of a remote repository
+    (options, index, branches, refs ...), keyed by server & repository.
+    Each file is stored (in a single cache file, as a JSON line followed by
+    the contents) together with the validator the transport gave for it
+    (HTTP ETag/Last-Modified, local file stat), so that it can be
+    revalidated instead of fetched again.
+    """
+
+    def __init__( self, cache_dir, server, repo ):
+        """
+          @param cache_dir (str): base folder for local caches
+          @param server (str): URL/path of the server holding the repository
+          @param repo (str): repository name
+        """
+        key = hashlib.sha1( server + '\0' + repo ).hexdigest()
+        self._dir = os.path.join( cache_dir, 'meta', key )
+
+    def _name( self, path ):
+        return os.path.join( self._dir, hashlib.sha1(path).hexdigest() )
+
+    def lookup( self, path ):
+        """
+        Get a cached file
+          @return (tuple): \c (validator,data), or \c (None,None) if the file
+            is not in the cache
+        """
+        try:
+            with open(self._name(path),'rb') as f:
+                validator = dict( (str(k),str(v)) for k,v in 
+                                  json.loads(f.readline()).iteritems() )
+                return validator, f.read()
+        except (IOError,ValueError,AttributeError):
+            return None, None
+
+    def store( self, path, validator, data ):
+        """
+        Add (or replace) a file in the cache. If the cache cannot be written,
+        the file is just left out of it, to be fetched again next time
+        """
+        name = self._name( path )
+        tmpname = '%s.%d.%d.tmp' % (name, os.getpid(),
+                                    threading.current_thread().ident)
+        try:
+            mkpath_recursive( self._dir )
+            with open(tmpname,'wb') as f:
+                f.write( json.dumps(validator) + '\n' )
+                f.write( data )
+            replace_file( tmpname, name )
+        except (IOError,OSError):
+            for n in (tmpname, name):
+                try:
+                    os.unlink( n )
+                except OSError:
+                    pass
+
+    def remove( self, path ):
+        """Take out a file from the cache"""
+        try:
+            os.unlink( self._name(path) )
+        except OSError:
+            pass
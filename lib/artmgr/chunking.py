@@ -0,0 +1,147 @@
+# ********************************************************************** <====
+
+from . import *
+
+# ********************************************************************** ====>
+
+import re
+import binascii
+import hashlib
+
+
+# Chunk boundaries are placed where a rolling hash of the data takes some
+# values: for each byte, a polynomial hash of it and the bytes following
+# it, computed for all bytes at once by multiplying the data (taken as a
+# long integer, once its byte values are shuffled) by a fixed constant.
+# Since any byte in that window changes the hash, boundaries appear in any
+# content with some variety (text, SQL dumps), not only in random data.
+# The hash is searched in hexadecimal for a run of zero digits followed by
+# a digit within a range, whose width sets how often it appears. Both the
+# multiplication and the search run in C, which is much faster than a
+# rolling hash computed byte by byte in Python
+_RANKED = sorted( range(256), key=lambda n : hashlib.sha1(chr(n)).digest() )
+CHUNK_BYTE_MAP = ''.join( chr(_RANKED.index(n)) for n in range(256) )
+CHUNK_HASH_MULTIPLIER = int( hashlib.sha1('chunk').hexdigest()[:32], 16 ) | 1
+# Bytes following a boundary that may change its hash (the window plus
+# some margin for carries)
+CHUNK_HASH_WINDOW = 64
+# Block size for reading the data to split
+CHUNK_READ_SIZE = 4*1024*1024
+# Format of the first line in a chunk manifest
+CHUNK_MANIFEST_HEADER = 'chunked 1 {0}\n'
+
+
+# ---------------------------------------------------------------------
+
+def chunk_remote_location( name ):
+    """Return the location of a chunk in the repository, as (path,basename)"""
+    return (CHUNKS + '/' + name[:2], name[2:])
+
+
+def chunk_id( data ):
+    """Compute the id of a chunk (hashed as objects are)"""
+    s = hashlib.sha1( "blob %u\0" % len(data) )
+    s.update( data )
+    return s.hexdigest()
+
+
+def use_chunks( chunk_size, size ):
+    """Find out if a file of the given size is to be stored chunked"""
+    return chunk_size > 0 and size >= CHUNKED_MIN_CHUNKS*chunk_size
+
+
+def format_manifest( chunk_size, chunks ):
+    """
+    Compose the manifest for a chunked object
+      @param chunk_size (int): average chunk size used to split it
+      @param chunks (list): the \c (sha,size) tuples for its chunks
+    """
+    return CHUNK_MANIFEST_HEADER.format( chunk_size ) + \
+        ''.join( '{0} {1}\n'.format(*c) for c in chunks )
+
+
+def parse_manifest( data ):
+    """
+    Parse the manifest for a chunked object
+      @return (tuple): average chunk size & list of \c (sha,size) chunks
+    """
+    lines = data.splitlines()
+    try:
+        f = lines[0].split(' ')
+        if f[:2] != ['chunked','1']:
+            raise ValueError( lines[0] )
+        chunks = [ l.split(' ') for l in lines[1:] ]
+        return int(f[2]), [ (c[0],int(c[1])) for c in chunks ]
+    except (IndexError,ValueError):
+        raise TransportError( 'invalid chunk manifest' )
+
+
+# ---------------------------------------------------------------------
+
+class Chunker( object ):
+    """
+    Split data into content-defined chunks: chunk boundaries depend only on
+    the data around them, so that a change in a file changes only the
+    chunks it falls into, and the rest are the same as before.
+    Chunks are between 1/4 and 4 times the average size requested; long
+    runs of a single byte value have no boundaries within, and are cut at
+    the maximum size.
+    """
+
+    def __init__( self, avg_size ):
+        self.min_size = max( avg_size // 4, 1 )
+        self.max_size = avg_size * 4
+        # Expected distance between markers (in hash digits, two per byte),
+        # once past the minimum size
+        gap = max( avg_size - self.min_size, 1 ) * 2
+        zeros = 0
+        while 16 ** (zeros+1) < gap:
+            zeros += 1
+        span = min( max(int(round(16.0 ** (zeros+1) / gap)),1), 16 )
+        self._marker = re.compile( '0'*zeros + '[0-{0:x}]'.format(span-1) )
+
+    def _hash( self, buf ):
+        """
+        Compute the rolling hash for a block of data, as a string with two
+        hexadecimal digits for each byte, plus some leading ones
+          @return (tuple): the hash, and the position of the digits for the
+            first byte of data
+        """
+        value = int( binascii.hexlify(buf.translate(CHUNK_BYTE_MAP)) or '0',
+                     16 ) * CHUNK_HASH_MULTIPLIER
+        digits = '%x' % value
+        width = 2*len(buf) + 32
+        return digits.zfill( width ), width - 2*len(buf)
+
+    def split( self, source ):
+        """
+        Read a file-like object, and produce its chunks
+          @return (iterator): the data for each chunk
+        """
+        buf = ''
+        pos = 0
+        eof = False
+        while True:
+            # Keep at least a maximum-sized chunk in the buffer, and the
+            # data after it that its boundary depends on
+            if not eof and len(buf) - pos < self.max_size + CHUNK_HASH_WINDOW:
+                blocks = [ buf[pos:] ]
+                size = len(blocks[0])
+                while size < self.max_size + CHUNK_READ_SIZE:
+                    data = source.read( CHUNK_READ_SIZE )
+                    if not data:
+                        eof = True
+                        break
+                    blocks.append( data )
+                    size += len(data)
+                buf = ''.join( blocks )
+                digits, start = self._hash( buf )
+                pos = 0
+            if pos == len(buf):
+                return
+            m = self._marker.search( digits, start + 2*(pos + self.min_size),
+                                     start + 2*(pos + self.max_size) )
+            end = (m.end() - start + 1) // 2 if m \
+                  else min( pos + self.max_size, len(buf) )
+            yield buf[pos:end]
+            pos = end
@@ -0,0 +1,339 @@
+# ********************************************************************** <====
+
+from . import TransportError
+from artmgr.parallel import run_parallel
+
+# ********************************************************************** ====>
+
+import struct
+import binascii
+from collections import MutableMapping
+
+
+# Binary index layout (all integers big-endian):
+#  * header: magic, format version & number of records
+#  * fanout table: for each value of the first SHA1 byte, the number of
+#    records whose first byte is less or equal than it
+#  * records, sorted by SHA1: raw SHA1, mtime, size, mode, path offset
+#    (from the start of the file) & path length
+#  * paths
+BINARY_INDEX_MAGIC = 'AMIX'
+BINARY_INDEX_VERSION = 1
+_HEADER = struct.Struct( '>4sII' )
+_FANOUT = struct.Struct( '>256I' )
+_RECORD = struct.Struct( '>20sdQIQH' )
+_RECORDS_START = _HEADER.size + _FANOUT.size
+# Size of the initial part of the index needed to open it
+BINARY_INDEX_HEADER = _RECORDS_START
+
+# Names of the shards for a sharded index
+SHARD_PREFIXES = tuple( '%02x' % n for n in range(256) )
+
+
+# ---------------------------------------------------------------------
+
+def index_line( sha, entry ):
+    """Format an index entry as a line of the text index"""
+    return "{0} {1} {2} 0{3:o} {4}\n".format( sha, *entry )
+
+def parse_index( data ):
+    """Parse the entries in a text index, as \c (sha,entry) tuples"""
+    for line in data.splitlines():
+        f = line.split(' ',4)
+        yield f[0], [ float(f[1]), int(f[2]), int(f[3],8), f[4] ]
+
+
+def pack_index_line( sha, entry ):
+    """Format an entry as a line of the pack index"""
+    return "{0} {1} {2} {3} {4}\n".format( sha, *entry )
+
+def parse_pack_index( data ):
+    """
+    Parse the entries in the pack index, as \c (sha,entry) tuples, with
+    entries being [pack,offset,size,encoding]
+    """
+    for line in data.splitlines():
+        f = line.split(' ')
+        yield f[0], [ f[1], int(f[2]), int(f[3]), f[4] ]
+
+
+# ---------------------------------------------------------------------
+
+def write_binary_index( items, dest ):
+    """
+    Write an index in binary format
+      @param items (iterable): the \c (sha,[mtime,size,mode,path]) entries
+      @param dest (file): a file-like object to write to
+    """
+    items = sorted( items )
+    fanout = [ 0 ] * 256
+    for sha, v in items:
+        fanout[ int(sha[:2],16) ] += 1
+    for n in range(1,256):
+        fanout[n] += fanout[n-1]
+    dest.write( _HEADER.pack(BINARY_INDEX_MAGIC,BINARY_INDEX_VERSION,
+                             len(items)) )
+    dest.write( _FANOUT.pack(*fanout) )
+    offset = _RECORDS_START + len(items)*_RECORD.size
+    for sha, v in items:
+        dest.write( _RECORD.pack(binascii.unhexlify(sha), float(v[0]),
+                                 int(v[1]), int(v[2]), offset, len(v[3])) )
+        offset += len(v[3])
+    for sha, v in items:
+        dest.write( v[3] )
+
+
+# ---------------------------------------------------------------------
+
+class BinaryIndex( MutableMapping ):
+    """
+    A repository index in binary format, accessed as a dict of
+    \c sha : [mtime,size,mode,path] entries.
+    Lookups are done by bisection over the records, reading only the parts
+    of the index they need: for a remote index the records sharing the first
+    SHA1 byte with the searched one are fetched (and kept) in a single read,
+    and their paths (which are stored in the same order) in another one.
+    Iterating over the index reads it completely.
+    Entries added are kept in memory, on top of the index.
+    """
+
+    def __init__( self, read, remote=False, header=None, jobs=1 ):
+        """
+          @param read (callable): a function returning \c size bytes of the
+            index file starting at \c offset (or up to its end if \c size
+            is \c None)
+          @param remote (bool): reads are expensive, so do as few as possible
+          @param header (str): the first BINARY_INDEX_HEADER bytes of the
+            index, if already read
+          @param jobs (int): number of parts to read in parallel, when
+            prefetching entries
+        """
+        self._read = read
+        self._remote = remote
+        self._jobs = jobs
+        if header is None:
+            header = read( 0, _RECORDS_START )
+        try:
+            magic, version, self._count = _HEADER.unpack(
+                header[:_HEADER.size] )
+            self._fanout = (0,) + _FANOUT.unpack( header[_HEADER.size:] )
+        except struct.error:
+            raise TransportError( 'invalid binary index' )
+        if magic != BINARY_INDEX_MAGIC or version != BINARY_INDEX_VERSION:
+            raise TransportError( 'invalid binary index' )
+        self._blocks = {}               # first byte : (records,paths,offset)
+        self._found = {}                        # sha : entry
+        self._added = {}                        # sha : entry
+        self._all = None
+
+    def _block( self, first ):
+        """
+        Get the records for all SHA1s with a given first byte, together with
+        their paths and the offset of these in the index
+        """
+        block = self._blocks.get( first )
+        if block is None:
+            start = self._fanout[first]
+            size = (self._fanout[first+1] - start) * _RECORD.size
+            if not size:
+                block = ( '', '', 0 )
+            else:
+                records = self._read( _RECORDS_START + start*_RECORD.size,
+                                      size )
+                begin = _RECORD.unpack_from( records, 0 )[4]
+                last = _RECORD.unpack_from( records, size - _RECORD.size )
+                block = ( records, self._read(begin,last[4]+last[5]-begin),
+                          begin )
+            self._blocks[first] = block
+        return block
+
+    def _record( self, n ):
+        """Get a record by its position in the index"""
+        if not self._remote:
+            return self._read( _RECORDS_START + n*_RECORD.size, _RECORD.size )
+        first = 0
+        while self._fanout[first+1] <= n:
+            first += 1
+        pos = (n - self._fanout[first]) * _RECORD.size
+        return self._block( first )[0][pos:pos+_RECORD.size]
+
+    def _path( self, first, offset, size ):
+        """Get the path of a record with a given first byte"""
+        if not self._remote:
+            return self._read( offset, size )
+        records, paths, begin = self._block( first )
+        return paths[offset-begin:offset-begin+size]
+
+    def _lookup( self, sha ):
+        """Search for an entry in the index file, by bisection"""
+        try:
+            raw = binascii.unhexlify( sha )
+        except TypeError:
+            return None
+        if len(raw) != 20:
+            return None
+        first = ord( raw[0] )
+        lo, hi = self._fanout[first], self._fanout[first+1]
+        if self._remote and lo < hi:
+            self._block( first )
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self._record( mid )
+            if record[:20] < raw:
+                lo = mid + 1
+            elif record[:20] > raw:
+                hi = mid
+            else:
+                r = _RECORD.unpack( record )
+                return [ r[1], r[2], r[3], self._path(first,r[4],r[5]) ]
+        return None
+
+    def prefetch( self, shas ):
+        """
+        Read at once, in parallel, all the parts of a remote index needed to
+        look up a set of entries
+        """
+        if not self._remote or self._all is not None:
+            return
+        firsts = set()
+        for sha in shas:
+            try:
+                first = int( sha[:2], 16 )
+            except ValueError:
+                continue
+            if first not in self._blocks and \
+               self._fanout[first] < self._fanout[first+1]:
+                firsts.add( first )
+        run_parallel( self._block, sorted(firsts), self._jobs )
+
+    def _load_all( self ):
+        """Read the whole index"""
+        if self._all is not None:
+            return self._all
+        data = self._read( 0, None )
+        self._all = {}
+        for n in range(self._count):
+            r = _RECORD.unpack_from( data, _RECORDS_START + n*_RECORD.size )
+            self._all[ binascii.hexlify(r[0]) ] = [ r[1], r[2], r[3],
+                                                    data[r[4]:r[4]+r[5]] ]
+        self._all.update( self._added )
+        return self._all
+
+    def __getitem__( self, sha ):
+        if sha in self._added:
+            return self._added[sha]
+        if self._all is not None:
+            return self._all[sha]
+        if sha not in self._found:
+            self._found[sha] = self._lookup( sha )
+        if self._found[sha] is None:
+            raise KeyError( sha )
+        return self._found[sha]
+
+    def __setitem__( self, sha, value ):
+        self._added[sha] = value
+        if self._all is not None:
+            self._all[sha] = value
+
+    def __delitem__( self, sha ):
+        del self._load_all()[sha]
+        self._added.pop( sha, None )
+
+    def __iter__( self ):
+        return iter( self._load_all() )
+
+    def __len__( self ):
+        return len( self._load_all() )
+
+
+# ---------------------------------------------------------------------
+
+class ShardedIndex( MutableMapping ):
+    """
+    A repository index split into 256 shards by the first byte of the SHA1
+    (as objects are), each one in text format, accessed as a dict of
+    \c sha : [mtime,size,mode,path] entries.
+    Shards are fetched the first time an entry in them is needed, or in
+    advance with prefetch(); iterating over the index fetches all of them.
+    Entries added are kept in memory, and the shards they go into are marked
+    as modified, so that only those need to be written back.
+    """
+
+    def __init__( self, fetch, jobs=1 ):
+        """
+          @param fetch (callable): a function returning the contents of the
+            shard for a given prefix (two hex digits), or \c None if there
+            is no such shard
+          @param jobs (int): number of shards to fetch in parallel, when
+            fetching all of them
+        """
+        self._fetch = fetch
+        self._jobs = jobs
+        self._shards = {}                       # prefix : { sha : entry }
+        self._added = {}                        # sha : entry
+        self._dirty = set()
+
+    def _shard( self, prefix ):
+        """Get the entries in a shard, fetching it if needed"""
+        shard = self._shards.get( prefix )
+        if shard is None:
+            data = self._fetch( prefix )
+            shard = dict( parse_index(data) ) if data else {}
+            self._shards[prefix] = shard
+        return shard
+
+    def _load_all( self ):
+        """Fetch all shards not fetched yet"""
+        self.prefetch( SHARD_PREFIXES )
+
+    def prefetch( self, shas ):
+        """
+        Fetch at once, in parallel, all the shards not fetched yet that hold
+        a set of entries
+        """
+        missing = set( sha[:2] for sha in shas ) - set( self._shards )
+        run_parallel( self._shard, sorted(missing & set(SHARD_PREFIXES)),
+                      self._jobs )
+
+    def pop_modified( self ):
+        """
+        Get the contents of all modified shards, and mark them as written
+          @return (dict): \c prefix : { sha : entry }
+        """
+        shards = {}
+        for prefix in self._dirty:
+            shards[prefix] = self._shard( prefix )
+        for sha, v in self._added.iteritems():
+            shards[sha[:2]][sha] = v
+        self._added = {}
+        self._dirty = set()
+        return shards
+
+    def __getitem__( self, sha ):
+        if sha in self._added:
+            return self._added[sha]
+        if sha[:2] not in SHARD_PREFIXES:
+            raise KeyError( sha )
+        return self._shard( sha[:2] )[sha]
+
+    def __setitem__( self, sha, value ):
+        self._added[sha] = value
+        self._dirty.add( sha[:2] )
+
+    def __delitem__( self, sha ):
+        shard = self._shard( sha[:2] )
+        if sha not in shard and sha not in self._added:
+            raise KeyError( sha )
+        shard.pop( sha, None )
+        self._added.pop( sha, None )
+        self._dirty.add( sha[:2] )
+
+    def __iter__( self ):
+        self._load_all()
+        keys = set( self._added )
+        for shard in self._shards.itervalues():
+            keys.update( shard )
+        return iter( keys )
+
+    def __len__( self ):
+        return sum( 1 for k in self )
@@ -1,7 +1,11 @@
 # ********************************************************************** <====
 
 from artmgr import *
-from artmgr.reader import ArtifactReader, object_remote_location, open_transports, write_options_to_cfg
+from artmgr.reader import ArtifactReader, object_remote_location, open_transports, write_options_to_cfg, sha1_file, sha1_start, HashingReader, CompressingReader, compressible
+from artmgr.parallel import run_parallel
+from artmgr.profiling import profiled
+from artmgr.index import ShardedIndex, write_binary_index, index_line, pack_index_line, parse_pack_index
+from artmgr.chunking import Chunker, chunk_id, chunk_remote_location, use_chunks, format_manifest
 
 # ********************************************************************** ====>
 
@@ -12,6 +16,10 @@ import errno
 import stat
 import re
 import glob
+import uuid
+import zlib
+import hashlib
+import threading
 from datetime import datetime
 from posixpath import join as posixjoin
 from HTMLParser import HTMLParser
@@ -57,13 +65,13 @@ class ArtifactManager( ArtifactReader ):
         # Parent constructor will read the remote repository metadata
         super(ArtifactManager,self).__init__( options )
         # Now initialize the repository if it happens to be empty
-        if not self.writer.exists( INDEX ) and not self.dry_run:
+        if not self.initialized and not self.dry_run:
             self.repo_init( options )
 
     def _repo_connect( self, source, subrepo ):
         """Open transports for R/W"""
-        (self.reader,self.writer) = open_transports( source, subrepo, 
-                                                     write=True )
+        (self.reader,self.writer) = open_transports(
+            source, subrepo, write=True, async_transfers=self.async_transfers )
 
     def repo_init( self, options ):
         """
@@ -73,20 +81,35 @@ class ArtifactManager( ArtifactReader ):
             print "\n# Info: initializing repository",options.repo_name
         # Ensure the base folder for the repo is there
         self.writer.init_base()
-        # Create the needed subfolders
-        self.writer.folder_create( OBJECTS )
-        self.writer.folder_create( REFS )
+        # Create the needed subfolders. All the folders for objects may be
+        # created now, so that uploads need not check for them
+        folders = [ OBJECTS, REFS ]
+        if getattr(options,'object_folders',None):
+            folders += [ OBJECTS + '/%02x' % n for n in range(256) ]
+        for folder in folders:
+            self.writer.folder_create( folder )
+        self.writer.known_folders.update( folders )
         # Create README, index & options files
         with closing(StringIO.StringIO(README)) as buffer:
             self.writer.put( buffer, 'README.html' )
         with closing(StringIO.StringIO(strip_tags(README))) as buffer:
             self.writer.put( buffer, 'README' )
-        self.writer.put( StringIO.StringIO(), INDEX )
         self.put_cfg()
 
 
     def put_cfg( self ):
-        """Write the config options file in the remote repo"""
+        """
+        Write the config options file in the remote repo. The index is
+        written first if the repository is new, or if its format or journal
+        size are being changed
+        """
+        self.version = max( self.version,
+                            INDEX_FORMAT_VERSION.get(self.index_format,0),
+                            INDEX_JOURNAL_VERSION if self.journal_size else 0,
+                            COMPRESSION_VERSION
+                            if self.compression != 'none' else 0,
+                            CHUNKING_VERSION if self.chunk_size else 0,
+                            PACKS_VERSION if self.packed else 0 )
         cfg = SafeConfigParser()
         write_options_to_cfg( self, cfg )
         if self.verbose:
@@ -95,16 +118,112 @@ class ArtifactManager( ArtifactReader ):
         if self.dry_run:
             print "** DRY RUN"
             return
+        changed = [ k for k, v in self.stored_options.iteritems()
+                    if getattr(self,k) != v ]
+        if changed or not self.initialized:
+            self.compact_index()
         with closing(StringIO.StringIO()) as buffer:
             cfg.write( buffer )
             buffer.seek( 0 )
             self.writer.put( buffer, OPTIONS )
-
-    def put_object( self, data_source, object_name ):
-        dest_path = object_remote_location(object_name)
+        self.initialized = True
+        self.stored_options = dict( (k,getattr(self,k))
+                                    for k in self.stored_options )
+
+    def put_object( self, data_source, object_name, compress=False,
+                    chunked=False ):
+        """Store an object, optionally compressing it or splitting it in chunks"""
+        suffix = ''
+        if chunked:
+            data_source = StringIO.StringIO( self._put_chunks(data_source) )
+            suffix = CHUNKED_SUFFIX
+        elif compress:
+            data_source = CompressingReader( data_source )
+            suffix = COMPRESSED_SUFFIX
+        dest_path = object_remote_location(object_name,suffix)
         self.writer.folder_ensure( dest_path[0] )
         self.writer.put( data_source, posixjoin(*dest_path) )
 
+    def move_object( self, tmpname, object_name ):
+        """Move a file uploaded under a temporary name into the object store"""
+        suffix = os.path.splitext( tmpname )[1]
+        dest_path = object_remote_location(object_name,suffix)
+        self.writer.folder_ensure( dest_path[0] )
+        self.writer.rename( tmpname, posixjoin(*dest_path) )
+
+    def _put_chunks( self, data_source ):
+        """
+        Split an object in chunks, and store the ones not yet in the
+        repository. Each one goes through a temporary name, so that an
+        interrupted upload cannot leave a truncated chunk. Several objects
+        may be stored at the same time, sharing the set of known chunks
+          @return (str): the manifest for the chunked object
+        """
+        chunks = []
+        for data in Chunker( self.chunk_size ).split( data_source ):
+            sha = chunk_id( data )
+            chunks.append( (sha,len(data)) )
+            dest_path = chunk_remote_location( sha )
+            with self._chunks_lock:
+                known = sha in self._known_chunks
+            if known or self.writer.exists( posixjoin(*dest_path) ):
+                with self._chunks_lock:
+                    self._known_chunks.add( sha )
+                continue
+            tmpname = posixjoin( TMP, uuid.uuid4().hex )
+            with closing(StringIO.StringIO(data)) as buffer:
+                self.writer.put( buffer, tmpname )
+            self.writer.folder_ensure( dest_path[0] )
+            self.writer.rename( tmpname, posixjoin(*dest_path) )
+            with self._chunks_lock:
+                self._known_chunks.add( sha )
+        return format_manifest( self.chunk_size, chunks )
+
+    def _known_remote_files( self, branch ):
+        """
+        Find out the remote paths of artifacts already stored: the ones in
+        the branch being replaced, plus all the ones in the index if it is
+        already in memory (otherwise it would need to be fetched completely)
+          @return (dict): \c path : sha
+        """
+        known = dict( (p,sha) for sha, paths in (branch or {}).iteritems()
+                      for p in paths )
+        if isinstance( self.remote_index, dict ):
+            known.update( (v[3],k) for k, v in self.remote_index.iteritems() )
+        return known
+
+    def _stage_file( self, name, st ):
+        """
+        Hash a local file while uploading it to a temporary name in the
+        repository, so that new artifacts need to be read only once. Files
+        that seem to be already in the remote index (same path, size and
+        modification time) are only hashed. Files to be stored chunked are
+        only hashed too: their chunks are stored in the upload phase, and
+        only if they are new, since checking each chunk is slow.
+          @return (str): the file hash
+        """
+        visible_name = os.path.join(self.subdir,name) if self.subdir else name
+        sha = self._remote_files.get( visible_name )
+        entry = self.remote_index.get( sha ) if sha else None
+        if (entry and (entry[1],'{0}'.format(entry[0])) ==
+            (st.st_size,'{0}'.format(st.st_mtime))) or \
+           use_chunks( self.chunk_size, st.st_size ):
+            return sha1_file( st.st_size, name )
+        s = sha1_start( st.st_size )
+        with open( name, 'rb' ) as f:
+            source = hashing = HashingReader( f, s )
+            if compressible( self.compression, visible_name ):
+                tmpname = posixjoin( TMP, uuid.uuid4().hex + COMPRESSED_SUFFIX )
+                source = CompressingReader( source )
+            else:
+                tmpname = posixjoin( TMP, uuid.uuid4().hex )
+            self.writer.put( source, tmpname )
+        self._staged.append( (s.hexdigest(),tmpname) )
+        if hashing.size != st.st_size:
+            raise GenericError( 'Upload Error', 
+                                "file '%s' changed while uploading" % name )
+        return s.hexdigest()
+
     def put_log( self, branch_string, msg ):
         """Set the log message for a branch"""
         dest_name = os.path.join( LOGS, branch_string )
@@ -113,7 +232,39 @@ class ArtifactManager( ArtifactReader ):
             self.writer.folder_ensure( head )
         with closing(StringIO.StringIO(msg)) as buffer:
             self.writer.update( buffer, dest_name )
-        
+        self._update_log_store( {branch_string : msg} )
+
+    def _update_log_store( self, logs, removed=() ):
+        """
+        Change log messages in the log store, adding to it the logs of all
+        branches it is missing (all of them if the repository does not have
+        it yet). Repositories that older versions of the script can write to
+        have no log store. Logs are also kept in a file for each branch, for
+        those versions
+        Other writers may replace the store at the same time, losing these
+        changes: it is read back to check them, and written again if needed
+          @param logs (dict): branch : new log message
+          @param removed (list): branches whose log is to be removed
+        """
+        if self.version < LOG_STORE_VERSION:
+            return
+        for _ in range(LOG_STORE_RETRIES):
+            store = self._get_log_store() or {}
+            store.update( self._fetch_logs([ b for b in self.remote_branches
+                                             if b not in store and
+                                                b not in logs and
+                                                b not in removed ]) )
+            store.update( logs )
+            for b in removed:
+                store.pop( b, None )
+            with closing(StringIO.StringIO(repr(store))) as buffer:
+                self.writer.update( buffer, LOG_STORE )
+            store = self._get_log_store() or {}
+            if all( store.get(b) == l for b, l in logs.iteritems() ) and \
+               not any( b in store for b in removed ):
+                return
+
+    @profiled( 'writes' )
     def _put_branch_filelist( self, branch_string ):
         """Put in the remote repository the list of objects for one branch"""
         # Compose the final name & ensure the destination folder exists
@@ -135,14 +286,217 @@ class ArtifactManager( ArtifactReader ):
             self.writer.update( buffer, dest_name )
 
 
+    @profiled( 'writes' )
     def _put_index( self ):
+        """Write the remote repository index, in its configured format"""
         buffer = StringIO.StringIO()
+        if self.index_format == 'sharded':
+            self._put_index_shards()
+            return
+        if self.index_format == 'binary':
+            write_binary_index( self.remote_index.iteritems(), buffer )
+            self.writer.update( StringIO.StringIO(buffer.getvalue()),
+                                BINARY_INDEX )
+            return
         for item in sorted(self.remote_index):
-            v = self.remote_index[item]
-            buffer.write( "{0} {1} {2} 0{3:o} {4}\n".format( item, *v ) )
+            buffer.write( index_line(item,self.remote_index[item]) )
         self.writer.update( StringIO.StringIO(buffer.getvalue()), INDEX )
 
 
+    def _put_index_shards( self ):
+        """
+        Write the remote repository index as shards: only the modified ones
+        if the index was already sharded, all of them if not
+        """
+        if isinstance( self.remote_index, ShardedIndex ):
+            shards = self.remote_index.pop_modified()
+        else:
+            shards = defaultdict( dict )
+            for k, v in self.remote_index.iteritems():
+                shards[k[:2]][k] = v
+        self.writer.folder_ensure( INDEX_SHARDS )
+        def put_shard( prefix ):
+            data = ''.join( index_line(k,shards[prefix][k])
+                            for k in sorted(shards[prefix]) )
+            self.writer.update( StringIO.StringIO(data),
+                                posixjoin(INDEX_SHARDS,prefix) )
+        run_parallel( put_shard, sorted(shards), self.jobs )
+
+
+    def _append_index( self, keys ):
+        """
+        Add new entries to the remote index. If the repository uses an index
+        journal, they are appended to it, and the index is rewritten only
+        when the journal gets too large
+          @param keys (list): the new index entries
+        """
+        journal = self.index_journal or ''
+        entries = len(journal.splitlines()) + len(keys)
+        if not self.journal_size or entries > self.journal_size:
+            self.compact_index()
+            return
+        journal += ''.join( index_line(k,self.remote_index[k])
+                            for k in sorted(keys) )
+        with self.profiler.phase( 'writes' ):
+            self.writer.update( StringIO.StringIO(journal), INDEX_JOURNAL )
+        self.index_journal = journal
+
+
+    def compact_index( self ):
+        """
+        Rewrite the whole remote index, merging into it the index journal
+        """
+        if self.verbose > 1:
+            print "\n# Info: writing repository index"
+        if self.dry_run:
+            return
+        self._put_index()
+        if self.index_journal is not None:
+            self.writer.delete( INDEX_JOURNAL )
+            self.index_journal = None
+
+
+    def _fetch_loose( self, sha ):
+        """
+        Read a loose object as stored, verifying it
+          @return (tuple): the object data & its encoding, or \c None if
+            there is no valid loose object
+        """
+        for suffix, encoding in (('','raw'),(COMPRESSED_SUFFIX,'zlib')):
+            with closing(StringIO.StringIO()) as buffer:
+                path = posixjoin( *object_remote_location(sha,suffix) )
+                if not self.reader.get_if_exists( path, buffer ):
+                    continue
+                data = buffer.getvalue()
+            try:
+                raw = zlib.decompress( data ) if encoding == 'zlib' else data
+            except zlib.error:
+                raw = None
+            if raw is not None:
+                s = sha1_start( len(raw) )
+                s.update( raw )
+                if s.hexdigest() == sha:
+                    return data, encoding
+            if self.verbose:
+                print "Warning: corrupt object", sha, "not packed"
+            return None
+        return None
+
+    def _put_pack( self, objects ):
+        """
+        Store a pack with the given objects, together with an index of its
+        own, and add them to the pack index
+          @param objects (dict): \c sha : (data,encoding)
+        """
+        entries = {}
+        with closing(StringIO.StringIO()) as buffer:
+            for sha in sorted( objects, key=lambda k : self.remote_index[k][3] ):
+                data, encoding = objects[sha]
+                entries[sha] = [ buffer.tell(), len(data), encoding ]
+                buffer.write( data )
+            data = buffer.getvalue()
+        pack_sha = hashlib.sha1( data ).hexdigest()
+        name = 'pack-{0}.pack'.format( pack_sha )
+        tmpname = posixjoin( TMP, uuid.uuid4().hex )
+        self.writer.folder_ensure( TMP )
+        self.writer.put( StringIO.StringIO(data), tmpname )
+        self.writer.folder_ensure( PACKS )
+        self.writer.rename( tmpname, posixjoin(PACKS,name) )
+        # The index of the pack allows rebuilding the pack index, should
+        # its entries get lost
+        for sha, e in entries.iteritems():
+            entries[sha] = [ name ] + e
+        self.writer.update( StringIO.StringIO(
+            ''.join( pack_index_line(k,entries[k]) for k in sorted(entries) )),
+            posixjoin(PACKS,'pack-{0}{1}'.format(pack_sha,PACK_INDEX_SUFFIX)) )
+        self.pack_index.update( entries )
+        self._put_pack_index()
+
+    def _put_pack_index( self ):
+        """
+        Write the pack index. Other repacks may have run since it was read,
+        so the entries they added are merged in first
+        """
+        data = self._get_remote_file( PACK_INDEX )
+        if data:
+            for sha, e in parse_pack_index( data ):
+                self.pack_index.setdefault( sha, e )
+        self.writer.update( StringIO.StringIO(
+            ''.join( pack_index_line(k,self.pack_index[k])
+                     for k in sorted(self.pack_index) )), PACK_INDEX )
+
+    def _rebuild_pack_index( self ):
+        """
+        Add to the pack index any entries found in the indexes of the packs
+        but missing from it (e.g. lost by repacks running at the same time).
+        Nothing is done if the writer cannot list the packs
+          @return (int): number of entries added
+        """
+        names = self.writer.folder_list( PACKS ) or []
+        missing = {}
+        for name in names:
+            if not name.endswith( PACK_INDEX_SUFFIX ):
+                continue
+            data = self._get_remote_file( posixjoin(PACKS,name) )
+            for sha, e in parse_pack_index( data or '' ):
+                if sha not in self.pack_index:
+                    missing[sha] = e
+        if missing:
+            self.pack_index.update( missing )
+            self._put_pack_index()
+        return len( missing )
+
+    def repack( self, max_size=PACK_OBJECT_SIZE ):
+        """
+        Move small loose objects into packs, so that they can be read
+        together. Objects are ordered by path, so that the ones likely
+        to be downloaded together end up close to each other
+          @param max_size (int): maximum size of the objects to pack
+          @return (int): number of objects packed
+        """
+        if self.packed and not self.dry_run:
+            recovered = self._rebuild_pack_index()
+            if recovered and self.verbose:
+                print "Warning: %d entries recovered for the pack index" % \
+                    recovered
+        candidates = sorted( (v[3],k) for k, v in self.remote_index.iteritems()
+                             if v[1] <= max_size and k not in self.pack_index )
+        if self.verbose:
+            print "\n# Info: packing up to %d loose objects" % len(candidates)
+        if self.dry_run:
+            return 0
+        # Group the objects in packs of about the same size
+        groups = [ [] ]
+        size = 0
+        for path, sha in candidates:
+            if size > PACK_SIZE:
+                groups.append( [] )
+                size = 0
+            groups[-1].append( sha )
+            size += self.remote_index[sha][1]
+        packed = 0
+        for group in groups:
+            objects = dict( (sha,o) for sha, o in
+                            zip(group,run_parallel(self._fetch_loose,group,
+                                                   self.jobs)) if o )
+            if not objects:
+                continue
+            self._put_pack( objects )
+            # The repository must be marked as having packs before removing
+            # any loose object
+            if not self.packed:
+                self.packed = True
+                self.put_cfg()
+            def delete( sha ):
+                path = object_remote_location( sha, ''
+                                    if objects[sha][1] == 'raw'
+                                    else COMPRESSED_SUFFIX )
+                self.writer.delete( posixjoin(*path) )
+            run_parallel( delete, objects.keys(), self.jobs )
+            packed += len(objects)
+        return packed
+
+
     def rename_branch( self, branch, new_branch_name ):
         """Rename a branch in the remote server"""
         if branch not in self.remote_branches:
@@ -165,6 +519,7 @@ class ArtifactManager( ArtifactReader ):
             newlog = os.path.join(LOGS,new_branch_name)
             self.writer.folder_ensure( os.path.split(newlog)[0] )
             self.writer.rename( os.path.join(LOGS,branch), newlog )
+            self._update_log_store( {new_branch_name : log}, [branch] )
         # Update the list of branches
         del self.remote_branches[branch]
         self.remote_branches[new_branch_name] = log
@@ -172,6 +527,7 @@ class ArtifactManager( ArtifactReader ):
         return True
 
 
+    @profiled( 'writes' )
     def put_branches_list( self ):
         """Write in the remote repo the list of existing branches"""
         buffer = StringIO.StringIO()
@@ -197,42 +553,76 @@ class ArtifactManager( ArtifactReader ):
                 print "Use --overwrite option to change it"
             return False
         # Collect all local artifact object & find out which ones are not yet 
-        # in the remote side.
-        self._local_collect_list( local_basedir )
-        newf = dict( (sha,self.local_artifacts[sha])
-                     for sha in self.local_artifacts 
-                     if sha not in self.remote_index )
-        if self.verbose > 1:
-            print "\n# Info: Uploading local artifacts to '%s'" % branch_string
-            print "  total local artifacts: ", len(self.local_artifacts)
-            print "  already in repo: ", len(self.local_artifacts) - len(newf)
-            if self.dry_run: print "  ** DRY RUN"
-            #print self.local_artifacts
-        # Process each new file
-        uploaded = 0
-        for k,v in newf.iteritems():
+        # in the remote side. Files that need hashing are uploaded at the
+        # same time to temporary names, as most likely they are new
+        self._staged = []                               # [(sha,tmpname)]
+        self._known_chunks = set()
+        self._chunks_lock = threading.Lock()
+        self._remote_files = self._known_remote_files( remote )
+        moved = set()
+        try:
+            if not self.dry_run:
+                self.writer.folder_ensure( TMP )
+            self._local_collect_list( local_basedir, hash_func=None
+                                      if self.dry_run else self._stage_file )
+            self._prefetch_index( self.local_artifacts )
+            newf = dict( (sha,self.local_artifacts[sha])
+                         for sha in self.local_artifacts 
+                         if sha not in self.remote_index )
+            if self.verbose > 1:
+                print "\n# Info: Uploading local artifacts to '%s'" % branch_string
+                print "  total local artifacts: ", len(self.local_artifacts)
+                print "  already in repo: ", len(self.local_artifacts) - len(newf)
+                if self.dry_run: print "  ** DRY RUN"
+                #print self.local_artifacts
+            # Process each new file
             if self.verbose:
-                print "   ... uploading: ", ' '.join(v)
+                for v in newf.itervalues():
+                    print "   ... uploading: ", ' '.join(v)
             if self.dry_run:
-                continue
-            # Send it to remote repo & add locally to index
-            # Use just the 1st file (the same "object" may be in more than 
-            # one position locally)
-            with open( os.path.join(local_basedir,v[0])) as f:
-                self.put_object( f, k )
+                return 0
+
+            # Send them to remote repo, in parallel: move into place the ones
+            # already uploaded, send the rest. Use just the 1st file (the
+            # same "object" may be in more than one position locally)
+            staged = dict( (sha,tmpname) for sha, tmpname in self._staged
+                           if sha in newf )
+            def upload( item ):
+                if item[0] in staged:
+                    self.move_object( staged[item[0]], item[0] )
+                    moved.add( staged[item[0]] )
+                    return
+                entry = self.local_index[item[0]]
+                with open( os.path.join(local_basedir,item[1][0]), 'rb' ) as f:
+                    self.put_object( f, item[0],
+                                     compressible(self.compression,entry[3]),
+                                     use_chunks(self.chunk_size,entry[1]) )
+            with self.profiler.phase( 'transfers' ):
+                run_parallel( upload, newf.items(), self.jobs )
+        finally:
+            # Drop all uploads not needed (objects already in the repository,
+            # or repeated within the project)
+            for sha, tmpname in self._staged:
+                if tmpname not in moved:
+                    try:
+                        self.writer.delete( tmpname )
+                    except (IOError,OSError):
+                        pass
+
+        # Only when all objects are stored, add them to the index, and then
+        # upload the list of files for this branch and update remote indices
+        for k in newf:
             self.remote_index[k] = self.local_index[k]
-            uploaded += 1
-
-        # Now upload the list of files for this branch and update remote indices
-        if not self.dry_run:
-            self._put_branch_filelist( branch_string )
-            if branch_string not in self.remote_branches.keys():
-                self.remote_branches[branch_string] = ''
-                self.put_branches_list()
-            if len(newf):
-                self._put_index()
-
-        return uploaded
+        self._put_branch_filelist( branch_string )
+        if branch_string not in self.remote_branches.keys():
+            self.remote_branches[branch_string] = ''
+            self.put_branches_list()
+            # so that readers know it has no log
+            self._update_log_store( {branch_string : ''} )
+        if len(newf):
+            self._append_index( newf.keys() )
+
+        return len(newf)
 
 
 
@@ -0,0 +1,51 @@
+
+import sys
+import threading
+import Queue
+
+
+# ---------------------------------------------------------------------
+
+def run_parallel( func, items, jobs ):
+    """
+    Apply a function to all items in a list, using a pool of worker threads
+      @param func (callable): the function to apply, taking one item
+      @param items (list): the items to process
+      @param jobs (int): maximum number of items to process at the same time
+      @return (list): the function results, in the same order as the items
+      @except the first exception raised by any call is raised again here,
+        once all workers have stopped
+    """
+    if jobs <= 1 or len(items) <= 1:
+        return map( func, items )
+
+    results = [ None ] * len(items)
+    errors = []
+    pending = Queue.Queue()
+    for n in range(len(items)):
+        pending.put( n )
+
+    def worker():
+        while not errors:
+            try:
+                n = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[n] = func( items[n] )
+            except BaseException:
+                # GenericError calls sys.exit(), so catch SystemExit too
+                errors.append( sys.exc_info() )
+
+    threads = [ threading.Thread(target=worker)
+                for n in range(min(jobs,len(items))) ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    # Join with a timeout, so that the main thread can get interrupted
+    for t in threads:
+        while t.is_alive():
+            t.join( 0.1 )
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
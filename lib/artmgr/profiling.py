@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None                             # not available in Windows
+
+
+# ---------------------------------------------------------------------
+
+def peak_memory():
+    """
+    Get the peak memory used so far by this process (its maximum resident
+    set size), in KB
+      @return (int): the memory used, or \c None if it cannot be known
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    # MacOS gives it in bytes, other systems in KB
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+class Profiler( object ):
+    """
+    Record the time spent in each phase of an operation (reading the
+    repository config, fetching the index, parsing branches, scanning and
+    hashing local files, transferring objects, writing the index & refs),
+    and the peak memory used at the end of each one. Phases may be nested,
+    and may run in parallel in several threads.
+
+    Pass it as the \c profiler attribute of the options given to
+    ArtifactReader/ArtifactManager, and call write_summary() or
+    write_trace() when done.
+    """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self.events = []                # (phase,thread,start,end,memory)
+
+    @contextmanager
+    def phase( self, name ):
+        """A context manager that records the time spent within it"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            event = ( name, threading.current_thread().ident, start,
+                      time.time(), peak_memory() )
+            with self._lock:
+                self.events.append( event )
+
+    def summary( self ):
+        """
+        Sum up the time spent in each phase
+          @return (list): \c (phase,count,seconds) tuples, in the order the
+            phases were first started
+        """
+        count = defaultdict( int )
+        total = defaultdict( float )
+        first = {}
+        for name, thread, start, end, memory in self.events:
+            count[name] += 1
+            total[name] += end - start
+            first[name] = min( first.get(name,start), start )
+        return [ (name,count[name],total[name])
+                 for name in sorted( first, key=first.get ) ]
+
+    def write_summary( self, out=sys.stderr ):
+        """
+        Print out a table with the time spent in each phase. Phases running
+        in parallel or nested within other ones may add up to more than
+        the elapsed time
+        """
+        elapsed = time.time() - self._start
+        line = "\n# Profile: %.3fs elapsed" % elapsed
+        memory = peak_memory()
+        if memory is not None:
+            line += ", peak memory %.1f MB" % (memory/1024.0)
+        print >>out, line
+        print >>out, '  %-12s %6s %10s %6s' % ('phase','count','seconds','%')
+        for name, count, total in self.summary():
+            print >>out, '  %-12s %6d %10.3f %6.1f' % (
+                name, count, total, total*100/elapsed if elapsed else 0 )
+
+    def write_trace( self, filename ):
+        """
+        Write the phases as a trace in the Chrome trace event format, to be
+        loaded into chrome://tracing or similar viewers
+        """
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for name, thread, start, end, memory in sorted( self.events,
+                                                        key=lambda e : e[2] ):
+            tid = threads.setdefault( thread, len(threads) )
+            ts = int( (start - self._start)*1000000 )
+            events.append( { 'name' : name, 'cat' : 'artmgr', 'ph' : 'X',
+                             'pid' : pid, 'tid' : tid, 'ts' : ts,
+                             'dur' : int( (end - start)*1000000 ) } )
+            if memory is not None:
+                events.append( { 'name' : 'peak memory (KB)', 'ph' : 'C',
+                                 'pid' : pid, 'tid' : tid,
+                                 'ts' : int( (end - self._start)*1000000 ),
+                                 'args' : { 'rss' : memory } } )
+        with open( filename, 'w' ) as f:
+            json.dump( { 'traceEvents' : events,
+                         'displayTimeUnit' : 'ms',
+                         'otherData' : { 'peak_memory_kb' : peak_memory() } },
+                       f )
+
+
+class NullProfiler( object ):
+    """A profiler that records nothing, used when not profiling"""
+
+    @contextmanager
+    def phase( self, name ):
+        yield
+
+
+def profiled( name ):
+    """
+    A decorator for methods of objects with a \c profiler attribute, to
+    record their calls as a phase
+    """
+    def decorator( method ):
+        @functools.wraps( method )
+        def wrapper( self, *args, **kwargs ):
+            with self.profiler.phase( name ):
+                return method( self, *args, **kwargs )
+        return wrapper
+    return decorator
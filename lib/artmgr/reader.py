@@ -2,6 +2,11 @@
 
 from . import *
 from artmgr.transport import *
+from artmgr.cache import HashCache, ObjectCache, MetadataCache, default_cache_dir
+from artmgr.index import BinaryIndex, ShardedIndex, BINARY_INDEX_HEADER, parse_index, parse_pack_index
+from artmgr.chunking import Chunker, chunk_id, chunk_remote_location, use_chunks, parse_manifest
+from artmgr.parallel import run_parallel
+from artmgr.profiling import NullProfiler, profiled
 
 # ********************************************************************** ====>
 
@@ -13,7 +18,10 @@ import stat
 import re
 import ast
 import hashlib
+import zlib
 import glob
+import mmap
+import threading
 from datetime import datetime
 from posixpath import join as posixjoin
 from HTMLParser import HTMLParser
@@ -30,15 +38,27 @@ except ImportError:
 
 # ---------------------------------------------------------------------
         
-def object_remote_location( name ):
+def object_remote_location( name, suffix='' ):
     """Return the location of an object in the repository, as (path,basename)"""
-    return (OBJECTS + '/' + name[:2], name[2:])
+    return (OBJECTS + '/' + name[:2], name[2:] + suffix)
 
 
-def _open_single_transport( url, subrepo, verbose ):
-    """Open a transport to a remote repo"""
+def compressible( compression, path ):
+    """Find out if an artifact is to be compressed when stored"""
+    ext = os.path.splitext( path )[1][1:].lower()
+    return compression != 'none' and ext not in COMPRESSED_EXTENSIONS
+
+
+def _open_single_transport( url, subrepo, verbose, async_transfers=False ):
+    """
+    Open a transport to a remote repo
+      @param async_transfers (bool): to access HTTP servers through an
+        asynchronous transport (if no proxy is in the way)
+    """
     #print url
     if( url.startswith('http:') or url.startswith('https:') ):
+        if async_transfers and AsyncWebTransport.usable( url ):
+            return SyncTransport( AsyncWebTransport(url,subrepo,verbose) )
         return WebTransport( url, subrepo, verbose )
     elif( url.startswith('\\') or url.startswith('smb:') ):
         return SMBTransport( url, subrepo )
@@ -46,10 +66,12 @@ def _open_single_transport( url, subrepo, verbose ):
         return LocalTransport( url, subrepo )
 
 
-def open_transports( spec, subrepo, write=False, verbose=0 ):
+def open_transports( spec, subrepo, write=False, verbose=0,
+                     async_transfers=False ):
     """Open one (R) or two (R & R/W) transports to a remote repo"""
     spec = spec.split(',')
-    reader = _open_single_transport( spec[0], subrepo, verbose )
+    reader = _open_single_transport( spec[0], subrepo, verbose,
+                                     async_transfers )
     if not write:
         return reader
     if len(spec) == 1:
@@ -62,7 +84,7 @@ def write_options_to_cfg( obj, cfg ):
     """Convert the options stored in the object into a config object"""
     cfg.add_section( OPTIONS_SECTION )
     for n in DEFAULT_OPTIONS:
-        cfg.set( 'general', n, str(getattr(obj,n)) )
+        cfg.set( 'general', n, repr(getattr(obj,n)) )
 
 
 def read_options_from_cfg( remote_cfg, command_line_options, obj ):
@@ -101,17 +123,99 @@ def read_options_from_cfg( remote_cfg, command_line_options, obj ):
 
 # ---------------------------------------------------------------------
 
-def sha1_file( size, filename ):
-    """Compute a hash over a file, using the same spec that Git uses"""
+def sha1_start( size ):
+    """Start a hash for a blob of the given size, as Git does"""
     s = hashlib.sha1()
     s.update("blob %u\0" % size)
+    return s
+
+def sha1_update_file( s, filename ):
+    """Add the contents of a file to a hash"""
     with open(filename,'rb') as f:
         while True:
-            bytes = f.read(8192)
+            bytes = f.read(65536)
             if not bytes:
                 break
             s.update(bytes)
-    return s.hexdigest()  
+    return s
+
+def sha1_file( size, filename ):
+    """Compute a hash over a file, using the same spec that Git uses"""
+    return sha1_update_file( sha1_start(size), filename ).hexdigest()
+
+
+class HashingWriter( object ):
+    """
+    A file-like object that passes all data written to another one, while
+    adding it to a hash
+    """
+    def __init__( self, dest, s ):
+        self._dest = dest
+        self._sha = s
+
+    def write( self, data ):
+        self._sha.update( data )
+        self._dest.write( data )
+
+
+class CompressingReader( object ):
+    """
+    A file-like object that reads data from another one, compressing it
+    """
+    def __init__( self, source ):
+        self._source = source
+        self._z = zlib.compressobj( COMPRESSION_LEVEL )
+        self._buffer = ''
+        self._eof = False
+
+    def read( self, size=-1 ):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self._source.read( 65536 )
+            if data:
+                self._buffer += self._z.compress( data )
+            else:
+                self._buffer += self._z.flush()
+                self._eof = True
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class DecompressingWriter( object ):
+    """
+    A file-like object that decompresses all data written, passing it to
+    another one. Call flush() when done.
+    """
+    def __init__( self, dest ):
+        self._dest = dest
+        self._z = zlib.decompressobj()
+
+    def write( self, data ):
+        try:
+            self._dest.write( self._z.decompress(data) )
+        except zlib.error as e:
+            raise TransportError( "corrupt compressed object: " + str(e) )
+
+    def flush( self ):
+        self._dest.write( self._z.flush() )
+
+
+class HashingReader( object ):
+    """
+    A file-like object that reads data from another one, while adding it to
+    a hash (and counting its size)
+    """
+    def __init__( self, source, s ):
+        self._source = source
+        self._sha = s
+        self.size = 0
+
+    def read( self, size=-1 ):
+        data = self._source.read( size )
+        self._sha.update( data )
+        self.size += len(data)
+        return data
 
 def fix_path(path):
     """Normalize a local path, and ensure we use forward slashes"""
@@ -227,80 +331,303 @@ class ArtifactReader( object ):
         self.verbose = options.verbose
         self.dry_run = options.dry_run
         self.subdir = options.subdir
+        self.jobs = getattr(options,'jobs',None) or DEFAULT_JOBS
+        self.async_transfers = getattr(options,'async_transfers',None) or 0
+        self.link_mode = getattr(options,'link_mode',None) or 'copy'
+        self.cache_dir = getattr(options,'cache_dir',None)
+        if self.cache_dir is None:
+            self.cache_dir = default_cache_dir()
+        if self.cache_dir:
+            self.cache_dir = os.path.abspath( self.cache_dir )
+        cache_size = getattr(options,'cache_size',None) or 0
+        self.object_cache = ObjectCache( self.cache_dir, cache_size*1024*1024 ) \
+                            if self.cache_dir and cache_size > 0 else None
+        self.profiler = getattr(options,'profiler',None) or NullProfiler()
         # Store the repository configuration from the options
         self._repo_config( options )
-        # Fetch remote lists
-        self.remote_branches = self._get_all_branches() # name : logmsg
-        self.remote_index = self._get_index()           # sha : [object spec]
+        # Remote lists are fetched when first needed
+        self._remote_lock = threading.Lock()
+        self._remote_branches = None                    # name : logmsg
+        self._remote_index = None                       # sha : [object spec]
+        self._pack_index = None                         # sha : [pack entry]
+        self.index_journal = None
         # Initialize local lists
         self._reset_lists()
 
+    @property
+    def remote_branches( self ):
+        """The branches in the remote repository, as a name:logmsg dict"""
+        if self._remote_branches is None:
+            with self._remote_lock:
+                if self._remote_branches is None:
+                    self._remote_branches = self._get_all_branches()
+        return self._remote_branches
+
+    @remote_branches.setter
+    def remote_branches( self, value ):
+        self._remote_branches = value
+
+    @property
+    def remote_index( self ):
+        """The index of the remote repository, as a sha:[object spec] dict"""
+        if self._remote_index is None:
+            with self._remote_lock:
+                if self._remote_index is None:
+                    self._remote_index = self._get_index()
+        return self._remote_index
+
+    @remote_index.setter
+    def remote_index( self, value ):
+        self._remote_index = value
+
+    @property
+    def pack_index( self ):
+        """The objects stored in packs, as a sha:[pack entry] dict"""
+        if self._pack_index is None:
+            with self._remote_lock:
+                if self._pack_index is None:
+                    self._pack_index = self._get_pack_index()
+        return self._pack_index
+
+    @pack_index.setter
+    def pack_index( self, value ):
+        self._pack_index = value
+
     def _reset_lists( self ):
         self.local_index = None                         # sha : [object spec]
         self.local_artifacts = None                     # sha : [list of files]
+        self.hash_cache = None
 
     def _repo_connect( self, source, subrepo ):
         """Open transport for reading"""
-        self.reader = open_transports( source, subrepo )
+        self.reader = open_transports( source, subrepo,
+                                       async_transfers=self.async_transfers )
         
 
+    @profiled( 'config' )
     def _repo_config( self, options ):
         """Prepare the configuration for the remote artifact repository"""
         # Open the remote repository
         self._repo_connect( options.server_url, options.repo_name )
+        self.areader = async_transport( self.reader )
+        self.meta_cache = MetadataCache( self.cache_dir,
+                                         options.server_url.split(',')[0],
+                                         options.repo_name ) \
+                          if self.cache_dir else None
         # Read remote options
         config = SafeConfigParser()
-        if not self.reader.exists( OPTIONS ):
+        data = self._get_remote_file( OPTIONS )
+        self.initialized = data is not None
+        if data is None:
             if self.verbose:
                 print "Warning: repository",options.repo_name,"not initialized"
         else:
-            with closing(StringIO.StringIO()) as buffer:
-                self.reader.get( OPTIONS, buffer )
-                buffer.seek( 0 )
+            with closing(StringIO.StringIO(data)) as buffer:
                 config.readfp( buffer )
         # Set the options, from defaults, remote config and command-line
         read_options_from_cfg( config, options, self )
+        # The index must be read the way it is stored, which is not the one
+        # set by the options when they are being changed
+        self.stored_options = {}
+        for k in ('index_format','journal_size'):
+            try:
+                self.stored_options[k] = ast.literal_eval(
+                    config.get(OPTIONS_SECTION,k) )
+            except NoOptionError:
+                self.stored_options[k] = DEFAULT_OPTIONS[k]
         #print self.__dict__
 
 
-    def _get_index( self ):
-        """Get the index of the remote repository"""
-        index = {}
-        if self.reader.exists( INDEX ):
+    def _get_remote_file( self, name ):
+        """
+        Read a (metadata) file from the remote repository
+          @return (str): the file contents, or \c None if it does not exist
+        """
+        if self.meta_cache is None:
+            with closing(StringIO.StringIO()) as buffer:
+                if not self.reader.get_if_exists( name, buffer ):
+                    return None
+                return buffer.getvalue()
+        # Revalidate the version we have in the cache, if any
+        validator, data = self.meta_cache.lookup( name )
+        with closing(StringIO.StringIO()) as buffer:
+            found, validator = self.reader.get_if_modified( name, buffer,
+                                                           validator )
+            if found is None:
+                return data
+            elif not found:
+                self.meta_cache.remove( name )
+                return None
+            data = buffer.getvalue()
+        if validator:
+            self.meta_cache.store( name, validator, data )
+        return data
+
+
+    def _open_binary_index( self ):
+        """
+        Open the index of the remote repository in binary format, mapping
+        it into memory if it is a local file, or else preparing to read it
+        by parts
+          @return (BinaryIndex): the index, or \c None if it does not exist
+        """
+        if hasattr( self.reader, 'local_path' ):
+            try:
+                with open( self.reader.local_path(BINARY_INDEX), 'rb' ) as f:
+                    data = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+            except EnvironmentError as e:
+                if e.errno == errno.ENOENT:
+                    return None
+                raise
+        elif not hasattr( self.reader, 'get_range' ):
+            data = self._get_remote_file( BINARY_INDEX )
+            if data is None:
+                return None
+        else:
+            def read( offset, size ):
+                with closing(StringIO.StringIO()) as buffer:
+                    if size is None:
+                        found = self.reader.get_if_exists( BINARY_INDEX,
+                                                           buffer, offset )
+                    else:
+                        found = self.reader.get_range( BINARY_INDEX, buffer,
+                                                       offset, size )
+                    if not found:
+                        raise TransportError( "can't access '%s'" %
+                                              BINARY_INDEX )
+                    return buffer.getvalue()
             with closing(StringIO.StringIO()) as buffer:
-                self.reader.get( INDEX, buffer )
-                for line in buffer.getvalue().splitlines():
-                    data = line.split(' ',4)
-                    index[ data[0] ] = [ float(data[1]), int(data[2]), 
-                                         int(data[3],8), data[4] ]
+                if not self.reader.get_range( BINARY_INDEX, buffer, 0,
+                                              BINARY_INDEX_HEADER ):
+                    return None
+                return BinaryIndex( read, True, buffer.getvalue(),
+                                    self.jobs )
+        return BinaryIndex( lambda offset, size : data[offset:] if size is None
+                            else data[offset:offset+size] )
+
+
+    @profiled( 'index' )
+    def _get_index( self ):
+        """
+        Get the index of the remote repository. A binary index is accessed
+        in place; if not available, we fall back to the text index. Shards
+        of a sharded index are fetched when needed. Entries in the index
+        journal, if used, are added on top.
+        """
+        index_format = self.stored_options['index_format']
+        if index_format not in INDEX_FORMAT_VERSION:
+            raise InvalidArgumentError( 'unknown index format: ' +
+                                        str(index_format) )
+        index = None
+        if index_format == 'sharded':
+            index = ShardedIndex( lambda prefix : self._get_remote_file(
+                posixjoin(INDEX_SHARDS,prefix)), self.jobs )
+        elif index_format != 'text':
+            index = self._open_binary_index()
+        if index is None:
+            index = {}
+            data = self._get_remote_file( INDEX )
+            if data is not None:
+                index.update( parse_index(data) )
+        # Add the journal
+        self.index_journal = None
+        if self.stored_options['journal_size']:
+            self.index_journal = self._get_remote_file( INDEX_JOURNAL )
+            if self.index_journal:
+                for k, v in parse_index(self.index_journal):
+                    index[k] = v
         return index
 
 
+    @profiled( 'index' )
+    def _get_pack_index( self ):
+        """
+        Get the index of the objects stored in packs, if the repository
+        has them
+        """
+        if not self.packed:
+            return {}
+        data = self._get_remote_file( PACK_INDEX )
+        return dict( parse_pack_index(data) ) if data else {}
+
+
+    @profiled( 'branches' )
     def _get_all_branches( self, get_logs=False ):
         """Get the list of branches in the remote repository"""
         branchlist = set()
-        if self.reader.exists( BRANCHES ):
-            with closing(StringIO.StringIO()) as buffer:
-                self.reader.get( BRANCHES, buffer )
-                branchlist.update( buffer.getvalue().splitlines() )
-        branches = {}
-        if not self.reader.exists(LOGS) or not get_logs:
+        data = self._get_remote_file( BRANCHES )
+        if data is not None:
+            branchlist.update( data.splitlines() )
+        if not get_logs:
             return dict( [(b,'') for b in branchlist] )
         else:
-            return dict( [(b,self.get_log(b)) for b in branchlist] )
+            return self._get_logs( branchlist )
+
+
+    def _get_log_store( self ):
+        """
+        Get the log messages for all branches kept in a single file, if the
+        repository has it (only repositories with a version recent enough
+        to keep it up to date do)
+          @return (dict): branch : log message, or \c None
+        """
+        if self.version < LOG_STORE_VERSION:
+            return None
+        data = self._get_remote_file( LOG_STORE )
+        if data is None:
+            return None
+        try:
+            return ast.literal_eval( data )
+        except (SyntaxError,ValueError):
+            raise TransportError( "can't parse remote log store" )
+
+
+    def _get_logs( self, branches ):
+        """
+        Get the log messages for a list of branches: from the log store if
+        there is one, or else fetching them one by one, in parallel. Branches
+        missing from the log store (e.g. lost by writers updating it at the
+        same time) are also fetched one by one
+          @return (dict): branch : log message
+        """
+        logs = self._get_log_store()
+        if logs is None:
+            return self._fetch_logs( branches )
+        missing = [ b for b in branches if b not in logs ]
+        logs.update( self._fetch_logs(missing) )
+        return dict( (b,logs[b]) for b in branches )
+
+
+    def _fetch_logs( self, branches ):
+        """
+        Get the log messages for a list of branches from their own files,
+        in parallel
+          @return (dict): branch : log message
+        """
+        branches = list( branches )
+        if not branches or not self.reader.exists( LOGS ):
+            return dict( (b,'') for b in branches )
+        return dict( zip(branches,run_parallel(self.get_log,branches,
+                                               self.jobs)) )
 
 
     def get_log( self, branch_string, return_none=False ):
         """Get the log message for a branch"""
-        name = LOGS + '/' + branch_string
-        if not self.reader.exists( name ):
-            return ''
-        with closing(StringIO.StringIO()) as buffer:
-            self.reader.get( name, buffer )
-            data = buffer.getvalue()
-        return data
+        data = self._get_remote_file( LOGS + '/' + branch_string )
+        return data if data is not None else ''
+
+
+    def _prefetch_index( self, shas ):
+        """
+        If the remote index is fetched by parts, fetch at once all the parts
+        holding a set of entries, instead of one at a time as they are used
+        """
+        shas = list( shas )
+        if shas and hasattr( self.remote_index, 'prefetch' ):
+            self.remote_index.prefetch( shas )
 
 
+    @profiled( 'branch' )
     def get_branch( self, branch_string, return_none=False ):
         """
         Get the list of artifacts in the remote repo that correspond to a given 
@@ -310,31 +637,33 @@ class ArtifactReader( object ):
             not exist (otherwise an exception is raised)
           @return (dict): all files in the branch, as a \t (key,path) dict
         """
-        name = REFS + '/' + branch_string
-        # Check the branch does exist
-        if return_none and not self.reader.exists( name ):
-            if self.verbose:
-                print "Warning: branch '%s' not in remote repo" % branch_string
-            return None
-        # Read the branch list from the server
-        with closing(StringIO.StringIO()) as buffer:
-            r = self.reader.get( name, buffer )
-            data = buffer.getvalue()
-        # Construct the branch dict
+        # Read the branch list from the server, checking it does exist
+        data = self._get_remote_file( REFS + '/' + branch_string )
+        if data is None:
+            if return_none:
+                if self.verbose:
+                    print "Warning: branch '%s' not in remote repo" % branch_string
+                return None
+            data = ''
+        # Construct the branch dict. Paths not given in the branch are taken
+        # from the index
+        self._prefetch_index( l for l in data.splitlines()
+                              if ' ' not in l )
         branch = defaultdict(list)
         prev = None
         for l in data.splitlines():
             f = l.split(' ',2)
             key = f[0]
             value = f[1] if len(f)>1 else self.remote_index[key][3]
+            # '-' repeats the previous object, for all its extra paths
             if key != '-':
                 branch[key].append( value )
+                prev = key
             else:
                 if prev is None:
                     print "Error in remote repo: invalid branch spec for '%s'" % branch_string
                     return None
                 branch[prev].append( value )
-            prev = key
 
         return branch
         
@@ -370,6 +699,8 @@ class ArtifactReader( object ):
         else:                           # gather remote artifacts
             clist = self.get_branch( branch_string, return_none=True )
             index = self.remote_index
+            if clist is not None:
+                self._prefetch_index( clist )
 
         if clist is None:
             return False
@@ -395,76 +726,127 @@ class ArtifactReader( object ):
         return True
 
 
-    def _add_local_file( self, name, size=None ):
+    def _add_local_file( self, name, st, sha ):
         """Add a local artifact file to our internal tables"""
-        if size is None:
-            size = os.path.getsize(name)
         visible_name = os.path.join(self.subdir,name) if self.subdir else name
-        s = [os.path.getmtime(name), size, 0644, visible_name]
-        k = sha1_file(size,name)
-        self.local_index[k] = s
-        self.local_artifacts[k].append( visible_name )
+        self.local_index[sha] = [st.st_mtime, st.st_size, 0644, visible_name]
+        self.local_artifacts[sha].append( visible_name )
+
+
+    @profiled( 'hashing' )
+    def _hash_files( self, names, hash_func=None ):
+        """
+        Compute the hashes for a list of local files, taking them from the
+        hash cache when possible and hashing the rest in parallel
+          @param names (list): the files to hash
+          @param hash_func (callable): function to hash a file, receiving its
+            name and stat data (by default, just compute its SHA1)
+          @return (list): a \t (stat,sha) tuple for each file
+        """
+        if hash_func is None:
+            hash_func = lambda name, st : sha1_file( st.st_size, name )
+        stats = [ os.stat(n) for n in names ]
+        hashes = [ self.hash_cache.lookup(n,st) if self.hash_cache else None
+                   for n, st in zip(names,stats) ]
+        missing = [ n for n in range(len(names)) if hashes[n] is None ]
+        computed = run_parallel( lambda n : hash_func(names[n],stats[n]),
+                                 missing, self.jobs )
+        for n, sha in zip(missing,computed):
+            hashes[n] = sha
+            if self.hash_cache:
+                self.hash_cache.store( names[n], stats[n], sha )
+        return zip( stats, hashes )
+
+
+    @profiled( 'scan' )
+    def _local_candidates( self ):
+        """
+        Find all files in the current directory that qualify as artifacts,
+        according to the repository options
+          @return (list): the names of all artifact files
+        """
+        if self.git_ignored:
+            return git_find_info( 'ignored', '.' )
+
+        # Compile extensions
+        artifact_ext = set( map(lambda s : s.lower() if s.startswith('.') 
+                                else '.'+s.lower(), 
+                                self.extensions) )
+
+        # Add all full paths (taking care of expanding globs)
+        full_files = set()
+        for f in self.files:
+            if any( c in f for c in '*?[]' ):
+                full_files.update( glob.glob(f) )
+            else:
+                full_files.add( f )
+
+        # Traverse the tree and add all matching files
+        candidates = []
+        for root, dirs, files in os.walk( '.' ):
+
+            # Remove the directory with the Git metadata
+            try:
+                dirs.remove( '.git' )
+            except ValueError:
+                pass
+
+            # Push all the files that match the conditions
+            for name in files:
+                fullname = fix_path( os.path.join(root,name) )
+                if os.path.islink( fullname ):
+                    continue        # skip symbolic links to files
+
+                # Build the set of extensions for this file
+                e = name.lower().split(os.path.extsep)[1:]
+                ext = set( [ '.' + os.path.extsep.join(e[i:]) 
+                             for i in range(0,len(e)) ])
+
+                size = os.path.getsize(fullname)
+                #print fullname, ext, size
+
+                if (fullname in full_files or 
+                    (not artifact_ext.isdisjoint(ext) and 
+                     size > self.min_size)):
+                    candidates.append( fullname )
+        return candidates
 
 
-    def _local_collect_list( self, local_basedir, reload=False ):
+    def _local_collect_list( self, local_basedir, reload=False,
+                             hash_func=None ):
         """
         Get all artifacts in the local checked out repository, and populate 
         the object's structure
+          @param hash_func (callable): function to hash files not in the
+            hash cache (see _hash_files)
         """
         if self.local_artifacts is not None and not reload:
             return
         self.local_index = {}                           # sha : [object spec]
         self.local_artifacts = defaultdict( list )      # sha : [list of files]
+        self.hash_cache = HashCache( self.cache_dir, local_basedir ) \
+                          if self.cache_dir else None
         current = os.getcwd()
         os.chdir( local_basedir )
         try:
-            if self.git_ignored:
-                for fullname in git_find_info( 'ignored', '.' ):
-                    self._add_local_file( fullname )
-                return
-
-            # Compile extensions
-            artifact_ext = set( map(lambda s : s.lower() if s.startswith('.') 
-                                    else '.'+s.lower(), 
-                                    self.extensions) )
-
-            # Add all full paths (taking care of expanding globs)
-            full_files = set()
-            for f in self.files:
-                if any( c in f for c in '*?[]' ):
-                    full_files.update( glob.glob(f) )
-                else:
-                    full_files.add( f )
-
-            # Traverse the tree and add all matching files
-            for root, dirs, files in os.walk( '.' ):
-
-                # Remove the directory with the Git metadata
-                try:
-                    dirs.remove( '.git' )
-                except ValueError:
-                    pass
-
-                # Push all the files that match the conditions
-                for name in files:
-                    fullname = fix_path( os.path.join(root,name) )
-                    if os.path.islink( fullname ):
-                        continue        # skip symbolic links to files
-
-                    # Build the set of extensions for this file
-                    e = name.lower().split(os.path.extsep)[1:]
-                    ext = set( [ '.' + os.path.extsep.join(e[i:]) 
-                                 for i in range(0,len(e)) ])
-
-                    size = os.path.getsize(fullname)
-                    #print fullname, ext, size
-
-                    if (fullname in full_files or 
-                        (not artifact_ext.isdisjoint(ext) and 
-                         size > self.min_size)):
-                        self._add_local_file( fullname, size )
+            names = self._local_candidates()
+            hashes = self._hash_files( names, hash_func )
+            for name, (st, sha) in zip(names,hashes):
+                self._add_local_file( name, st, sha )
         finally:
             os.chdir( current )
+        self._save_hash_cache( prune=True )
+
+
+    def _save_hash_cache( self, prune=False ):
+        """
+        Write the hash cache, if in use. If it cannot be written, it is
+        dropped for the rest of the session
+        """
+        if self.hash_cache and not self.hash_cache.save( prune ):
+            if self.verbose:
+                print "Warning: can't write the hash cache in", self.cache_dir
+            self.hash_cache = None
 
 
     def _compare_lists( self, collection1, collection2 ):
@@ -504,6 +886,7 @@ class ArtifactReader( object ):
         # -- first put all local files
         all_artifacts = self.local_index.copy()
         # -- now add all remote artifacts that are not in local
+        self._prefetch_index( item[0] for item in results[2] )
         all_artifacts.update( dict( (item[0],self.remote_index[item[0]]) 
                                     for item in results[2] ) )
 
@@ -561,6 +944,8 @@ class ArtifactReader( object ):
 
         # Print the lists
         if self.verbose:
+            self._prefetch_index( i[0] for l in lists.itervalues()
+                                  for i in l )
             self._print_diff( lists, self.remote_index )
         return lists
 
@@ -592,22 +977,256 @@ class ArtifactReader( object ):
         return lists
 
 
-    def _get_file( self, fileid, outname ):
+    def _fetch_chunks( self, manifest_path, dest, basis=None ):
         """
-        Download an artifact into a local file
+        Download a chunked object (a coroutine). Chunks also present in a
+        local file (usually a previous version of the same artifact) are
+        taken from it, and only the rest are downloaded
+          @param manifest_path (str): the remote name of the chunk manifest
+          @param dest (file): where to write the object contents
+          @param basis (str): name of the local file to take chunks from
+          @return (bool): \c False if there is no such chunked object
+        """
+        with closing(StringIO.StringIO()) as buffer:
+            if not (yield self.areader.get_if_exists( manifest_path, buffer )):
+                raise Return( False )
+            chunk_size, chunks = parse_manifest( buffer.getvalue() )
+        local = {}                                      # sha : offset
+        f = open( basis, 'rb' ) if basis and os.path.isfile(basis) else None
+        try:
+            if f:
+                offset = 0
+                for data in Chunker( chunk_size ).split( f ):
+                    local[ chunk_id(data) ] = offset
+                    offset += len(data)
+            for sha, size in chunks:
+                if sha in local:
+                    f.seek( local[sha] )
+                    dest.write( f.read(size) )
+                else:
+                    yield self.areader.get(
+                        posixjoin(*chunk_remote_location(sha)), dest )
+        finally:
+            if f:
+                f.close()
+        if self.verbose > 1:
+            print "  chunks for {0}: {1} local, {2} downloaded".format(
+                manifest_path, sum(1 for c in chunks if c[0] in local),
+                sum(1 for c in chunks if c[0] not in local) )
+        raise Return( True )
+
+
+    def _fetch_packed( self, fileid, dest, data=None ):
+        """
+        Read an object stored in a pack, with a single ranged read (a
+        coroutine)
+          @param data (str): the object data as stored in the pack, if
+            already read
+          @return (bool): \c False if the pack is not there
+        """
+        pack, offset, size, encoding = self.pack_index[fileid]
+        if encoding == 'zlib':
+            dest = DecompressingWriter( dest )
+        if data is not None:
+            dest.write( data )
+        elif not (yield self.areader.get_range( posixjoin(PACKS,pack), dest,
+                                                offset, size )):
+            raise Return( False )
+        if encoding == 'zlib':
+            dest.flush()
+        raise Return( True )
+
+
+    def _fetch_object( self, fileid, outname, basis=None, packed=None ):
+        """
+        Download an object into a local file (a coroutine). Data goes first
+        into a '.part' file next to it, so that an interrupted download can
+        be resumed later on; it is hashed while it gets written, and once
+        complete and verified against the object id, it is renamed to its
+        final name (replacing, not overwriting, any previous file, which
+        could be a hard link). A download that does not verify is discarded
+        and tried again.
+        Objects may be stored compressed (then they are decompressed while
+        downloaded, and not resumed), chunked (then the chunks found in
+        the \c basis file are not downloaded) or in a pack (then they are
+        not resumed either, and its \c packed data may have been read
+        already); we look first for the way they are most likely to be
+        stored.
+        """
+        partname = outname + '.part'
+        size = self.remote_index[fileid][1]
+        suffixes = ['',COMPRESSED_SUFFIX,CHUNKED_SUFFIX]
+        if use_chunks( self.chunk_size, size ):
+            suffixes.insert( 0, suffixes.pop(2) )
+        elif compressible( self.compression, self.remote_index[fileid][3] ):
+            suffixes.insert( 0, suffixes.pop(1) )
+        if fileid in self.pack_index:
+            suffixes.insert( 0, None )
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            for suffix in suffixes:
+                offset = 0
+                if suffix == '' and os.path.exists( partname ):
+                    offset = os.path.getsize( partname )
+                    if offset > size:
+                        offset = 0
+                s = sha1_start( size )
+                if offset:
+                    sha1_update_file( s, partname )
+                source_path = posixjoin( *object_remote_location(fileid,
+                                                                 suffix or '') )
+                with open( partname, 'ab' if offset else 'wb' ) as f:
+                    dest = HashingWriter( f, s )
+                    if suffix is None:
+                        found = yield self._fetch_packed( fileid, dest, packed )
+                        packed = None
+                    elif suffix == CHUNKED_SUFFIX:
+                        found = yield self._fetch_chunks( source_path, dest,
+                                                          basis )
+                    elif suffix:
+                        dest = DecompressingWriter( dest )
+                        found = yield self.areader.get_if_exists( source_path,
+                                                                  dest )
+                        if found:
+                            dest.flush()
+                    else:
+                        found = yield self.areader.get_if_exists( source_path,
+                                                                  dest, offset )
+                if found:
+                    break
+            else:
+                os.unlink( partname )
+                raise TransportError( "can't find object " + fileid )
+            if s.hexdigest() == fileid:
+                replace_file( partname, outname )
+                return
+            os.unlink( partname )
+            if self.verbose:
+                print "Warning: corrupt download for object", fileid
+        raise TransportError( "corrupt download for object " + fileid )
+
+
+    def _download_object( self, fileid, outname, basis=None, packed=None ):
+        """Download an object into a local file (see _fetch_object)"""
+        run_coroutine( self._fetch_object(fileid,outname,basis,packed) )
+
+
+    def _fetch_file( self, fileid, outname, packed=None ):
+        """
+        Download an artifact into a local file (a coroutine)
+          @param packed (str): the object data, if already read from a pack
+          @return (bool): whether the file contents were verified against
+            the object id on the way (i.e. not linked or copied from a
+            local file)
         """
         # Create the directory to put the file, if needed
         (head,tail) = os.path.split( outname )
         if head:
             mkpath_recursive( head )
-        # Download the file
+        # Download the file, through the object cache if we have it. Objects
+        # in a local folder may be linked instead of copied, unless they are
+        # stored compressed or chunked. The file being replaced, if any, may
+        # provide chunks for the new one
         source_path = posixjoin( *object_remote_location(fileid) )
-        with open(outname,'wb') as f:
-            self.reader.get( source_path, f )
-        # Set permissions & modification time
-        filedata = self.remote_index[fileid]
-        os.chmod( outname, int(filedata[2]) )
-        os.utime( outname, (-1, float(filedata[0])) )
+        method = 'copy'
+        if self.object_cache:
+            # Freshly downloaded objects are verified before being copied
+            verified = not self.object_cache.get(
+                fileid, outname,
+                lambda n : self._download_object(fileid,n,outname,packed),
+                self.link_mode )
+        elif self.link_mode != 'copy' and hasattr(self.reader,'local_path') \
+             and os.path.exists( self.reader.local_path(source_path) ):
+            method = link_or_copy( self.reader.local_path(source_path),
+                                   outname, self.link_mode )
+            verified = False
+        else:
+            yield self._fetch_object( fileid, outname, outname, packed )
+            verified = True
+        # Set permissions & modification time, unless the file is a hard link
+        # to the stored object (which may not even belong to us)
+        if method != 'hardlink':
+            filedata = self.remote_index[fileid]
+            os.chmod( outname, int(filedata[2]) )
+            os.utime( outname, (-1, float(filedata[0])) )
+        raise Return( verified )
+
+
+    def _get_file( self, fileid, outname, packed=None ):
+        """Download an artifact into a local file (see _fetch_file)"""
+        run_coroutine( self._fetch_file(fileid,outname,packed) )
+
+
+    def _download_runs( self, downloads ):
+        """
+        Group downloads so that packed objects close together in the same
+        pack are read at once
+          @param downloads (list): \c (fileid,outname) tuples
+          @return (list): lists of \c (fileid,outname) tuples, each to be
+            read at once
+        """
+        runs = []
+        packed = sorted( (self.pack_index[d[0]][:2],d) for d in downloads
+                         if d[0] in self.pack_index )
+        for (pack, offset), d in packed:
+            if runs:
+                first = self.pack_index[ runs[-1][0][0] ]
+                last = self.pack_index[ runs[-1][-1][0] ]
+                end = offset + self.pack_index[d[0]][2]
+                if pack == last[0] and \
+                   offset <= last[1] + last[2] + PACK_READ_GAP and \
+                   end - first[1] <= PACK_READ_SIZE:
+                    runs[-1].append( d )
+                    continue
+            runs.append( [d] )
+        return runs + [ [d] for d in downloads if d[0] not in self.pack_index ]
+
+
+    def _fetch_files( self, run ):
+        """
+        Download a list of artifacts, as \c (fileid,outname) tuples (a
+        coroutine). If there are more than one, they are packed objects to
+        be read in a single request
+          @return (list): the names of the files verified (see _fetch_file)
+        """
+        if len(run) == 1:
+            verified = yield self._fetch_file( *run[0] )
+            raise Return( [ run[0][1] ] if verified else [] )
+        entries = [ self.pack_index[d[0]] for d in run ]
+        start = entries[0][1]
+        end = max( e[1] + e[2] for e in entries )
+        with closing(StringIO.StringIO()) as buffer:
+            if not (yield self.areader.get_range(
+                    posixjoin(PACKS,entries[0][0]), buffer, start,
+                    end - start )):
+                raise TransportError( "can't find pack " + entries[0][0] )
+            data = buffer.getvalue()
+        verified = []
+        for (fileid, outname), e in zip( run, entries ):
+            if (yield self._fetch_file( fileid, outname,
+                                        data[e[1]-start:e[1]-start+e[2]] )):
+                verified.append( outname )
+        raise Return( verified )
+
+
+    @profiled( 'transfers' )
+    def _transfer( self, runs ):
+        """
+        Perform a list of downloads (see _download_runs). With asynchronous
+        transfers from an HTTP server they all run in a single thread, up
+        to the given number at once; otherwise they are spread over
+        parallel jobs. Downloads through the object cache always use jobs,
+        since the cache is filled by blocking calls.
+          @return (set): the names of the files verified (see _fetch_file)
+        """
+        if self.async_transfers and self.object_cache is None and \
+           not isinstance( self.areader, AsyncTransport ):
+            results = EventLoop().run( [ self._fetch_files(r) for r in runs ],
+                                       self.async_transfers )
+        else:
+            results = run_parallel( lambda r : run_coroutine(
+                                                   self._fetch_files(r)),
+                                    runs, self.jobs )
+        return set( name for r in results for name in r )
 
 
     def download_artifacts( self, branch_string, local_basedir, 
@@ -639,9 +1258,13 @@ class ArtifactReader( object ):
         for r in zip(results,('ok','old','new')):
             status.update( dict( (item,r[1]) for item in r[0] ) )
             
-        # Go over each artifact and perform the required action
+        # Go over each artifact and perform the required action. Downloads
+        # are queued, and done in parallel once all the list has been shown.
+        # Old files about to be replaced are kept until then, since they may
+        # hold chunks of the new ones
         prefix = len(self.subdir) if self.subdir else None
-        downloaded = 0
+        replaced = set( k[1] for k in status if status[k] == 'new' )
+        downloads = []
         for k in sorted( status, key=itemgetter(1) ):
 
             if prefix is None:
@@ -652,16 +1275,29 @@ class ArtifactReader( object ):
                 continue
 
             what = status.get(k)
-            action = '' if self.dry_run else "[DOWN]" if what == 'new' else "[DEL]" if what == 'old' and remove_old else ''
+            action = '' if self.dry_run else "[DOWN]" if what == 'new' else "[DEL]" if what == 'old' and remove_old and k[1] not in replaced else ''
             if self.verbose:
                 print '%4s: %s %s' % (what, outname, action)
             if action == '[DOWN]':
-                self._get_file( k[0], os.path.join(local_basedir,outname) )
-                downloaded += 1
+                downloads.append( (k[0], outname) )
             elif action== '[DEL]':
                 os.unlink( os.path.join(local_basedir,outname) )
 
-        return downloaded
+        verified = self._transfer(
+            self._download_runs([ (d[0],os.path.join(local_basedir,d[1]))
+                                  for d in downloads ]) )
+        if self.object_cache:
+            self.object_cache.trim()
+        # Downloaded files that have been verified can have their hashes
+        # trusted by later local scans; linked or copied ones cannot
+        if self.hash_cache:
+            for fileid, outname in downloads:
+                name = os.path.join( local_basedir, outname )
+                if name in verified:
+                    self.hash_cache.store( fix_path(outname), os.stat(name),
+                                           fileid )
+            self._save_hash_cache()
+        return len(downloads)
 
 
     def get( self, filename, branch, outname ):
@@ -677,11 +1313,13 @@ class ArtifactReader( object ):
             print "Error: no files in branch '%s'" % branch
             return False        
         for k,v in files.iteritems():
-            if v == filename:
+            if filename in v:
                 if not self.dry_run:
                     if self.verbose:
                         print "[DOWNLOADING]"
                     self._get_file( k, outname )
+                    if self.object_cache:
+                        self.object_cache.trim()
                 return True
         print "Error: can't find the file in branch '%s'" % branch
         return False
@@ -1,6 +1,11 @@
 __all__ = [ 'WebTransport', 'LocalTransport', 'SMBTransport',
-            'mkpath_recursive' ]
+            'AsyncWebTransport', 'AsyncTransport', 'SyncTransport',
+            'EventLoop', 'Return', 'async_transport', 'run_coroutine',
+            'mkpath_recursive', 'link_or_copy', 'copy_stream', 'replace_file' ]
 
 from http import WebTransport
-from local import LocalTransport, mkpath_recursive
+from aio import AsyncWebTransport, AsyncTransport, SyncTransport, EventLoop, \
+                Return, async_transport, run_coroutine
+from local import LocalTransport, mkpath_recursive, link_or_copy, copy_stream, \
+                  replace_file
 from smb import SMBTransport
@@ -0,0 +1,599 @@
+import os
+import sys
+import ssl
+import errno
+import types
+import socket
+import select
+import urllib
+import urlparse
+import threading
+from posixpath import join as posixjoin
+from collections import defaultdict, deque
+
+
+# ********************************************************************** <====
+
+from .. import TransportError
+from .http import BodyWriter, HTTP_MAX_REDIRECTS
+
+# ********************************************************************** ====>
+
+
+# Seconds to wait for any socket to get ready before giving up
+ASYNC_TIMEOUT = 120
+# Size of the blocks read from sockets
+ASYNC_BLOCK_SIZE = 65536
+# Maximum size of the status line & headers of an HTTP response
+ASYNC_MAX_HEADER = 65536
+# Maximum number of coroutines active at once where there is no poll(),
+# since select() only handles a limited number of sockets (FD_SETSIZE)
+ASYNC_SELECT_LIMIT = 500
+
+# Error codes for socket operations that would block
+_WOULD_BLOCK = ( errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS,
+                 errno.EALREADY, getattr(errno,'WSAEWOULDBLOCK',10035) )
+
+
+# ---------------------------------------------------------------------
+# Coroutines are generators, which may yield:
+#  * ('r',sock) or ('w',sock), to wait until a socket can be read/written
+#  * another coroutine, to run it and get back its result (or have its
+#    exception raised where it was yielded)
+# They finish with a result by raising Return, since Python 2 generators
+# cannot return values.
+#
+# Asynchronous transports provide the same methods as blocking transports
+# (exists, get, get_if_exists, get_if_modified, get_range; and for R/W
+# transports otype, put, delete, rename...) as coroutines, to be run in an
+# EventLoop. AsyncTransport turns a blocking transport into an asynchronous
+# one (whose operations do not overlap), and SyncTransport does the reverse.
+
+class Return( Exception ):
+    """Finish a coroutine with a result"""
+    def __init__( self, value=None ):
+        super(Return,self).__init__()
+        self.value = value
+
+
+def run_coroutine( coro ):
+    """Run a coroutine to completion, and get its result"""
+    return EventLoop().run( [coro] )[0]
+
+
+class _Task( object ):
+    """A coroutine being run, with the stack of coroutines it has called"""
+    def __init__( self, n, coro ):
+        self.n = n
+        self.stack = [ coro ]
+
+    def close( self ):
+        while self.stack:
+            self.stack.pop().close()
+
+
+class EventLoop( object ):
+    """
+    Run coroutines concurrently in a single thread, switching among them
+    whenever they need to wait for a socket
+    """
+
+    def __init__( self, timeout=ASYNC_TIMEOUT ):
+        self._timeout = timeout
+
+    def _step( self, task, value=None, exc=None ):
+        """
+        Advance a task until it has to wait for a socket, or it finishes
+          @return (tuple): \c ('r'|'w',sock) to wait, or \c (None,result)
+        """
+        while True:
+            coro = task.stack[-1]
+            try:
+                if exc is None:
+                    r = coro.send( value )
+                else:
+                    r = coro.throw( *exc )
+            except Return as e:
+                value, exc = e.value, None
+            except StopIteration:
+                value, exc = None, None
+            except Exception:
+                value, exc = None, sys.exc_info()
+            else:
+                value, exc = None, None
+                if isinstance( r, types.GeneratorType ):
+                    task.stack.append( r )
+                    continue
+                if isinstance( r, tuple ) and r[0] in ('r','w'):
+                    return r
+                value, exc = None, ( TypeError,
+                                     TypeError('invalid yield: %r' % (r,)),
+                                     None )
+                continue
+            task.stack.pop()
+            if not task.stack:
+                if exc is not None:
+                    raise exc[0], exc[1], exc[2]
+                return None, value
+
+    def _wait( self, readers, writers ):
+        """
+        Wait until some sockets can be read or written. poll() is used if
+        available, since select() fails with descriptors over FD_SETSIZE
+          @return (tuple): the lists of sockets ready to read & to write
+        """
+        if not hasattr( select, 'poll' ):
+            rl, wl, xl = select.select( readers, writers, [], self._timeout )
+            return rl, wl
+        poller = select.poll()
+        socks = ( dict( (s.fileno(),s) for s in readers ),
+                  dict( (s.fileno(),s) for s in writers ) )
+        for fd in socks[0]:
+            poller.register( fd, select.POLLIN )
+        for fd in socks[1]:
+            poller.register( fd, select.POLLOUT )
+        rl, wl = [], []
+        timeout = self._timeout * 1000 if self._timeout is not None else None
+        for fd, event in poller.poll( timeout ):
+            # errors & hang-ups are reported when the socket is used
+            if fd in socks[1]:
+                wl.append( socks[1][fd] )
+            else:
+                rl.append( socks[0][fd] )
+        return rl, wl
+
+    def run( self, coros, limit=None ):
+        """
+        Run coroutines, with at most \c limit of them active at once. If
+        one of them fails, the rest are stopped and its exception is raised
+          @return (list): their results, in the same order
+        """
+        if not hasattr( select, 'poll' ):
+            limit = min( limit or ASYNC_SELECT_LIMIT, ASYNC_SELECT_LIMIT )
+        pending = deque( enumerate(coros) )
+        results = [ None ] * len(pending)
+        ready = deque()                                 # (task,value,exc)
+        waiting = ( {}, {} )                            # sock : task
+        live = set()
+        try:
+            while pending or ready or waiting[0] or waiting[1]:
+                while pending and (not limit or len(live) < limit):
+                    task = _Task( *pending.popleft() )
+                    live.add( task )
+                    ready.append( (task,None,None) )
+                while ready:
+                    task, value, exc = ready.popleft()
+                    r = self._step( task, value, exc )
+                    if r[0] is None:
+                        results[task.n] = r[1]
+                        live.discard( task )
+                    else:
+                        waiting[ r[0] == 'w' ][ r[1] ] = task
+                if not (waiting[0] or waiting[1]):
+                    continue
+                rl, wl = self._wait( list(waiting[0]), list(waiting[1]) )
+                if not rl and not wl:
+                    e = socket.timeout( 'timed out' )
+                    for w in waiting:
+                        ready.extend( (t,None,(socket.timeout,e,None))
+                                      for t in w.itervalues() )
+                        w.clear()
+                for s in rl:
+                    ready.append( (waiting[0].pop(s),None,None) )
+                for s in wl:
+                    ready.append( (waiting[1].pop(s),None,None) )
+        finally:
+            for task in live:
+                task.close()
+            for n, coro in pending:
+                coro.close()
+        return results
+
+
+# ---------------------------------------------------------------------
+
+class AsyncTransport( object ):
+    """
+    Present a blocking transport as an asynchronous one: its methods become
+    coroutines that perform the whole operation when first run
+    """
+
+    def __init__( self, transport ):
+        self.transport = transport
+
+    def __getattr__( self, name ):
+        method = getattr( self.transport, name )
+        def coro( *args, **kwargs ):
+            raise Return( method(*args,**kwargs) )
+            yield
+        return coro
+
+
+class SyncTransport( object ):
+    """
+    Present an asynchronous transport as a blocking one: each call to its
+    methods runs the coroutine in an event loop of its own
+    """
+
+    def __init__( self, transport ):
+        self.transport = transport
+
+    def __getattr__( self, name ):
+        method = getattr( self.transport, name )
+        def run( *args, **kwargs ):
+            return run_coroutine( method(*args,**kwargs) )
+        return run
+
+
+def async_transport( transport ):
+    """Get the asynchronous version of a transport"""
+    if isinstance( transport, SyncTransport ):
+        return transport.transport
+    return AsyncTransport( transport )
+
+
+# ---------------------------------------------------------------------
+
+class AsyncConnection( object ):
+    """
+    A non-blocking connection to a server, with coroutines to send data
+    and receive it
+    """
+
+    def __init__( self, sock ):
+        self.sock = sock
+        self._buffer = ''
+
+    @classmethod
+    def open( cls, addr, scheme, host ):
+        """Connect to a server (a coroutine producing the connection)"""
+        sock = socket.socket( addr[0], socket.SOCK_STREAM )
+        try:
+            sock.setblocking( 0 )
+            err = sock.connect_ex( addr[4] )
+            if err in _WOULD_BLOCK:
+                yield 'w', sock
+                err = sock.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR )
+            if err:
+                raise socket.error( err, os.strerror(err) )
+            if scheme == 'https':
+                if hasattr( ssl, 'create_default_context' ):
+                    sock = ssl.create_default_context().wrap_socket(
+                        sock, server_hostname=host,
+                        do_handshake_on_connect=False )
+                else:
+                    sock = ssl.wrap_socket( sock,
+                                            do_handshake_on_connect=False )
+                yield cls(sock)._retry( 'w', sock.do_handshake )
+        except:
+            sock.close()
+            raise
+        raise Return( cls(sock) )
+
+    def _retry( self, mode, operation, *args ):
+        """Run a socket operation, waiting for the socket while it blocks"""
+        while True:
+            try:
+                result = operation( *args )
+            except ssl.SSLError as e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    yield 'r', self.sock
+                elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                    yield 'w', self.sock
+                else:
+                    raise
+            except socket.error as e:
+                if e.args[0] not in _WOULD_BLOCK:
+                    raise
+                yield mode, self.sock
+            else:
+                raise Return( result )
+
+    def send( self, data ):
+        """Send all the data"""
+        while data:
+            n = yield self._retry( 'w', self.sock.send, data )
+            data = data[n:]
+
+    def recv( self ):
+        """Receive the next block of data (empty when the server closes)"""
+        if self._buffer:
+            data, self._buffer = self._buffer, ''
+            raise Return( data )
+        data = yield self._retry( 'r', self.sock.recv, ASYNC_BLOCK_SIZE )
+        raise Return( data )
+
+    def recv_some( self, size ):
+        """Receive at most \c size bytes, failing if the server closes"""
+        data = yield self.recv()
+        if not data:
+            raise socket.error( 'connection closed by server' )
+        self._buffer = data[size:]
+        raise Return( data[:size] )
+
+    def recv_until( self, sep ):
+        """Receive data up to a separator (included)"""
+        data = ''
+        while True:
+            data += yield self.recv_some( ASYNC_BLOCK_SIZE )
+            pos = data.find( sep )
+            if pos >= 0:
+                self._buffer = data[pos+len(sep):]
+                raise Return( data[:pos+len(sep)] )
+            if len(data) > ASYNC_MAX_HEADER:
+                raise socket.error( 'invalid response from server' )
+
+    def close( self ):
+        self.sock.close()
+
+
+class AsyncResponse( object ):
+    """
+    An HTTP response, whose status & headers have been received, with
+    a coroutine to receive its body
+    """
+
+    def __init__( self, conn, key, method, url, head ):
+        self.conn = conn
+        self.key = key
+        self.url = url
+        self._method = method
+        lines = head.split( '\r\n' )
+        try:
+            version, status = lines[0].split( ' ', 2 )[:2]
+            self.status = int( status )
+        except ValueError:
+            raise socket.error( 'invalid response from server' )
+        self._headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split( ':', 1 )
+                name = name.strip().lower()
+                if name in self._headers:
+                    value = self._headers[name] + ', ' + value.strip()
+                self._headers[name] = value.strip()
+        connection = self.getheader( 'connection', '' ).lower()
+        self.will_close = 'close' in connection or \
+                          (version == 'HTTP/1.0' and 'keep-alive' not in
+                           connection)
+
+    def getheader( self, name, default=None ):
+        return self._headers.get( name.lower(), default )
+
+    def read_body( self, write ):
+        """
+        Receive the response body, passing each block to \c write. If it
+        returns \c False, the rest of the body is not wanted
+          @return (bool): \c True if the whole body was received
+        """
+        if self._method == 'HEAD' or self.status in (204,304) or \
+           self.status < 200:
+            raise Return( True )
+        if 'chunked' in self.getheader( 'transfer-encoding', '' ).lower():
+            while True:
+                line = yield self.conn.recv_until( '\r\n' )
+                try:
+                    size = int( line.split(';')[0], 16 )
+                except ValueError:
+                    raise socket.error( 'invalid chunk in response' )
+                if not size:
+                    break
+                while size:
+                    data = yield self.conn.recv_some( size )
+                    size -= len(data)
+                    if not write( data ):
+                        raise Return( False )
+                yield self.conn.recv_until( '\r\n' )
+            while (yield self.conn.recv_until('\r\n')) != '\r\n':
+                pass                                    # trailers
+            raise Return( True )
+        size = self.getheader( 'content-length' )
+        if size is None:
+            self.will_close = True
+            while True:
+                data = yield self.conn.recv()
+                if not data:
+                    raise Return( True )
+                if not write( data ):
+                    raise Return( False )
+        size = int( size )
+        while size:
+            data = yield self.conn.recv_some( size )
+            size -= len(data)
+            if not write( data ) and size:
+                raise Return( False )
+        raise Return( True )
+
+
+# ---------------------------------------------------------------------
+
+class AsyncWebTransport( object ):
+    """
+    A read-only transport using HTTP to access a remote repository, whose
+    methods are coroutines: any number of transfers can go on at the same
+    time in a single event loop, each one over a persistent connection.
+    Proxies are not supported.
+    """
+
+    def __init__( self, url_base, subrepo='', verbose=0 ):
+        self._verbose = verbose
+        self._base = posixjoin( url_base, subrepo )
+        if not self._base.endswith('/'):
+            self._base += '/'
+        self._idle = defaultdict( list )        # (scheme,host,port) : [conns]
+        self._addrs = {}                        # (scheme,host,port) : addr
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def usable( url_base ):
+        """Find out if a URL can be accessed with this transport"""
+        scheme = urlparse.urlsplit( url_base ).scheme
+        if scheme not in ('http','https'):
+            return False
+        proxy = urllib.getproxies().get( scheme )
+        return not proxy or urllib.proxy_bypass(
+            urlparse.urlsplit(url_base).hostname )
+
+    def _connect( self, key ):
+        """Get a connection to a host: an idle one, or else a new one"""
+        with self._lock:
+            if self._idle[key]:
+                raise Return( (self._idle[key].pop(),True) )
+        scheme, host, port = key
+        addr = self._addrs.get( key )
+        if addr is None:
+            port = port or (443 if scheme == 'https' else 80)
+            addr = socket.getaddrinfo( host, port, 0, socket.SOCK_STREAM )[0]
+            self._addrs[key] = addr
+        conn = yield AsyncConnection.open( addr, scheme, host )
+        raise Return( (conn,False) )
+
+    def _send( self, method, url, headers ):
+        """
+        Send a request, and receive the status & headers of its response.
+        A request sent over a reused connection that the server had already
+        closed is retried over a fresh one
+        """
+        parts = urlparse.urlsplit( url )
+        if parts.scheme not in ('http','https') or not parts.hostname:
+            raise socket.error( 'invalid url' )
+        key = ( parts.scheme, parts.hostname, parts.port )
+        path = urlparse.urlunsplit( ('','',parts.path or '/',parts.query,'') )
+        request = [ '%s %s HTTP/1.1' % (method,path),
+                    'Host: ' + parts.netloc.rsplit('@',1)[-1],
+                    'Accept-Encoding: identity' ]
+        request.extend( '%s: %s' % h for h in headers.iteritems() )
+        request = '\r\n'.join( request ) + '\r\n\r\n'
+        while True:
+            conn, reused = yield self._connect( key )
+            try:
+                yield conn.send( request )
+                head = yield conn.recv_until( '\r\n\r\n' )
+                raise Return( AsyncResponse(conn,key,method,url,head) )
+            except socket.error:
+                conn.close()
+                if not reused:
+                    raise
+
+    def _request( self, method, path, headers=None ):
+        """
+        Send a request for a repository path, following redirections, and
+        produce its response; its body must then be received with
+        _read_body(), which also releases the connection
+          @except TransportError on any access errors
+        """
+        url = self._base + path
+        try:
+            for n in range(HTTP_MAX_REDIRECTS+1):
+                u = yield self._send( method, url, headers or {} )
+                if u.status not in (301,302,303,307,308):
+                    raise Return( u )
+                yield self._read_body( u )
+                url = urlparse.urljoin( url, u.getheader('location') )
+        except socket.error as e:
+            raise TransportError( "can't access '%s' : %s" % (url,str(e)) )
+        raise TransportError( "can't access '%s' : too many redirections"
+                              % url )
+
+    def _read_body( self, u, write=None ):
+        """
+        Receive the body of a response, passing it to \c write (or else
+        discarding it), and then keep its connection for further requests
+        if possible
+          @return (bool): \c True if the whole body was received
+        """
+        try:
+            complete = yield u.read_body( write or (lambda data : True) )
+        except socket.error as e:
+            u.conn.close()
+            raise TransportError( "can't access '%s' : %s" % (u.url,str(e)) )
+        except:
+            u.conn.close()
+            raise
+        if complete and not u.will_close:
+            with self._lock:
+                self._idle[u.key].append( u.conn )
+        else:
+            u.conn.close()
+        raise Return( complete )
+
+    def _read_into( self, u, source_name, dest, offset=0, size=None ):
+        """Receive the body of a response into a file-like object"""
+        body = BodyWriter( u, source_name, dest, offset, size, self._verbose )
+        if (yield self._read_body( u, body.write )):
+            body.close()
+
+    def _check_status( self, u ):
+        """
+        Raise an exception for an error status other than 404. The body of
+        the response must have been received already, to release its
+        connection
+        """
+        if u.status >= 400 and u.status != 404:
+            raise TransportError( "can't access '%s' (%d)" % (u.url,u.status) )
+
+    def exists( self, path ):
+        """Test if a path exists in the repository (see WebTransport)"""
+        u = yield self._request( 'HEAD', path )
+        yield self._read_body( u )
+        self._check_status( u )
+        raise Return( u.status != 404 )
+
+    def get_if_exists( self, source_name, dest, offset=0 ):
+        """Get a file, if it exists (see WebTransport)"""
+        headers = { 'Range' : 'bytes=%d-' % offset } if offset else {}
+        u = yield self._request( 'GET', source_name, headers )
+        if u.status >= 400:
+            yield self._read_body( u )
+            # on 416, we may already have the whole file
+            total = (u.getheader('content-range') or '').split('/')[-1]
+            if u.status == 416 and total == str(offset):
+                raise Return( True )
+            self._check_status( u )
+            raise Return( False )
+        yield self._read_into( u, source_name, dest, offset )
+        raise Return( True )
+
+    def get_if_modified( self, source_name, dest, validator=None ):
+        """Get a file, unless it has not changed (see WebTransport)"""
+        headers = {}
+        if validator and validator.get('etag'):
+            headers['If-None-Match'] = validator['etag']
+        if validator and validator.get('last-modified'):
+            headers['If-Modified-Since'] = validator['last-modified']
+        u = yield self._request( 'GET', source_name, headers )
+        if u.status == 304 or u.status >= 400:
+            yield self._read_body( u )
+            self._check_status( u )
+            raise Return( ((None if u.status == 304 else False), validator) )
+        yield self._read_into( u, source_name, dest )
+        validator = dict( (h,u.getheader(h)) for h in ('etag','last-modified')
+                          if u.getheader(h) )
+        raise Return( (True, validator or None) )
+
+    def get_range( self, source_name, dest, offset, size ):
+        """Get a part of a file (see WebTransport)"""
+        headers = { 'Range' : 'bytes=%d-%d' % (offset,offset+size-1) }
+        u = yield self._request( 'GET', source_name, headers )
+        if u.status >= 400:
+            yield self._read_body( u )
+            if u.status == 416:
+                raise Return( True )
+            self._check_status( u )
+            raise Return( False )
+        yield self._read_into( u, source_name, dest, offset, size )
+        raise Return( True )
+
+    def get( self, source_name, dest, offset=0 ):
+        """Get a file, which must exist (see WebTransport)"""
+        if not (yield self.get_if_exists( source_name, dest, offset )):
+            raise TransportError( "can't access '%s' (404): Not Found" %
+                                  (self._base + source_name) )
+
+    def close( self ):
+        """Close all idle connections"""
+        with self._lock:
+            for conns in self._idle.itervalues():
+                for c in conns:
+                    c.close()
+            self._idle.clear()
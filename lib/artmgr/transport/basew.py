@@ -11,6 +11,9 @@ import os.path
 # ---------------------------------------------------------------------
 # Read-write transports inherit from BaseWTransport. They need to support:
 #  * get
+#  * get_if_exists (optional)
+#  * get_if_modified (optional)
+#  * get_range (optional)
 #  * otype
 #  * init_base
 #  * put
@@ -24,19 +27,34 @@ class BaseWTransport( object ):
     A parent class providing some common functionality for R/W tranports
     """
 
+    def __init__( self ):
+        # Folders known to exist in the repository, which need not be
+        # checked again (folders are never removed)
+        self.known_folders = set()
+
     def folder_ensure( self, folder ):
-        """Ensure a path exists in the repository. Create it if not"""
+        """
+        Ensure a path exists in the repository. Create it if not. Folders
+        already checked or created are remembered, and not checked again
+        """
         if not folder:
             raise InvalidArgumentError('empty folder')
-        t = self.otype( folder )
-        if t == 'D':
+        if folder in self.known_folders:
             return
-        elif t == 'F':
+        t = self.otype( folder )
+        if t == 'F':
             raise TransportError( "can't make folder: %s is a file" % folder )
-        (parent,name) = os.path.split( folder )
-        if parent:
-            self.folder_ensure( parent )
-        self.folder_create( folder )
+        elif t != 'D':
+            (parent,name) = os.path.split( folder )
+            if parent:
+                self.folder_ensure( parent )
+            try:
+                self.folder_create( folder )
+            except (IOError,OSError):
+                # it may have been created meanwhile by a parallel upload
+                if self.otype( folder ) != 'D':
+                    raise
+        self.known_folders.add( folder )
 
     def exists( self, path ):
         """
@@ -45,6 +63,29 @@ class BaseWTransport( object ):
         check = self.otype( path )
         return check in ('F','D')
 
+    def get_if_exists( self, sourcename, dest, offset=0 ):
+        """
+        Read a file into a file-like destination, if it exists.
+        Transports able to do it in one operation should override this.
+          @return (bool): \c True if ok, \c False if the file does not exist
+        """
+        if not self.exists( sourcename ):
+            return False
+        self.get( sourcename, dest, offset )
+        return True
+
+    def get_if_modified( self, sourcename, dest, validator=None ):
+        """
+        Read a file into a file-like destination, unless it has not changed
+        since the version identified by the validator. 
+        Transports able to check it should override this; by default the
+        file is always read.
+          @return (tuple): \c (status,validator), where status is \c True
+            if the file was read, \c False if it does not exist, or \c None
+            if it has not been modified (and then nothing has been written)
+        """
+        return self.get_if_exists( sourcename, dest ), None
+
     def update( self, source, destname ):
         """
         Create or update a file in the repository, as atomically as possible
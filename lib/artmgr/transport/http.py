@@ -1,8 +1,16 @@
+
 import os
+import re
 import sys
 import errno
-import urllib2
+import socket
+import httplib
+import urllib
+import urlparse
+import threading
 from posixpath import join as posixjoin
+from collections import defaultdict
+from contextlib import contextmanager
 
 
 # ********************************************************************** <====
@@ -12,20 +20,218 @@ from .. import TransportError
 # ********************************************************************** ====>
 
 
+# Maximum number of idle connections to keep open for each host
+HTTP_POOL_SIZE = 8
+# Maximum number of redirections to follow for a request
+HTTP_MAX_REDIRECTS = 5
+
+
 # ---------------------------------------------------------------------
-# Read-only transports need to support two methods:
+
+class HTTPConnectionPool( object ):
+    """
+    A small thread-safe pool of persistent HTTP/1.1 connections, so that
+    consecutive requests to the same host reuse the same socket instead of
+    doing a new TCP (and possibly TLS) handshake each time
+    """
+
+    def __init__( self, maxsize=HTTP_POOL_SIZE ):
+        self._maxsize = maxsize
+        self._idle = defaultdict( list )        # (scheme,host,port) : [conns]
+        self._lock = threading.Lock()
+
+    def _connect( self, key ):
+        """Create a new connection to a host, possibly through a proxy"""
+        scheme, host, port = key
+        proxy = urllib.getproxies().get( scheme )
+        if proxy and not urllib.proxy_bypass( host ):
+            p = urlparse.urlsplit( proxy )
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection( p.hostname, p.port )
+                conn.set_tunnel( host, port )
+                return conn, False
+            return httplib.HTTPConnection( p.hostname, p.port ), True
+        if scheme == 'https':
+            return httplib.HTTPSConnection( host, port ), False
+        return httplib.HTTPConnection( host, port ), False
+
+    def _acquire( self, key ):
+        """
+        Get a connection for a host: an idle one if available, else a new one
+          @return (tuple): \c (connection, via_proxy, reused)
+        """
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop() + (True,)
+        return self._connect( key ) + (False,)
+
+    def _release( self, key, conn, via_proxy ):
+        """Give back a connection to the pool, for further reuse"""
+        with self._lock:
+            if len(self._idle[key]) < self._maxsize:
+                self._idle[key].append( (conn,via_proxy) )
+                return
+        conn.close()
+
+    @contextmanager
+    def request( self, method, url, headers=None ):
+        """
+        Send an HTTP request, and yield its response. When the caller is
+        done with it, the connection goes back to the pool if the server
+        allows it and the response body has been completely read.
+        A request sent over a reused connection that the server had already
+        closed is transparently retried over a fresh one.
+        """
+        parts = urlparse.urlsplit( url )
+        if parts.scheme not in ('http','https') or not parts.hostname:
+            raise httplib.InvalidURL( 'invalid url' )
+        key = ( parts.scheme, parts.hostname, parts.port )
+        path = urlparse.urlunsplit( ('','',parts.path or '/',parts.query,'') )
+        while True:
+            conn, via_proxy, reused = self._acquire( key )
+            try:
+                conn.request( method, url if via_proxy else path,
+                              headers=headers or {} )
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException,socket.error):
+                conn.close()
+                if not reused:
+                    raise
+        try:
+            yield response
+        except:
+            conn.close()
+            raise
+        if response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            self._release( key, conn, via_proxy )
+
+    def close( self ):
+        """Close all idle connections"""
+        with self._lock:
+            for conns in self._idle.itervalues():
+                for c in conns:
+                    c[0].close()
+            self._idle.clear()
+
+
+# ---------------------------------------------------------------------
+
+class BodyWriter( object ):
+    """
+    Copy the body of a response into a file-like object as it arrives,
+    checking that it is complete
+    """
+
+    def __init__( self, u, source_name, dest, offset=0, size=None,
+                  verbose=0 ):
+        """
+          @param u: the response, with \c status & \c url attributes and a
+            \c getheader() method
+          @param offset (int): position in the file the data written must
+            start at. If the server did not honour our range request, the
+            body will start earlier, and we skip the leading data
+          @param size (int): maximum number of bytes to write
+        """
+        start = 0
+        if u.status == 206:
+            m = re.match( r'bytes (\d+)-', u.getheader('content-range') or '' )
+            if not m:
+                raise TransportError( "invalid range in response for '%s'" %
+                                      u.url )
+            start = int( m.group(1) )
+        self._skip = offset - start
+        if self._skip < 0:
+            raise TransportError( "invalid range in response for '%s'" % u.url )
+        self._url = u.url
+        self._dest = dest
+        self._size = size
+        self._file_size = u.getheader("Content-Length")
+        self._file_size_dl = 0
+        file_name = source_name.split('/')[-1]
+        if verbose > 1 and size is None:
+            # a single write, so that output from parallel downloads does
+            # not get mixed
+            sys.stdout.write( " .. downloading: %40s    size: %s%s\n" %
+                              (file_name, self._file_size,
+                               ' (from %d)' % offset if offset else '') )
+
+    def write( self, buffer ):
+        """
+        Process a block of the body
+          @return (bool): \c False if no more data is wanted
+        """
+        self._file_size_dl += len(buffer)
+        if self._skip:
+            n = min( self._skip, len(buffer) )
+            buffer = buffer[n:]
+            self._skip -= n
+        if self._size is not None:
+            buffer = buffer[:self._size]
+            self._size -= len(buffer)
+        self._dest.write(buffer)
+        return self._size != 0
+
+    def close( self ):
+        """Check that the whole body has been received"""
+        if self._file_size is not None and \
+           self._file_size_dl != int(self._file_size):
+            raise TransportError( "incomplete transfer for '%s': got %d of %s"
+                                  " bytes" % (self._url,self._file_size_dl,
+                                              self._file_size) )
+
+
+# ---------------------------------------------------------------------
+# Read-only transports need to support these methods:
 #  * exists
-#  * get        
+#  * get
+#  * get_if_exists
+#  * get_if_modified
+#  * get_range (optional)
 
 class WebTransport( object ):
     """
     A read-only transport using HTTP to access a remote repository
     """
-    def __init__(self, url_base, subrepo='', verbose=0):        
+    def __init__(self, url_base, subrepo='', verbose=0):
         self._verbose = verbose
         self._base = posixjoin( url_base, subrepo )
         if not self._base.endswith('/'):
             self._base += '/'
+        self._pool = HTTPConnectionPool()
+
+    @contextmanager
+    def _request( self, method, path, headers=None ):
+        """
+        Send a request for a repository path, following redirections, and
+        yield its response (with a \c url attribute holding the final URL)
+          @except TransportError on any access errors other than a 404
+            (Not Found) status code.
+        """
+        url = self._base + path
+        try:
+            for n in range(HTTP_MAX_REDIRECTS+1):
+                with self._pool.request( method, url, headers ) as response:
+                    if response.status not in (301,302,303,307,308):
+                        response.url = url
+                        yield response
+                        return
+                    response.read()
+                    url = urlparse.urljoin( url,
+                                            response.getheader('location') )
+        except (httplib.HTTPException,socket.error) as e:
+            raise TransportError( "can't access '%s' : %s" % (url,str(e)) )
+        raise TransportError( "can't access '%s' : too many redirections"
+                              % url )
+
+    def _check_status( self, response ):
+        """Raise an exception for an error status other than 404"""
+        if response.status >= 400 and response.status != 404:
+            raise TransportError( "can't access '%s' (%d): %s" %
+                                  (response.url,response.status,
+                                   response.reason) )
 
     def exists( self, path ):
         """
@@ -35,48 +241,108 @@ class WebTransport( object ):
           @except TransportError on any access errors other than a 404
             (Not Found) status code.
         """
-        url = self._base + path
-        request = urllib2.Request(url)
-        request.get_method = lambda : 'HEAD'
-        try:
-            response = urllib2.urlopen(request)
-            return True
-        except ValueError as e:
-            raise TransportError( "can't access '%s' : invalid url" % url )
-        except urllib2.HTTPError as e:
-            if e.code == 404:
-                return False
-            raise TransportError( "can't access '%s' (%d): %s" % 
-                                  (url,e.code,str(e.reason)) )
-        except urllib2.URLError as e:
-            raise TransportError( "can't access '%s' : %s" % 
-                                  (url,str(e.reason)) )
+        with self._request( 'HEAD', path ) as response:
+            response.read()
+            self._check_status( response )
+            return response.status != 404
 
 
-    def get( self, source_name, dest ):
+    def _read_body( self, u, source_name, dest, offset=0, size=None ):
         """
-        Get a file given its path, and store its contents in the 
-        file-like object given.
-        Any HTTP access or fetch error will generate an exception. To
-        ensure the file is there before trying, use the exists() method.
+        Copy the body of a response into a file-like object, checking that
+        it is complete (see BodyWriter)
         """
-        u = urllib2.urlopen( self._base + source_name )
-        meta = u.info()
-        file_size = int(meta.getheaders("Content-Length")[0])
-        file_name = source_name.split('/')[-1]
-        if self._verbose > 1:
-            print " .. downloading: %40s    size: %s" % (file_name, file_size)
-
-        file_size_dl = 0
-        block_sz = 8192
+        body = BodyWriter( u, source_name, dest, offset, size, self._verbose )
         while True:
-            buffer = u.read(block_sz)
+            buffer = u.read( 8192 )
             if not buffer:
                 break
-            file_size_dl += len(buffer)
-            dest.write(buffer)
-            #status = r"%10d  [%3.2f%%]" % (file_size_dl, file_size_dl * 100. / file_size)
-            #status = status + chr(8)*(len(status)+1)
-            #print status,
+            if not body.write( buffer ):
+                return          # any remaining data is not wanted
+        body.close()
+
+
+    def get_if_exists( self, source_name, dest, offset=0 ):
+        """
+        Get a file given its path, and store its contents in the
+        file-like object given. A single request is sent to the server.
+          @param offset (int): start position within the file, to resume
+            an interrupted transfer (using an HTTP range request)
+          @return (bool): \c True if ok, \c False if the file does not exist
+          @except TransportError on any access errors other than a 404
+            (Not Found) status code.
+        """
+        headers = { 'Range' : 'bytes=%d-' % offset } if offset else {}
+        with self._request( 'GET', source_name, headers ) as u:
+            if u.status == 416:
+                # we may already have the whole file
+                u.read()
+                total = (u.getheader('content-range') or '').split('/')[-1]
+                if total == str(offset):
+                    return True
+            self._check_status( u )
+            if u.status == 404:
+                u.read()
+                return False
+            self._read_body( u, source_name, dest, offset )
+            return True
+
+
+    def get_if_modified( self, source_name, dest, validator=None ):
+        """
+        Get a file given its path, unless it has not changed since the
+        version identified by the validator, using a conditional request
+          @param validator (dict): the ETag and/or Last-Modified headers
+            returned by the server for the version we already have
+          @return (tuple): \c (status,validator), where status is \c True
+            if the file was fetched, \c False if it does not exist, or \c None
+            if it has not been modified (and then nothing has been written)
+        """
+        headers = {}
+        if validator and validator.get('etag'):
+            headers['If-None-Match'] = validator['etag']
+        if validator and validator.get('last-modified'):
+            headers['If-Modified-Since'] = validator['last-modified']
+        with self._request( 'GET', source_name, headers ) as u:
+            self._check_status( u )
+            if u.status in (304,404):
+                u.read()
+                return (None if u.status == 304 else False), validator
+            self._read_body( u, source_name, dest )
+            validator = dict( (h,u.getheader(h)) 
+                              for h in ('etag','last-modified')
+                              if u.getheader(h) )
+            return True, validator or None
+
 
-            
+    def get_range( self, source_name, dest, offset, size ):
+        """
+        Get a part of a file given its path, and store it in the file-like
+        object given, using an HTTP range request
+          @param offset (int): start position within the file
+          @param size (int): number of bytes to get (less if the file ends)
+          @return (bool): \c True if ok, \c False if the file does not exist
+        """
+        headers = { 'Range' : 'bytes=%d-%d' % (offset,offset+size-1) }
+        with self._request( 'GET', source_name, headers ) as u:
+            if u.status == 416:
+                u.read()
+                return True
+            self._check_status( u )
+            if u.status == 404:
+                u.read()
+                return False
+            self._read_body( u, source_name, dest, offset, size )
+            return True
+
+
+    def get( self, source_name, dest, offset=0 ):
+        """
+        Get a file given its path, and store its contents in the
+        file-like object given, optionally starting at a given offset.
+        Any HTTP access or fetch error will generate an exception. To
+        fetch a file that may not be there, use the get_if_exists() method.
+        """
+        if not self.get_if_exists( source_name, dest, offset ):
+            raise TransportError( "can't access '%s' (404): Not Found" %
+                                  (self._base + source_name) )
@@ -12,6 +12,16 @@ import re
 
 # chunksize for reading/writing local files
 CHUNK = 8192
+# maximum chunksize for copies between real files
+MAX_CHUNK = 4*1024*1024
+
+# ioctl request to clone a file as copy-on-write (Linux: btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 # ---------------------------------------------------------------------
@@ -28,7 +38,82 @@ def mkpath_recursive(path):
         (head,tail) = os.path.split( path )
         if head:
             mkpath_recursive( head )
-        os.mkdir( path )
+        try:
+            os.mkdir( path )
+        except OSError as e:
+            # another thread or process may have created it meanwhile
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def replace_file( source, dest ):
+    """Rename a local file over another one (which may exist)"""
+    try:
+        os.rename( source, dest )
+    except OSError:
+        # Windows does not allow renaming over an existing file
+        if not os.path.exists( dest ):
+            raise
+        os.unlink( dest )
+        os.rename( source, dest )
+
+
+def copy_stream( source, dest ):
+    """
+    Copy all remaining data from a file-like source into a destination.
+    When the source is a real file, use large buffers, growing while it
+    gives full reads (the destination may be anything, such as a writer
+    that hashes the data). Other sources are copied in small chunks.
+      @param source (file): an object with a read() method
+      @param dest (file): an object with a write() method
+    """
+    try:
+        source.fileno()
+        size, max_size = 16*CHUNK, MAX_CHUNK
+    except (AttributeError,IOError,ValueError):
+        size = max_size = CHUNK
+    while True:
+        bytes = source.read( size )
+        if not bytes:
+            break
+        dest.write( bytes )
+        if len(bytes) == size and size < max_size:
+            size *= 2
+
+
+def link_or_copy( source, dest, mode='copy' ):
+    """
+    Place a copy of a local file into another name. Any existing file with
+    that name is replaced (not overwritten, since it could be a hard link)
+      @param source (str): name of the file to copy
+      @param dest (str): name of the new file
+      @param mode (str): how to do it:
+         - 'copy': a plain copy
+         - 'hardlink': a hard link to the source file; note that any change
+           to the file will also change the source
+         - 'reflink': a copy-on-write clone, if the filesystem supports it
+         - 'auto': the same as 'reflink'
+        Whenever the method is not available, a plain copy is done
+      @return (str): the method actually used
+    """
+    if os.path.lexists( dest ):
+        os.unlink( dest )
+    if mode == 'hardlink':
+        try:
+            os.link( source, dest )
+            return 'hardlink'
+        except (OSError,AttributeError):
+            pass    # different filesystem, no support, too many links ...
+    with open(source,'rb') as src:
+        with open(dest,'wb') as dst:
+            if mode in ('reflink','auto') and fcntl is not None:
+                try:
+                    fcntl.ioctl( dst.fileno(), FICLONE, src.fileno() )
+                    return 'reflink'
+                except (IOError,OSError):
+                    pass
+            copy_stream( src, dst )
+    return 'copy'
 
 
 # ---------------------------------------------------------------------
@@ -53,32 +138,84 @@ class LocalTransport( BaseWTransport ):
         self._basedir = os.path.join(basedir,subrepo)
         super(LocalTransport,self).__init__()
 
+    def local_path( self, name ):
+        """Return the name of a repository file in the local filesystem"""
+        return os.path.join( self._basedir, name )
+
     def init_base( self ):
         """Ensure the base path for the repository exists"""
         mkpath_recursive( self._basedir )
         
 
-    def get( self, sourcename, dest ):
+    def get( self, sourcename, dest, offset=0 ):
         """
         Read a file into a file-like destination.
         @param sourcename (str): name of the file in remote repo
         @param dest (file): an object with a write() method
+        @param offset (int): start position within the file
         @return (bool): \c True if ok, \c False if the file does not exist
         """
         name = os.path.join(self._basedir,sourcename)
         try:
             with open(name, 'rb') as f:
-                while True:
-                    bytes = f.read( CHUNK )
-                    if not bytes:
-                        break
-                    dest.write( bytes )
+                if offset:
+                    f.seek( offset )
+                copy_stream( f, dest )
             return True
         except IOError as e:
             if e.errno == errno.ENOENT:
                 return False
             raise
         
+    def get_range( self, sourcename, dest, offset, size ):
+        """
+        Read a part of a file into a file-like destination
+        @param offset (int): start position within the file
+        @param size (int): number of bytes to read (less if the file ends)
+        @return (bool): \c True if ok, \c False if the file does not exist
+        """
+        name = os.path.join(self._basedir,sourcename)
+        try:
+            with open(name, 'rb') as f:
+                f.seek( offset )
+                dest.write( f.read(size) )
+            return True
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+    def get_if_exists( self, sourcename, dest, offset=0 ):
+        """
+        Read a file into a file-like destination, if it exists.
+        Our get() already does it in a single operation
+        """
+        return self.get( sourcename, dest, offset )
+
+    def get_if_modified( self, sourcename, dest, validator=None ):
+        """
+        Read a file into a file-like destination, unless its modification
+        time, size & inode are the ones in the validator
+          @return (tuple): \c (status,validator), where status is \c True
+            if the file was read, \c False if it does not exist, or \c None
+            if it has not been modified (and then nothing has been written)
+        """
+        name = os.path.join(self._basedir,sourcename)
+        try:
+            f = open(name, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False, None
+            raise
+        with f:
+            st = os.fstat( f.fileno() )
+            current = { 'stat' : '%r %d %d' % (st.st_mtime, st.st_size,
+                                               st.st_ino) }
+            if current == validator:
+                return None, validator
+            copy_stream( f, dest )
+        return True, current
+
     def otype( self, path ):
         """
         Given the path of am object, return:
@@ -104,11 +241,7 @@ class LocalTransport( BaseWTransport ):
         """
         name = os.path.join(self._basedir,destname)
         with open(name, 'wb') as f:
-            while True:
-                bytes = source.read( CHUNK )
-                if not bytes:
-                    break
-                f.write( bytes )
+            copy_stream( source, f )
 
     def delete( self, filename ):
         """
@@ -101,9 +101,16 @@ class SMBTransport( BaseWTransport ):
         """Ensure the base path for the repository exists"""
         pass
 
-    def get( self, sourcename, dest ):
+    def get( self, sourcename, dest, offset=0 ):
         path = os.path.join( self.cdata['path'], sourcename )
-        self.conn.retrieveFile( self.cdata['share'], path, dest )
+        self.conn.retrieveFileFromOffset( self.cdata['share'], path, dest,
+                                          offset )
+
+    def get_range( self, sourcename, dest, offset, size ):
+        path = os.path.join( self.cdata['path'], sourcename )
+        self.conn.retrieveFileFromOffset( self.cdata['share'], path, dest,
+                                          offset, size )
+        return True
 
     def put( self, source, destname ):
         pass
@@ -1,5 +1,6 @@
 
 import datetime
+import os
 
 import unittest
 import pprint
@@ -46,6 +47,50 @@ class TestBasic( unittest.TestCase ):
         self.assertEquals( 0, r, "re-upload, no new" )   # no new artifacts
 
 
+    def test03_failed_upload(self):
+        """A failed object upload does not publish the branch"""
+        put = self.mgr.writer.put
+        def failing_put( source, destname ):
+            if destname.startswith( ('objects/','tmp/') ):
+                raise IOError( 'simulated failure' )
+            put( source, destname )
+        self.mgr.writer.put = failing_put
+        self.assertRaises( IOError, self.mgr.upload_artifacts,
+                           self.args.project_dir, BRANCH_NAME )
+        self.assertEquals( 0, len(self.mgr.remote_index), "index unchanged" )
+        refs = os.path.join( self.server.dir, REPO_NAME, 'refs', BRANCH_NAME )
+        self.assertFalse( os.path.exists(refs), "branch not written" )
+
+        tmp = os.path.join( self.server.dir, REPO_NAME, 'tmp' )
+        self.assertEquals( [], os.listdir(tmp), "no temporary uploads" )
+
+
+    def test04_single_read(self):
+        """New artifacts are hashed while being uploaded"""
+        hashed = []
+        orig = am_mod.sha1_file
+        def counting_sha1( size, name ):
+            hashed.append( name )
+            return orig( size, name )
+        am_mod.sha1_file = counting_sha1
+        try:
+            r = self.mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+            self.assertEquals( 2, r, "uploaded" )
+            self.assertEquals( 0, len(hashed), "not hashed separately" )
+            # Unchanged files already in the index are just hashed
+            mgr = am_mod.ArtifactManager( self.args )
+            r = mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME, True )
+            self.assertEquals( 0, r, "no new artifacts" )
+            self.assertEquals( 2, len(hashed), "hashed" )
+        finally:
+            am_mod.sha1_file = orig
+        tmp = os.path.join( self.server.dir, REPO_NAME, 'tmp' )
+        self.assertEquals( [], os.listdir(tmp), "no temporary uploads" )
+        l = self.mgr.local_print_changes( self.args.project_dir,
+                                          BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in local']), "no changes" )
+
+
     def test10_download_nobranch(self):
         """Download artifacts - no branch"""
         r = self.mgr.download_artifacts( BRANCH_NAME, self.args.project_dir )
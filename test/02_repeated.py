@@ -4,6 +4,8 @@ Test the Artifact management when there are repeated artifacts
 """
 
 import datetime
+import os
+import shutil
 
 import unittest
 import pprint
@@ -51,6 +53,65 @@ class TestRepeatedArtifact( unittest.TestCase ):
                                           BRANCH_NAME, False )
         self.assertEquals( 0, len(l['only in local']), "no changes after upload" )
 
+    def test03_parallel_hashing(self):
+        """Parallel & serial hashing give the same local lists"""
+        self.mgr.jobs = 1
+        self.mgr._local_collect_list( self.args.project_dir )
+        serial = ( self.mgr.local_index, self.mgr.local_artifacts )
+        self.mgr._reset_lists()
+        self.mgr.jobs = 4
+        self.mgr._local_collect_list( self.args.project_dir )
+        self.assertEquals( serial[0], self.mgr.local_index, "same index" )
+        self.assertEquals( serial[1], self.mgr.local_artifacts, "same lists" )
+        self.assertEquals( 2, len(serial[0]), "repeated artifact" )
+
+
+    def test04_parallel_download(self):
+        """Download all artifacts in parallel into a missing folder"""
+        self.mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        self.mgr._reset_lists()
+        self.mgr.jobs = 4
+        r = self.mgr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertEquals( 3, r, "downloaded files" )
+        self.mgr._reset_lists()
+        l = self.mgr.local_print_changes( self.args.project_dir,
+                                          BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in local']), "no changes" )
+        self.assertEquals( 0, len(l['only in server']), "no changes" )
+
+
+    def test05_three_copies(self):
+        """Artifacts repeated more than twice keep all their paths"""
+        project = TmpProject( repeat=3 )
+        try:
+            self.args.project_dir = project.dir
+            self.mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+            rdr = am_mod.ArtifactReader( self.args )
+            paths = sorted( sorted(v) for v in
+                            rdr.get_branch(BRANCH_NAME).itervalues() )
+            self.assertEquals( [ ['dir1/artifactA%d.zip' % n
+                                  for n in range(3)],
+                                 ['dir1/artifactB.zip'] ], paths, "paths" )
+        finally:
+            project.delete()
+
+
+    def test06_get(self):
+        """Get single files, whether they are repeated or not"""
+        self.mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        rdr = am_mod.ArtifactReader( self.args )
+        outname = os.path.join( self.project.dir, 'out.zip' )
+        for name in ('dir1/artifactA1.zip','dir1/artifactB.zip'):
+            self.assertTrue( rdr.get(name,BRANCH_NAME,outname), name )
+            with open(os.path.join(self.project.dir,name),'rb') as f1:
+                with open(outname,'rb') as f2:
+                    self.assertEquals( f1.read(), f2.read(), "contents" )
+            os.unlink( outname )
+        self.assertFalse( rdr.get('dir1/missing.zip',BRANCH_NAME,outname),
+                          "missing file" )
+
+
     def test02_move(self):
         """Test diff when moving an artifact"""
         # Upload
@@ -0,0 +1,149 @@
+"""
+Test the persistent cache of local artifact hashes
+"""
+
+import os
+import time
+import shutil
+import tempfile
+
+import unittest
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+
+
+# --------------------------------------------------------------------
+
+class TestHashCache( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server, a project and a cache folder
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject()
+        self.cachedir = tempfile.mkdtemp()
+        self.args = am_args_defaults( self.server, self.project )
+        self.args.cache_dir = self.cachedir
+        # Make all artifacts old enough to be cached
+        old = time.time() - 3600
+        for f in self.artifacts():
+            os.utime( f, (old,old) )
+        self.mgr = am_mod.ArtifactManager( self.args )
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+        shutil.rmtree( self.cachedir )
+
+    def artifacts(self):
+        d = os.path.join( self.project.dir, 'dir1' )
+        return [ os.path.join(d,f) for f in sorted(os.listdir(d)) ]
+
+    def collect(self):
+        """Collect the local artifacts, counting the number of hashed files"""
+        hashed = []
+        orig = am_mod.sha1_file
+        def counting_sha1( size, name ):
+            hashed.append( name )
+            return orig( size, name )
+        am_mod.sha1_file = counting_sha1
+        try:
+            self.mgr._reset_lists()
+            self.mgr._local_collect_list( self.args.project_dir )
+        finally:
+            am_mod.sha1_file = orig
+        return hashed
+
+
+    def test01_cached(self):
+        """A second scan does not hash again"""
+        self.assertEquals( 2, len(self.collect()), "first scan" )
+        first = dict( self.mgr.local_artifacts )
+        self.assertEquals( 0, len(self.collect()), "second scan" )
+        self.assertEquals( first, dict(self.mgr.local_artifacts), "same hashes" )
+
+
+    def test02_modified(self):
+        """A modified file is hashed again"""
+        self.collect()
+        name = self.artifacts()[0]
+        with open(name,'ab') as f:
+            f.write( 'more data' )
+        old = time.time() - 1800
+        os.utime( name, (old,old) )
+        self.assertEquals( 1, len(self.collect()), "changed file" )
+        self.assertEquals( 2, len(self.mgr.local_artifacts), "artifacts" )
+
+
+    def test03_recent(self):
+        """Files modified right now are not cached"""
+        name = self.artifacts()[0]
+        os.utime( name, None )
+        self.collect()
+        self.assertEquals( [name.split(self.project.dir)[1][1:]],
+                           [os.path.normpath(n) for n in self.collect()],
+                           "recent file hashed again" )
+
+
+    def test04_upload(self):
+        """Uploads work with cached hashes"""
+        self.collect()
+        self.mgr = am_mod.ArtifactManager( self.args )
+        r = self.mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        self.assertEquals( 2, r, "uploaded" )
+        l = self.mgr.local_print_changes( self.args.project_dir,
+                                          BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in local']), "no changes" )
+
+
+    def test05_download(self):
+        """Downloaded files are verified and need no hashing afterwards"""
+        self.mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        self.mgr = am_mod.ArtifactManager( self.args )
+        r = self.mgr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertEquals( 2, r, "downloaded" )
+        self.assertEquals( 0, len(self.collect()), "no hashing" )
+        self.assertEquals( 2, len(self.mgr.local_artifacts), "artifacts" )
+
+
+    def test06_download_copied(self):
+        """Files copied from a local repository are not trusted"""
+        self.mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        self.args.link_mode = 'reflink'
+        self.mgr = am_mod.ArtifactManager( self.args )
+        del self.args.link_mode
+        r = self.mgr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertEquals( 2, r, "downloaded" )
+        self.assertEquals( 2, len(self.collect()), "hashed" )
+
+
+    def test07_unwritable(self):
+        """A cache that cannot be written is dropped, not an error"""
+        name = am_mod.HashCache( self.cachedir, self.args.project_dir )._name
+        os.makedirs( os.path.join(name,'blocker') )
+        self.assertEquals( 2, len(self.collect()), "first scan" )
+        self.assertIsNone( self.mgr.hash_cache, "cache dropped" )
+        self.assertEquals( ['blocker'], os.listdir(name), "no temporary file" )
+        self.assertEquals( 2, len(self.collect()), "second scan" )
+
+
+    def test08_newline(self):
+        """Files with a line break in their names are not cached"""
+        name = os.path.join( self.project.dir, 'dir1', 'new\nline.zip' )
+        shutil.copy( self.artifacts()[0], name )
+        old = time.time() - 3600
+        os.utime( name, (old,old) )
+        self.assertEquals( 3, len(self.collect()), "first scan" )
+        self.mgr = am_mod.ArtifactManager( self.args )
+        self.assertEquals( 1, len(self.collect()), "second scan" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
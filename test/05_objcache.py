@@ -0,0 +1,98 @@
+"""
+Test the shared local object cache
+"""
+
+import os
+import time
+import shutil
+import tempfile
+
+import unittest
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+
+
+# --------------------------------------------------------------------
+
+class TestObjectCache( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server and upload a project to it
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject()
+        self.args = am_args_defaults( self.server, self.project )
+        self.mgr = am_mod.ArtifactManager( self.args )
+        self.mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        # Prepare a reader using an object cache
+        self.cachedir = tempfile.mkdtemp()
+        self.args.cache_dir = self.cachedir
+        self.args.cache_size = 1
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+        shutil.rmtree( self.cachedir )
+
+    def download(self):
+        """Remove all local artifacts and download them again"""
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        rdr = am_mod.ArtifactReader( self.args )
+        return rdr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+
+    def cached(self):
+        """Return the list of objects in the cache"""
+        d = os.path.join( self.cachedir, 'objects' )
+        return sorted( p + f for p in os.listdir(d)
+                       for f in os.listdir(os.path.join(d,p)) )
+
+
+    def test01_fill(self):
+        """Downloads fill the cache"""
+        self.assertEquals( 2, self.download(), "downloaded" )
+        self.assertEquals( sorted(self.mgr.remote_index.keys()),
+                           self.cached(), "cached objects" )
+
+
+    def test02_serve(self):
+        """Downloads are served from the cache"""
+        self.download()
+        # Take the objects out of the server
+        shutil.rmtree( os.path.join(self.server.dir,REPO_NAME,'objects') )
+        self.assertEquals( 2, self.download(), "downloaded from cache" )
+        rdr = am_mod.ArtifactReader( self.args )
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in server']), "all downloaded" )
+
+
+    def test03_get(self):
+        """Fetching a single file goes also through the cache"""
+        rdr = am_mod.ArtifactReader( self.args )
+        name = os.path.join( self.project.dir, 'single.zip' )
+        self.assertTrue( rdr.get('dir1/artifactB.zip',BRANCH_NAME,name), "get" )
+        self.assertTrue( os.path.exists(name), "file fetched" )
+        self.assertEquals( 1, len(self.cached()), "cached objects" )
+
+
+    def test04_evict(self):
+        """The least recently used objects are evicted"""
+        self.download()
+        cache = am_mod.ObjectCache( self.cachedir, 1024*1024 )
+        objects = self.cached()
+        # Make the first object older, & reduce the cache size to one object
+        old = time.time() - 60
+        os.utime( cache.path(objects[0]), (old,old) )
+        size = os.path.getsize( cache.path(objects[1]) )
+        cache = am_mod.ObjectCache( self.cachedir,
+                                    int(size/am_mod.OBJECT_CACHE_TRIM) + 1 )
+        cache.trim()
+        self.assertEquals( objects[1:], self.cached(), "evicted oldest" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Test the different ways of placing downloaded artifacts in the project
+"""
+
+import os
+import shutil
+import tempfile
+
+import unittest
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+
+
+# --------------------------------------------------------------------
+
+class TestLinkMode( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server and upload a project to it
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject()
+        self.args = am_args_defaults( self.server, self.project )
+        self.mgr = am_mod.ArtifactManager( self.args )
+        self.mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+        shutil.rmtree( self.cachedir )
+
+    def download(self, mode):
+        """Remove all local artifacts and download them again"""
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        self.args.link_mode = mode
+        rdr = am_mod.ArtifactReader( self.args )
+        r = rdr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertEquals( 2, r, "downloaded" )
+        rdr._reset_lists()
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in server']), "all downloaded" )
+        self.assertEquals( 0, len(l['only in local']), "no changes" )
+        return rdr
+
+    def same_file(self, rdr, source):
+        """Check if the downloaded artifacts are the same files as the source"""
+        name = 'dir1/artifactB.zip'
+        sha = [ k for k,v in rdr.local_artifacts.iteritems() if name in v ][0]
+        return os.path.samefile( source(sha),
+                                 os.path.join(self.project.dir,name) )
+
+
+    def test01_hardlink(self):
+        """Hard links to a local repository"""
+        objects = os.path.join( self.server.dir, REPO_NAME, 'objects' )
+        mtimes = dict( (os.path.join(d,f), os.stat(os.path.join(d,f)).st_mtime)
+                       for d, _, files in os.walk(objects) for f in files )
+        rdr = self.download( 'hardlink' )
+        self.assertTrue( self.same_file(rdr,
+              lambda k : rdr.reader.local_path('objects/%s/%s' % (k[:2],k[2:]))),
+                         "linked" )
+        for name, mtime in mtimes.iteritems():
+            self.assertEquals( mtime, os.stat(name).st_mtime, "object untouched" )
+
+
+    def test02_hardlink_cache(self):
+        """No hard links are made to the object cache"""
+        self.args.cache_dir = self.cachedir
+        self.args.cache_size = 1
+        self.download( 'hardlink' )
+        rdr = self.download( 'hardlink' )
+        self.assertFalse( self.same_file(rdr,rdr.object_cache.path),
+                          "not linked" )
+        # Modifying the artifact in place does not corrupt the cache
+        with open(os.path.join(self.project.dir,'dir1','artifactB.zip'),
+                  'r+b') as f:
+            f.write( 'changed' )
+        self.download( 'hardlink' )
+
+
+    def test03_copy_over_link(self):
+        """Downloading over a hard-linked file does not touch its source"""
+        rdr = self.download( 'hardlink' )
+        source = lambda k : rdr.reader.local_path('objects/%s/%s' % (k[:2],k[2:]))
+        name = os.path.join( self.project.dir, 'dir1', 'artifactB.zip' )
+        sha = [ k for k,v in rdr.local_artifacts.iteritems()
+                if 'dir1/artifactB.zip' in v ][0]
+        rdr.link_mode = 'copy'
+        rdr._get_file( sha, name )
+        self.assertFalse( self.same_file(rdr,source), "copied" )
+        with open(source(sha),'rb') as f1:
+            with open(name,'rb') as f2:
+                self.assertEquals( f1.read(), f2.read(), "same contents" )
+
+
+    def test04_auto(self):
+        """Automatic mode works in any filesystem"""
+        rdr = self.download( 'auto' )
+        self.assertFalse( self.same_file(rdr,
+              lambda k : rdr.reader.local_path('objects/%s/%s' % (k[:2],k[2:]))),
+                          "not linked" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+"""
+Test the binary format for the repository index
+"""
+
+import os
+import shutil
+import hashlib
+from ConfigParser import SafeConfigParser
+
+import unittest
+
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+from testaux.httpserver import TmpHttpServer
+
+
+# --------------------------------------------------------------------
+
+class TestBinaryIndex( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server and a project, and upload the project
+        # in a repository using a binary index
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject( repeat=2 )
+        self.args = am_args_defaults( self.server, self.project )
+        self.args.index_format = 'binary'
+        mgr = am_mod.ArtifactManager( self.args )
+        del self.args.index_format
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+
+    def repo_file(self, name):
+        return os.path.join( self.server.dir, REPO_NAME, name )
+
+
+    def test01_roundtrip(self):
+        """Write a binary index and look up all its entries"""
+        index = dict( (hashlib.sha1(str(n)).hexdigest(),
+                       [1400000000.5+n, n*100, 0644, 'dir/file%d.zip' % n])
+                      for n in range(1000) )
+        buffer = StringIO.StringIO()
+        am_mod.write_binary_index( index.iteritems(), buffer )
+        data = buffer.getvalue()
+        read = lambda offset, size : data[offset:] if size is None \
+               else data[offset:offset+size]
+        for remote in (False,True):
+            b = am_mod.BinaryIndex( read, remote )
+            for k, v in index.iteritems():
+                self.assertEquals( v, b[k], "entry" )
+            self.assertFalse( hashlib.sha1('x').hexdigest() in b, "missing" )
+            self.assertFalse( 'notasha' in b, "invalid" )
+            self.assertEquals( index, dict(b.iteritems()), "all entries" )
+
+
+    def test02_local(self):
+        """Use a binary index from a local folder"""
+        self.assertFalse( os.path.exists(self.repo_file('index')), "no text" )
+        cfg = SafeConfigParser()
+        cfg.read( self.repo_file('options') )
+        self.assertEquals( '4', cfg.get('general','version'), "version" )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertTrue( isinstance(rdr.remote_index,am_mod.BinaryIndex),
+                         "binary index" )
+        self.assertEquals( 2, len(rdr.get_branch(BRANCH_NAME)), "branch" )
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        r = rdr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertEquals( 3, r, "downloaded" )
+        rdr._reset_lists()
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in server']), "no changes" )
+        self.assertEquals( 0, len(l['only in local']), "no changes" )
+
+
+    def test03_upload(self):
+        """New objects are added to a binary index"""
+        self.project.moveArtifact( change_name=True )
+        with open(os.path.join(self.project.dir,'dir1','new.zip'),'w') as f:
+            f.write( 'new artifact' )
+        mgr = am_mod.ArtifactManager( self.args )
+        r = mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME+'2' )
+        self.assertEquals( 1, r, "uploaded" )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( 3, len(rdr.remote_index), "index" )
+        self.assertEquals( 3, len(rdr.get_branch(BRANCH_NAME+'2')), "branch" )
+
+
+    def test04_convert(self):
+        """Convert a text index into binary, and back"""
+        self.args.index_format = 'text'
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.put_cfg()
+        del self.args.index_format
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertTrue( isinstance(rdr.remote_index,dict), "text index" )
+        text = rdr.remote_index
+        self.args.index_format = 'binary'
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.put_cfg()
+        del self.args.index_format
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertTrue( isinstance(rdr.remote_index,am_mod.BinaryIndex),
+                         "binary index" )
+        self.assertEquals( text, dict(rdr.remote_index.iteritems()), "same" )
+
+
+    def test05_http(self):
+        """Lookups over HTTP read only parts of a binary index"""
+        http = TmpHttpServer( self.server.dir )
+        try:
+            self.args.server_url = http.url
+            rdr = am_mod.ArtifactReader( self.args )
+            outname = os.path.join( self.project.dir, 'out.zip' )
+            self.assertTrue( rdr.get('dir1/artifactB.zip',BRANCH_NAME,outname),
+                             "get" )
+            self.assertTrue( os.path.exists(outname), "downloaded" )
+            reqs = [ r[2] for r in http.requests if r[1].endswith('index.bin') ]
+            self.assertEquals( [206]*3, reqs, "range requests" )
+        finally:
+            http.delete()
+
+
+    def test06_remote_reads(self):
+        """Remote lookups read each part of the index once, not per entry"""
+        index = dict( (hashlib.sha1(str(n)).hexdigest(),
+                       [1400000000.5+n, n*100, 0644, 'dir/file%d.zip' % n])
+                      for n in range(1000) )
+        buffer = StringIO.StringIO()
+        am_mod.write_binary_index( index.iteritems(), buffer )
+        data = buffer.getvalue()
+        blocks = len( set(k[:2] for k in index) )
+        reads = []
+        def read( offset, size ):
+            reads.append( offset )
+            return data[offset:offset+size]
+        b = am_mod.BinaryIndex( read, True )
+        for k, v in index.iteritems():
+            self.assertEquals( v, b[k], "entry" )
+        self.assertEquals( 1 + 2*blocks, len(reads), "records & paths" )
+        # Prefetching reads everything needed beforehand
+        del reads[:]
+        b = am_mod.BinaryIndex( read, True, jobs=4 )
+        b.prefetch( index )
+        self.assertEquals( 1 + 2*blocks, len(reads), "prefetched" )
+        for k, v in index.iteritems():
+            self.assertEquals( v, b[k], "entry" )
+        self.assertEquals( 1 + 2*blocks, len(reads), "no more reads" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
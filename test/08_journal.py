@@ -0,0 +1,121 @@
+"""
+Test the index journal
+"""
+
+import os
+
+import unittest
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+
+
+# --------------------------------------------------------------------
+
+class TestJournal( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server and a project, and a repository that
+        # uses an index journal
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject()
+        self.args = am_args_defaults( self.server, self.project )
+        self.args.journal_size = 3
+        am_mod.ArtifactManager( self.args )
+        del self.args.journal_size
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+
+    def repo_lines(self, name):
+        """Get the lines in a repository file, or None if not there"""
+        name = os.path.join( self.server.dir, REPO_NAME, name )
+        if not os.path.exists( name ):
+            return None
+        with open(name) as f:
+            return f.read().splitlines()
+
+    def add_artifacts(self, num):
+        for n in range(num):
+            name = os.path.join( self.project.dir, 'dir2', 'new%d.zip' % n )
+            with open(name,'w') as f:
+                f.write( 'new artifact %d' % n )
+
+    def upload(self, branch=BRANCH_NAME):
+        mgr = am_mod.ArtifactManager( self.args )
+        return mgr.upload_artifacts( self.args.project_dir, branch )
+
+
+    def test01_append(self):
+        """Uploads append to the journal, not to the index"""
+        self.assertEquals( 2, self.upload(), "uploaded" )
+        self.assertEquals( [], self.repo_lines('index'), "index" )
+        self.assertEquals( 2, len(self.repo_lines('index.journal')), "journal" )
+        self.add_artifacts( 1 )
+        self.assertEquals( 1, self.upload(BRANCH_NAME+'2'), "uploaded" )
+        self.assertEquals( 3, len(self.repo_lines('index.journal')), "journal" )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( 3, len(rdr.remote_index), "index + journal" )
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME+'2',
+                                     False )
+        self.assertEquals( 0, len(l['only in local']), "no changes" )
+
+
+    def test02_auto_compact(self):
+        """The journal is merged into the index when it grows too large"""
+        self.upload()
+        self.add_artifacts( 2 )
+        self.assertEquals( 2, self.upload(BRANCH_NAME+'2'), "uploaded" )
+        self.assertEquals( 4, len(self.repo_lines('index')), "index" )
+        self.assertEquals( None, self.repo_lines('index.journal'), "journal" )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( 4, len(rdr.remote_index), "index" )
+
+
+    def test03_compact(self):
+        """Explicit compaction"""
+        self.upload()
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.compact_index()
+        self.assertEquals( 2, len(self.repo_lines('index')), "index" )
+        self.assertEquals( None, self.repo_lines('index.journal'), "journal" )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( mgr.remote_index, rdr.remote_index, "same index" )
+
+
+    def test04_binary(self):
+        """A journal on top of a binary index"""
+        self.args.index_format = 'binary'
+        am_mod.ArtifactManager( self.args ).put_cfg()
+        del self.args.index_format
+        self.upload()
+        self.assertEquals( 2, len(self.repo_lines('index.journal')), "journal" )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( 2, len(rdr.remote_index), "index" )
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in local']), "no changes" )
+
+
+    def test05_options(self):
+        """Changing other options does not compact the index"""
+        self.upload()
+        self.args.compression = 'zlib'
+        am_mod.ArtifactManager( self.args ).put_cfg()
+        del self.args.compression
+        self.assertEquals( [], self.repo_lines('index'), "index" )
+        self.assertEquals( 2, len(self.repo_lines('index.journal')), "journal" )
+        self.args.journal_size = 0
+        am_mod.ArtifactManager( self.args ).put_cfg()
+        del self.args.journal_size
+        self.assertEquals( 2, len(self.repo_lines('index')), "index" )
+        self.assertEquals( None, self.repo_lines('index.journal'), "journal" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
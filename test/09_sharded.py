@@ -0,0 +1,152 @@
+"""
+Test the sharded format for the repository index
+"""
+
+import os
+import shutil
+import threading
+
+import unittest
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+from testaux.httpserver import TmpHttpServer
+
+
+# --------------------------------------------------------------------
+
+class TestShardedIndex( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server and a project, and upload the project
+        # in a repository using a sharded index
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject( repeat=2 )
+        self.args = am_args_defaults( self.server, self.project )
+        self.args.index_format = 'sharded'
+        mgr = am_mod.ArtifactManager( self.args )
+        del self.args.index_format
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        self.shas = sorted( mgr.local_index )
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+
+    def shards(self):
+        return sorted( os.listdir(os.path.join(self.server.dir,REPO_NAME,
+                                               'index.d')) )
+
+
+    def test01_layout(self):
+        """Each object goes into the shard for its first SHA1 byte"""
+        self.assertEquals( sorted(set(s[:2] for s in self.shas)),
+                           self.shards(), "shards" )
+        self.assertFalse( os.path.exists(os.path.join(self.server.dir,
+                                                      REPO_NAME,'index')),
+                          "no text index" )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertTrue( isinstance(rdr.remote_index,am_mod.ShardedIndex),
+                         "sharded index" )
+        self.assertEquals( self.shas, sorted(rdr.remote_index), "entries" )
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in local']), "no changes" )
+
+
+    def test02_modified_shards(self):
+        """Only modified shards are written"""
+        with open(os.path.join(self.project.dir,'dir2','new.zip'),'w') as f:
+            f.write( 'new artifact' )
+        mgr = am_mod.ArtifactManager( self.args )
+        written = []
+        update = mgr.writer.update
+        def recording_update( source, destname ):
+            written.append( destname )
+            update( source, destname )
+        mgr.writer.update = recording_update
+        r = mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME, True )
+        self.assertEquals( 1, r, "uploaded" )
+        new = [ k for k in mgr.local_index if k not in self.shas ][0]
+        self.assertEquals( ['index.d/'+new[:2]],
+                           [ w for w in written if w.startswith('index') ],
+                           "shards written" )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( 3, len(rdr.remote_index), "entries" )
+
+
+    def test03_http(self):
+        """Only the shards needed are fetched"""
+        http = TmpHttpServer( self.server.dir )
+        try:
+            self.args.server_url = http.url
+            rdr = am_mod.ArtifactReader( self.args )
+            outname = os.path.join( self.project.dir, 'out.zip' )
+            self.assertTrue( rdr.get('dir1/artifactB.zip',BRANCH_NAME,outname),
+                             "get" )
+            reqs = [ r[1] for r in http.requests if '/index.d/' in r[1] ]
+            self.assertEquals( 1, len(reqs), "shards fetched" )
+        finally:
+            http.delete()
+
+
+    def test04_convert(self):
+        """Convert a sharded index into text, and back"""
+        self.args.index_format = 'text'
+        am_mod.ArtifactManager( self.args ).put_cfg()
+        del self.args.index_format
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertTrue( isinstance(rdr.remote_index,dict), "text index" )
+        text = rdr.remote_index
+        self.assertEquals( self.shas, sorted(text), "entries" )
+        self.args.index_format = 'sharded'
+        am_mod.ArtifactManager( self.args ).put_cfg()
+        del self.args.index_format
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( text, dict(rdr.remote_index.iteritems()), "same" )
+
+
+    def test05_prefetch(self):
+        """Shards needed for a branch are fetched at once, in parallel"""
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        rdr = am_mod.ArtifactReader( self.args )
+        fetched = []
+        fetch = rdr.remote_index._fetch
+        def recording_fetch( prefix ):
+            fetched.append( (prefix,threading.current_thread().name) )
+            return fetch( prefix )
+        rdr.remote_index._fetch = recording_fetch
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME, False )
+        self.assertEquals( 3, len(l['only in server']), "remote only" )
+        self.assertEquals( self.shards(), sorted(f[0] for f in fetched),
+                           "each shard fetched once" )
+        if len(fetched) > 1:
+            self.assertFalse( threading.current_thread().name in
+                              [ f[1] for f in fetched ], "in parallel" )
+
+
+    def test06_prefetch_upload(self):
+        """Shards needed for an upload are fetched at once, in parallel"""
+        with open(os.path.join(self.project.dir,'dir2','new.zip'),'w') as f:
+            f.write( 'new artifact' )
+        mgr = am_mod.ArtifactManager( self.args )
+        fetched = []
+        fetch = mgr.remote_index._fetch
+        def recording_fetch( prefix ):
+            fetched.append( (prefix,threading.current_thread().name) )
+            return fetch( prefix )
+        mgr.remote_index._fetch = recording_fetch
+        r = mgr.upload_artifacts( self.args.project_dir, 'branch2' )
+        self.assertEquals( 1, r, "uploaded" )
+        self.assertEquals( len(fetched), len(set(f[0] for f in fetched)),
+                           "each shard fetched once" )
+        self.assertFalse( threading.current_thread().name in
+                          [ f[1] for f in fetched ], "in parallel" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
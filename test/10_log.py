@@ -2,7 +2,9 @@
 Test log creation and retrieval for the Artifact server
 """
 
+import os
 import datetime
+import StringIO
 
 import unittest
 import pprint
@@ -11,6 +13,7 @@ from testaux import REPO_NAME, BRANCH_NAME
 from testaux.am import am_mod, am_args_defaults
 from testaux.server import TmpServer
 from testaux.project import TmpProject
+from testaux.httpserver import TmpHttpServer
 
 
 # --------------------------------------------------------------------
@@ -56,6 +59,103 @@ class TestLog( unittest.TestCase ):
         self.assertEqual( '', msg, "empty log message" )
 
 
+    def upgrade(self):
+        """Move the repository to the version that keeps a log store"""
+        self.args.version = am_mod.LOG_STORE_VERSION
+        self.mgr = am_mod.ArtifactManager( self.args )
+        del self.args.version
+        self.mgr.put_cfg()
+
+    def add_branches(self):
+        """Create a few more branches, with log messages for some of them"""
+        logs = { BRANCH_NAME : '' }
+        for n in range(4):
+            branch = 'branch%d' % n
+            self.mgr.upload_artifacts( self.args.project_dir, branch )
+            logs[branch] = 'Log for\nbranch %d' % n if n % 2 else ''
+            if logs[branch]:
+                self.mgr.put_log( branch, logs[branch] )
+        return logs
+
+    def test03_log_store(self):
+        """All logs are read at once from the log store"""
+        self.upgrade()
+        logs = self.add_branches()
+        self.mgr.rename_branch( 'branch1', 'branch1b' )
+        logs['branch1b'] = logs.pop( 'branch1' )
+        http = TmpHttpServer( self.server.dir )
+        try:
+            self.args.server_url = http.url
+            rdr = am_mod.ArtifactReader( self.args )
+            self.assertEqual( logs, rdr._get_all_branches(True), "logs" )
+            self.assertEqual( [], [ r[1] for r in http.requests
+                                    if '/logs/' in r[1] ], "single logs" )
+        finally:
+            http.delete()
+
+
+    def test04_log_store_migration(self):
+        """Repositories without a log store get one on the next log change"""
+        self.upgrade()
+        logs = self.add_branches()
+        os.unlink( os.path.join(self.server.dir,REPO_NAME,'logs.store') )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEqual( logs, rdr._get_all_branches(True), "logs" )
+        self.mgr.put_log( BRANCH_NAME, 'New log' )
+        logs[BRANCH_NAME] = 'New log'
+        self.assertEqual( logs, self.mgr._get_log_store(), "log store" )
+
+
+    def test05_no_log_store(self):
+        """Repositories older versions can write to have no log store"""
+        logs = self.add_branches()
+        store = os.path.join( self.server.dir, REPO_NAME, 'logs.store' )
+        self.assertFalse( os.path.exists(store), "no log store" )
+        # A stale one is not used
+        with open(store,'w') as f:
+            f.write( repr({'branch1' : 'Old log'}) )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEqual( logs, rdr._get_all_branches(True), "logs" )
+
+
+    def test06_log_store_lost(self):
+        """Logs lost from the log store are read from their own files"""
+        self.upgrade()
+        logs = self.add_branches()
+        store = os.path.join( self.server.dir, REPO_NAME, 'logs.store' )
+        with open(store,'w') as f:
+            f.write( repr({BRANCH_NAME : ''}) )
+        http = TmpHttpServer( self.server.dir )
+        try:
+            self.args.server_url = http.url
+            rdr = am_mod.ArtifactReader( self.args )
+            self.assertEqual( logs, rdr._get_all_branches(True), "logs" )
+            fetched = [ r[1] for r in http.requests
+                        if r[0] == 'GET' and '/logs/' in r[1] ]
+            self.assertEqual( 4, len(fetched), "single logs" )
+        finally:
+            http.delete()
+
+
+    def test07_log_store_concurrent(self):
+        """Changes to the log store lost to another writer are made again"""
+        self.upgrade()
+        logs = self.add_branches()
+        update = self.mgr.writer.update
+        def concurrent_update( source, name ):
+            update( source, name )
+            if name == 'logs.store' and concurrent_update.stale:
+                # another writer replaces the store, from an older copy
+                update( concurrent_update.stale.pop(), name )
+        stale = os.path.join( self.server.dir, REPO_NAME, 'logs.store' )
+        with open(stale,'rb') as f:
+            concurrent_update.stale = [ StringIO.StringIO(f.read()) ]
+        self.mgr.writer.update = concurrent_update
+        self.mgr.put_log( 'branch0', 'New log' )
+        logs['branch0'] = 'New log'
+        self.assertEqual( logs, self.mgr._get_log_store(), "log store" )
+
+
 
 # --------------------------------------------------------------------
 
@@ -0,0 +1,129 @@
+"""
+Test compressed object storage
+"""
+
+import os
+import glob
+import shutil
+import tempfile
+
+import unittest
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+from testaux.httpserver import TmpHttpServer
+
+
+# --------------------------------------------------------------------
+
+class TestCompression( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server and a project with a compressible
+        # artifact, and a repository storing objects compressed
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject()
+        self.data = ''.join( 'line %d of a compressible artifact\n' % n
+                             for n in range(5000) )
+        self.pkl = os.path.join( self.project.dir, 'dir2', 'data.pkl' )
+        with open(self.pkl,'wb') as f:
+            f.write( self.data )
+        self.args = am_args_defaults( self.server, self.project )
+        self.args.compression = 'zlib'
+        am_mod.ArtifactManager( self.args )
+        del self.args.compression
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+
+    def objects(self):
+        """Get all objects in the repository, as name : size"""
+        names = glob.glob( os.path.join(self.server.dir,REPO_NAME,
+                                        'objects','*','*') )
+        return dict( (os.path.basename(n),os.path.getsize(n)) for n in names )
+
+    def check_download(self):
+        os.unlink( self.pkl )
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        rdr = am_mod.ArtifactReader( self.args )
+        r = rdr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertEquals( 3, r, "downloaded" )
+        with open(self.pkl,'rb') as f:
+            self.assertEquals( self.data, f.read(), "contents" )
+        rdr._reset_lists()
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in server']), "no changes" )
+
+
+    def test01_upload(self):
+        """Compressible artifacts are stored compressed, others are not"""
+        mgr = am_mod.ArtifactManager( self.args )
+        self.assertEquals( 3, mgr.upload_artifacts(self.args.project_dir,
+                                                   BRANCH_NAME), "uploaded" )
+        objects = self.objects()
+        compressed = [ n for n in objects if n.endswith('.z') ]
+        self.assertEquals( 1, len(compressed), "compressed" )
+        self.assertTrue( objects[compressed[0]] < len(self.data)/3, "size" )
+        self.assertEquals( 3, len(objects), "objects" )
+        self.check_download()
+
+
+    def test02_upload_hashed(self):
+        """Artifacts with known hashes are compressed too"""
+        self.args.cache_dir = tempfile.mkdtemp()
+        try:
+            mgr = am_mod.ArtifactManager( self.args )
+            mgr._local_collect_list( self.args.project_dir )
+            mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+            self.assertEquals( 1, len([ n for n in self.objects()
+                                        if n.endswith('.z') ]), "compressed" )
+            self.check_download()
+        finally:
+            shutil.rmtree( self.args.cache_dir )
+
+
+    def test03_mixed(self):
+        """Objects stored before enabling compression are still found"""
+        self.args.compression = 'none'
+        am_mod.ArtifactManager( self.args ).put_cfg()
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        self.args.compression = 'zlib'
+        am_mod.ArtifactManager( self.args ).put_cfg()
+        del self.args.compression
+        self.assertEquals( [], [ n for n in self.objects()
+                                 if n.endswith('.z') ], "not compressed" )
+        self.check_download()
+
+
+    def test04_http(self):
+        """Download compressed objects over HTTP"""
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        http = TmpHttpServer( self.server.dir )
+        try:
+            self.args.server_url = http.url
+            self.check_download()
+            self.assertFalse( [r for r in http.requests if r[2] == 404],
+                              "no failed requests" )
+        finally:
+            http.delete()
+
+
+    def test05_hardlink(self):
+        """Compressed objects in a local repository cannot be linked"""
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        self.args.link_mode = 'hardlink'
+        self.check_download()
+        self.assertEquals( 1, os.stat(self.pkl).st_nlink, "copied" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
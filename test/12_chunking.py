@@ -0,0 +1,182 @@
+"""
+Test chunked object storage
+"""
+
+import os
+import glob
+import random
+import shutil
+import tempfile
+
+import unittest
+
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+from testaux.httpserver import TmpHttpServer
+
+
+CHUNK_SIZE = 16384
+
+
+# --------------------------------------------------------------------
+
+class TestChunking( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server and a project with a large artifact,
+        # and a repository storing large objects in chunks
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject()
+        rnd = random.Random( 1 )
+        self.data = ''.join( chr(rnd.randint(0,255)) for n in range(400000) )
+        self.big = os.path.join( self.project.dir, 'dir2', 'big.tar' )
+        self.write_big( self.data )
+        self.args = am_args_defaults( self.server, self.project )
+        self.args.chunk_size = CHUNK_SIZE
+        am_mod.ArtifactManager( self.args )
+        del self.args.chunk_size
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+
+    def write_big(self, data):
+        with open(self.big,'wb') as f:
+            f.write( data )
+
+    def repo_files(self, folder):
+        """Get all files in a repository folder, as name : size"""
+        names = glob.glob( os.path.join(self.server.dir,REPO_NAME,
+                                        folder,'*','*') )
+        return dict( (os.path.basename(n),os.path.getsize(n)) for n in names )
+
+    def upload(self, branch=BRANCH_NAME):
+        mgr = am_mod.ArtifactManager( self.args )
+        return mgr.upload_artifacts( self.args.project_dir, branch )
+
+    def download(self, branch=BRANCH_NAME):
+        rdr = am_mod.ArtifactReader( self.args )
+        return rdr.download_artifacts( branch, self.args.project_dir, True )
+
+    def check_big(self, data):
+        with open(self.big,'rb') as f:
+            self.assertEquals( data, f.read(), "contents" )
+
+
+    def test01_upload(self):
+        """Large artifacts are stored chunked, and rebuilt on download"""
+        self.assertEquals( 3, self.upload(), "uploaded" )
+        objects = self.repo_files( 'objects' )
+        self.assertEquals( 1, len([ n for n in objects
+                                    if n.endswith('.chunks') ]), "chunked" )
+        chunks = self.repo_files( 'chunks' )
+        self.assertTrue( len(chunks) > 4, "chunks" )
+        self.assertEquals( len(self.data), sum(chunks.values()), "chunk sizes" )
+        self.assertFalse( os.listdir(os.path.join(self.server.dir,REPO_NAME,
+                                                  'tmp')), "no tmp files" )
+        os.unlink( self.big )
+        self.assertEquals( 1, self.download(), "downloaded" )
+        self.check_big( self.data )
+
+
+    def test02_upload_hashed(self):
+        """Artifacts with known hashes are chunked too"""
+        self.args.cache_dir = tempfile.mkdtemp()
+        try:
+            mgr = am_mod.ArtifactManager( self.args )
+            mgr._local_collect_list( self.args.project_dir )
+            mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+            self.assertEquals( 1, len([ n for n in self.repo_files('objects')
+                                        if n.endswith('.chunks') ]), "chunked" )
+        finally:
+            shutil.rmtree( self.args.cache_dir )
+
+
+    def test03_delta(self):
+        """A modified artifact shares most chunks with the previous one"""
+        self.upload()
+        chunks = self.repo_files( 'chunks' )
+        data2 = self.data[:200000] + 'a small change' + self.data[200000:]
+        self.write_big( data2 )
+        self.assertEquals( 1, self.upload(BRANCH_NAME+'2'), "uploaded" )
+        new = set( self.repo_files('chunks') ) - set( chunks )
+        self.assertTrue( 0 < len(new) <= 2, "new chunks" )
+        # Going back and forth between versions downloads only those chunks
+        http = TmpHttpServer( self.server.dir )
+        try:
+            self.args.server_url = http.url
+            self.assertEquals( 1, self.download(), "downloaded" )
+            self.check_big( self.data )
+            del http.requests[:]
+            self.assertEquals( 1, self.download(BRANCH_NAME+'2'), "downloaded" )
+            self.check_big( data2 )
+            reqs = [ r[1] for r in http.requests if '/chunks/' in r[1] ]
+            self.assertEquals( len(new), len(reqs), "chunks downloaded" )
+        finally:
+            http.delete()
+
+
+    def test04_small(self):
+        """Small artifacts are not chunked, and chunking can be disabled"""
+        self.args.chunk_size = 0
+        am_mod.ArtifactManager( self.args ).put_cfg()
+        self.upload()
+        self.assertEquals( [], [ n for n in self.repo_files('objects')
+                                 if n.endswith('.chunks') ], "not chunked" )
+        self.args.chunk_size = CHUNK_SIZE
+        self.write_big( self.data[::-1] )
+        self.upload( BRANCH_NAME+'2' )
+        del self.args.chunk_size
+        objects = self.repo_files( 'objects' )
+        self.assertEquals( 1, len([ n for n in objects
+                                    if n.endswith('.chunks') ]), "chunked" )
+        self.assertEquals( 4, len(objects), "small objects not chunked" )
+        self.download()
+        self.check_big( self.data )
+
+
+    def test05_text(self):
+        """Text is split by its contents, not at fixed sizes"""
+        rnd = random.Random( 2 )
+        data = ''.join( "INSERT INTO t VALUES (%d, 'name%d', %d);\n" %
+                        (n, rnd.randint(0,1000), rnd.randint(0,9))
+                        for n in range(20000) )
+        chunker = am_mod.Chunker( CHUNK_SIZE )
+        chunks = list( chunker.split(StringIO.StringIO(data)) )
+        self.assertEquals( data, ''.join(chunks), "same data" )
+        self.assertTrue( len(chunks) > len(data) // chunker.max_size + 1,
+                         "content-defined" )
+        data2 = data[:300000] + 'a small change' + data[300000:]
+        new = set( chunker.split(StringIO.StringIO(data2)) ) - set( chunks )
+        self.assertTrue( 0 < len(new) <= 2, "new chunks" )
+
+
+    def test06_unchanged(self):
+        """Chunks of artifacts already stored are not checked again"""
+        self.upload()
+        self.write_big( self.data )
+        mgr = am_mod.ArtifactManager( self.args )
+        checked = []
+        exists = mgr.writer.exists
+        def recording_exists( name ):
+            checked.append( name )
+            return exists( name )
+        mgr.writer.exists = recording_exists
+        r = mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME+'2' )
+        self.assertEquals( 0, r, "uploaded" )
+        self.assertEquals( [], [ n for n in checked if 'chunks' in n ],
+                           "chunks checked" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+Test packs of objects
+"""
+
+import os
+import glob
+import shutil
+from ConfigParser import SafeConfigParser
+
+import unittest
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+from testaux.httpserver import TmpHttpServer
+
+
+# --------------------------------------------------------------------
+
+class TestPacks( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server and a project, and upload the project
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject()
+        for n in range(3):
+            name = os.path.join( self.project.dir, 'dir1', 'extra%d.zip' % n )
+            with open(name,'w') as f:
+                f.write( 'extra artifact %d' % n )
+        self.args = am_args_defaults( self.server, self.project )
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+
+    def repo_file(self, name):
+        return os.path.join( self.server.dir, REPO_NAME, name )
+
+    def loose(self):
+        return glob.glob( self.repo_file(os.path.join('objects','*','*')) )
+
+    def repack(self, max_size=am_mod.PACK_OBJECT_SIZE):
+        return am_mod.ArtifactManager( self.args ).repack( max_size )
+
+    def check_download(self, branch=BRANCH_NAME):
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        rdr = am_mod.ArtifactReader( self.args )
+        r = rdr.download_artifacts( branch, self.args.project_dir )
+        rdr._reset_lists()
+        l = rdr.local_print_changes( self.args.project_dir, branch, False )
+        self.assertEquals( 0, len(l['only in server']), "no changes" )
+        return r
+
+
+    def test01_repack(self):
+        """Loose objects are moved into a pack"""
+        self.assertEquals( 5, self.repack(), "packed" )
+        self.assertEquals( [], self.loose(), "no loose objects" )
+        self.assertEquals( 1, len(glob.glob(self.repo_file('packs/*.pack'))),
+                           "pack" )
+        cfg = SafeConfigParser()
+        cfg.read( self.repo_file('options') )
+        self.assertEquals( 'True', cfg.get('general','packed'), "packed" )
+        self.assertEquals( '4', cfg.get('general','version'), "version" )
+        self.assertEquals( 0, self.repack(), "nothing else to pack" )
+        self.assertEquals( 5, self.check_download(), "downloaded" )
+
+
+    def test02_max_size(self):
+        """Only objects up to a size are packed"""
+        rdr = am_mod.ArtifactReader( self.args )
+        sizes = sorted( v[1] for v in rdr.remote_index.itervalues() )
+        self.assertEquals( 4, self.repack(sizes[3]), "packed" )
+        self.assertEquals( 1, len(self.loose()), "loose objects" )
+        self.assertEquals( 1, self.repack(), "packed" )
+        self.assertEquals( 2, len(glob.glob(self.repo_file('packs/*.pack'))),
+                           "packs" )
+        self.check_download()
+
+
+    def test03_upload(self):
+        """New objects are stored loose on top of packed ones"""
+        self.repack()
+        with open(os.path.join(self.project.dir,'dir1','new.zip'),'w') as f:
+            f.write( 'new artifact' )
+        mgr = am_mod.ArtifactManager( self.args )
+        r = mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME+'2' )
+        self.assertEquals( 1, r, "uploaded" )
+        self.assertEquals( 1, len(self.loose()), "loose objects" )
+        self.assertEquals( 6, self.check_download(BRANCH_NAME+'2'),
+                           "downloaded" )
+
+
+    def test04_compressed(self):
+        """Compressed objects are packed as they are stored"""
+        self.args.compression = 'zlib'
+        am_mod.ArtifactManager( self.args ).put_cfg()
+        del self.args.compression
+        with open(os.path.join(self.project.dir,'dir1','data.pkl'),'w') as f:
+            f.write( 'compressible data\n' * 1000 )
+        am_mod.ArtifactManager( self.args ).upload_artifacts(
+            self.args.project_dir, BRANCH_NAME+'2' )
+        self.assertEquals( 6, self.repack(), "packed" )
+        self.assertTrue( os.path.getsize(glob.glob(
+            self.repo_file('packs/*.pack'))[0]) < 5000, "compressed" )
+        self.assertEquals( 6, self.check_download(BRANCH_NAME+'2'),
+                           "downloaded" )
+
+
+    def test05_http(self):
+        """Objects close together in a pack are read at once"""
+        self.repack()
+        http = TmpHttpServer( self.server.dir )
+        try:
+            self.args.server_url = http.url
+            self.assertEquals( 5, self.check_download(), "downloaded" )
+            reqs = [ r[2] for r in http.requests if r[1].endswith('.pack') ]
+            self.assertEquals( [206], reqs, "pack reads" )
+            # A single object
+            rdr = am_mod.ArtifactReader( self.args )
+            outname = os.path.join( self.project.dir, 'out.zip' )
+            self.assertTrue( rdr.get('dir1/artifactB.zip',BRANCH_NAME,outname),
+                             "get" )
+            self.assertTrue( os.path.exists(outname), "downloaded" )
+        finally:
+            http.delete()
+
+
+    def test06_concurrent(self):
+        """Repacks running at the same time keep each other's entries"""
+        rdr = am_mod.ArtifactReader( self.args )
+        sizes = sorted( v[1] for v in rdr.remote_index.itervalues() )
+        other = am_mod.ArtifactManager( self.args )
+        self.assertEquals( 4, self.repack(sizes[3]), "packed" )
+        self.assertEquals( 1, other.repack(), "packed" )
+        self.assertEquals( 2, len(glob.glob(self.repo_file('packs/*.idx'))),
+                           "pack indexes" )
+        self.assertEquals( 5, self.check_download(), "downloaded" )
+
+
+    def test07_rebuild(self):
+        """Entries lost from the pack index are recovered on repack"""
+        self.repack()
+        with open(self.repo_file(am_mod.PACK_INDEX),'w') as f:
+            f.write( '' )
+        self.assertEquals( 0, self.repack(), "nothing else to pack" )
+        self.assertEquals( 5, self.check_download(), "downloaded" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Test the folders created in the repository by writer transports
+"""
+
+import os
+import glob
+
+import unittest
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+
+
+# --------------------------------------------------------------------
+
+class TestFolders( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server and a project with many artifacts
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject()
+        for n in range(20):
+            name = os.path.join( self.project.dir, 'dir1', 'extra%d.zip' % n )
+            with open(name,'w') as f:
+                f.write( 'extra artifact %d' % n )
+        self.args = am_args_defaults( self.server, self.project )
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+
+    def upload(self, mgr):
+        """Upload the project, counting checks for objects folders"""
+        checks = []
+        otype = mgr.writer.otype
+        def count( path ):
+            if path.startswith( am_mod.OBJECTS ):
+                checks.append( path )
+            return otype( path )
+        mgr.writer.otype = count
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        return checks
+
+    def object_folders(self):
+        return glob.glob( os.path.join(self.server.dir,REPO_NAME,
+                                       am_mod.OBJECTS,'*') )
+
+
+    def test01_known(self):
+        """Each folder is checked once"""
+        mgr = am_mod.ArtifactManager( self.args )
+        checks = self.upload( mgr )
+        self.assertEquals( sorted(set(checks)), sorted(checks), "checks" )
+        self.assertEquals( len(self.object_folders()), len(checks),
+                           "checks" )
+
+
+    def test02_object_folders(self):
+        """All object folders are created with the repository"""
+        self.args.object_folders = True
+        mgr = am_mod.ArtifactManager( self.args )
+        del self.args.object_folders
+        self.assertEquals( 256, len(self.object_folders()), "folders" )
+        self.assertEquals( [], self.upload(mgr), "no checks" )
+        # Later sessions check the folders they use, once
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME+'2' )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( 22, len(rdr.remote_index), "index" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
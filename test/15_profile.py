@@ -0,0 +1,96 @@
+"""
+Test the profiling of the phases in an operation
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import StringIO
+
+import unittest
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+
+
+# --------------------------------------------------------------------
+
+class TestProfile( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server and a project
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject()
+        self.args = am_args_defaults( self.server, self.project )
+
+    def tearDown(self):
+        self.server.delete()
+        self.project.delete()
+
+    def phases(self, profiler):
+        return [ p[0] for p in profiler.summary() ]
+
+
+    def test01_phases(self):
+        """The phases of uploads & downloads are recorded"""
+        self.args.profiler = am_mod.Profiler()
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        phases = self.phases( self.args.profiler )
+        for p in ('config','branch','scan','hashing','transfers','writes'):
+            self.assertTrue( p in phases, "upload phase " + p )
+        self.args.profiler = am_mod.Profiler()
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( 2, rdr.download_artifacts(BRANCH_NAME,
+                                                     self.args.project_dir),
+                           "downloaded" )
+        phases = self.phases( self.args.profiler )
+        for p in ('config','branches','branch','index','scan','hashing',
+                  'transfers'):
+            self.assertTrue( p in phases, "download phase " + p )
+        self.assertFalse( 'writes' in phases, "no writes" )
+        del self.args.profiler
+
+
+    def test02_output(self):
+        """Write a summary table, and a trace"""
+        self.args.profiler = am_mod.Profiler()
+        mgr = am_mod.ArtifactManager( self.args )
+        del self.args.profiler
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        out = StringIO.StringIO()
+        mgr.profiler.write_summary( out )
+        lines = out.getvalue().splitlines()
+        self.assertTrue( lines[1].startswith('# Profile:'), "header" )
+        self.assertEquals( len(mgr.profiler.summary()), len(lines) - 3,
+                           "phases" )
+        fd, name = tempfile.mkstemp()
+        os.close( fd )
+        try:
+            mgr.profiler.write_trace( name )
+            with open(name) as f:
+                trace = json.load( f )
+        finally:
+            os.unlink( name )
+        events = [ e for e in trace['traceEvents'] if e['ph'] == 'X' ]
+        self.assertEquals( len(mgr.profiler.events), len(events), "events" )
+        self.assertEquals( sorted(self.phases(mgr.profiler)),
+                           sorted(set(e['name'] for e in events)), "phases" )
+
+
+    def test03_no_profiler(self):
+        """Without a profiler, nothing is recorded"""
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertTrue( isinstance(rdr.profiler,am_mod.NullProfiler),
+                         "no profiler" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
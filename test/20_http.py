@@ -0,0 +1,205 @@
+"""
+Test read access to an artifact server through the HTTP transport
+"""
+
+import os
+import time
+import shutil
+import tempfile
+
+import unittest
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+from testaux.httpserver import TmpHttpServer
+
+
+# --------------------------------------------------------------------
+
+class TestHttp( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server, upload a project, and serve it via HTTP
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject( repeat=2 )
+        self.args = am_args_defaults( self.server, self.project )
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        self.http = TmpHttpServer( self.server.dir )
+        self.args.server_url = self.http.url
+
+    def tearDown(self):
+        self.http.delete()
+        self.server.delete()
+        self.project.delete()
+
+
+    def test01_read(self):
+        """Read the repository metadata over HTTP"""
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( [BRANCH_NAME], rdr.list_branches(), "branches" )
+        self.assertEquals( 2, len(rdr.remote_index), "index" )
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in local']), "no changes" )
+        self.assertEquals( 0, len(l['only in server']), "no changes" )
+
+
+    def test02_keepalive(self):
+        """All sequential requests go through a single connection"""
+        self.args.jobs = 1
+        rdr = am_mod.ArtifactReader( self.args )
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        r = rdr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertEquals( 3, r, "downloaded" )
+        self.assertTrue( len(self.http.requests) > 3, "requests" )
+        self.assertEquals( 1, self.http.connections, "connections" )
+
+
+    def test03_parallel(self):
+        """Parallel downloads over HTTP"""
+        self.args.jobs = 4
+        rdr = am_mod.ArtifactReader( self.args )
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        r = rdr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertEquals( 3, r, "downloaded" )
+        rdr._reset_lists()
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in server']), "all downloaded" )
+
+
+    def test04_closed_connection(self):
+        """Recover from idle connections closed by the server"""
+        self.http.delete()
+        self.http = TmpHttpServer( self.server.dir, timeout=0.2 )
+        self.args.server_url = self.http.url
+        rdr = am_mod.ArtifactReader( self.args )
+        time.sleep( 0.5 )
+        self.assertEquals( [BRANCH_NAME], rdr._get_all_branches().keys(),
+                           "branches" )
+        self.assertEquals( 2, self.http.connections, "reconnected" )
+
+
+
+    def test05_cold_start(self):
+        """Reading the repository metadata needs a single request per file,
+        and only for the files needed"""
+        self.http.reset()
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertEquals( [('GET','/%s/options' % REPO_NAME)],
+                           [r[:2] for r in self.http.requests], "requests" )
+        self.assertEquals( [BRANCH_NAME], rdr.list_branches(), "branches" )
+        self.assertEquals( 2, len(self.http.requests), "requests" )
+        self.assertEquals( None, rdr.get_branch('noBranch',return_none=True),
+                           "no branch" )
+        self.assertEquals( '', rdr.get_log(BRANCH_NAME), "no log" )
+        self.assertEquals( ['GET']*4, [r[0] for r in self.http.requests],
+                           "requests" )
+        self.assertFalse( [r for r in self.http.requests if 'index' in r[1]],
+                          "index not fetched" )
+
+
+
+    def test06_metadata_cache(self):
+        """Metadata in the local cache is revalidated, not fetched again"""
+        self.args.cache_dir = tempfile.mkdtemp()
+        try:
+            rdr1 = am_mod.ArtifactReader( self.args )
+            rdr1.get_branch( BRANCH_NAME )
+            self.http.reset()
+            rdr2 = am_mod.ArtifactReader( self.args )
+            rdr2.get_branch( BRANCH_NAME )
+            self.assertEquals( [304]*2, [r[2] for r in self.http.requests],
+                               "not modified" )
+            self.assertEquals( rdr1.remote_index, rdr2.remote_index, "index" )
+            # Modify the branch and check that we get the new version
+            mgr = am_mod.ArtifactManager( am_args_defaults(self.server,
+                                                           self.project) )
+            self.project.deleteArtifact()
+            mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME, True )
+            rdr3 = am_mod.ArtifactReader( self.args )
+            self.assertEquals( 1, len(rdr3.get_branch(BRANCH_NAME)), "changed" )
+        finally:
+            shutil.rmtree( self.args.cache_dir )
+
+
+    def test07_resume(self):
+        """Partial downloads are resumed with range requests"""
+        name = os.path.join( self.project.dir, 'dir1', 'artifactB.zip' )
+        with open(name,'rb') as f:
+            data = f.read()
+        os.unlink( name )
+        with open(name + '.part','wb') as f:
+            f.write( data[:len(data)//2] )
+        self.http.reset()
+        rdr = am_mod.ArtifactReader( self.args )
+        r = rdr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertEquals( 1, r, "downloaded" )
+        self.assertEquals( [206], [q[2] for q in self.http.requests
+                                   if q[1].find('/objects/') >= 0], "range" )
+        self.assertFalse( os.path.exists(name + '.part'), "part removed" )
+        with open(name,'rb') as f:
+            self.assertEquals( data, f.read(), "contents" )
+
+
+    def test08_resume_corrupt(self):
+        """A corrupt partial download is detected and downloaded again"""
+        name = os.path.join( self.project.dir, 'dir1', 'artifactB.zip' )
+        with open(name,'rb') as f:
+            data = f.read()
+        os.unlink( name )
+        with open(name + '.part','wb') as f:
+            f.write( 'garbage' )
+        self.http.reset()
+        rdr = am_mod.ArtifactReader( self.args )
+        r = rdr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertEquals( 1, r, "downloaded" )
+        self.assertEquals( [206,200], [q[2] for q in self.http.requests
+                                       if q[1].find('/objects/') >= 0],
+                           "retried" )
+        self.assertFalse( os.path.exists(name + '.part'), "part removed" )
+        with open(name,'rb') as f:
+            self.assertEquals( data, f.read(), "contents" )
+
+
+    def test09_corrupt_object(self):
+        """A corrupt object in the server makes the download fail"""
+        name = os.path.join( self.project.dir, 'dir1', 'artifactB.zip' )
+        os.unlink( name )
+        rdr = am_mod.ArtifactReader( self.args )
+        for sha, v in rdr.get_branch( BRANCH_NAME ).iteritems():
+            if v == ['dir1/artifactB.zip']:
+                obj = os.path.join( self.server.dir, REPO_NAME,
+                                    *am_mod.object_remote_location(sha) )
+        with open(obj,'r+b') as f:
+            f.write( 'X' )
+        with self.assertRaises( SystemExit ):
+            rdr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        self.assertFalse( os.path.exists(name), "not downloaded" )
+        self.assertFalse( os.path.exists(name + '.part'), "part removed" )
+
+
+    def test10_metadata_cache_unwritable(self):
+        """Metadata that cannot be cached is just fetched again"""
+        self.args.cache_dir = tempfile.mkdtemp()
+        try:
+            cache = am_mod.MetadataCache( self.args.cache_dir,
+                                          self.args.server_url, REPO_NAME )
+            os.makedirs( os.path.join(cache._name(am_mod.OPTIONS),'blocker') )
+            for _ in range(2):
+                self.http.reset()
+                rdr = am_mod.ArtifactReader( self.args )
+                self.assertEquals( 2, len(rdr.get_branch(BRANCH_NAME)),
+                                   "branch" )
+                self.assertIn( ('GET','/%s/%s' % (REPO_NAME,am_mod.OPTIONS),
+                                200), self.http.requests, "options fetched" )
+        finally:
+            shutil.rmtree( self.args.cache_dir )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
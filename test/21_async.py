@@ -0,0 +1,236 @@
+"""
+Test the asynchronous HTTP transport & the event loop running it
+"""
+
+import os
+import glob
+import time
+import shutil
+import socket
+import select
+import tempfile
+import StringIO
+
+import unittest
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from testaux import REPO_NAME, BRANCH_NAME
+from testaux.am import am_mod, am_args_defaults
+from testaux.server import TmpServer
+from testaux.project import TmpProject
+from testaux.httpserver import TmpHttpServer
+
+
+# --------------------------------------------------------------------
+
+def echo( sock, data, log ):
+    """A coroutine that sends data through a socket, and reads it back"""
+    yield 'w', sock
+    sock.send( data )
+    log.append( 'sent ' + data )
+    yield 'r', sock
+    raise am_mod.Return( sock.recv(100) )
+
+
+def fail():
+    raise ValueError( 'failed' )
+    yield
+
+
+def call( coro ):
+    """A coroutine that runs another one, and catches its exceptions"""
+    try:
+        r = yield coro
+    except ValueError as e:
+        r = str(e)
+    raise am_mod.Return( r )
+
+
+class TestEventLoop( unittest.TestCase ):
+
+    def test01_run(self):
+        """Coroutines run interleaved, and give back their results"""
+        pairs = [ socket.socketpair() for n in range(3) ]
+        log = []
+        try:
+            for n, p in enumerate(pairs):
+                p[1].send( 'reply %d' % n )
+            r = am_mod.EventLoop().run( [ echo(p[0],str(n),log)
+                                          for n, p in enumerate(pairs) ] +
+                                        [ call(fail()) ] )
+            self.assertEquals( ['reply 0','reply 1','reply 2','failed'], r,
+                               "results" )
+            self.assertEquals( ['sent 0','sent 1','sent 2'], sorted(log),
+                               "log" )
+            # One at a time
+            log = []
+            for n, p in enumerate(pairs):
+                p[1].send( 'reply %d' % n )
+            r = am_mod.EventLoop().run( [ echo(p[0],str(n),log)
+                                          for n, p in enumerate(pairs) ], 1 )
+            self.assertEquals( ['reply 0','reply 1','reply 2'], r, "results" )
+            self.assertEquals( ['sent 0','sent 1','sent 2'], log, "log" )
+        finally:
+            for p in pairs:
+                p[0].close()
+                p[1].close()
+
+
+    def test02_errors(self):
+        """Errors in a coroutine are raised, and other ones are stopped"""
+        a, b = socket.socketpair()
+        log = []
+        try:
+            self.assertRaises( ValueError, am_mod.EventLoop().run,
+                               [ echo(a,'0',log), fail() ] )
+            self.assertRaises( socket.timeout, am_mod.EventLoop(0.1).run,
+                               [ echo(a,'1',log) ] )
+        finally:
+            a.close()
+            b.close()
+
+
+    def test03_many_sockets(self):
+        """Sockets with descriptors over FD_SETSIZE can be waited for"""
+        if not hasattr( select, 'poll' ) or resource is None:
+            self.skipTest( "no poll()" )
+        if resource.getrlimit( resource.RLIMIT_NOFILE )[0] < 1200:
+            self.skipTest( "not enough file descriptors" )
+        files = [ open(os.devnull) for n in range(1100) ]
+        pairs = [ socket.socketpair() for n in range(3) ]
+        log = []
+        try:
+            self.assertTrue( pairs[0][0].fileno() > 1024, "high descriptor" )
+            for n, p in enumerate(pairs):
+                p[1].send( 'reply %d' % n )
+            r = am_mod.EventLoop().run( [ echo(p[0],str(n),log)
+                                          for n, p in enumerate(pairs) ] )
+            self.assertEquals( ['reply 0','reply 1','reply 2'], r, "results" )
+        finally:
+            for p in pairs:
+                p[0].close()
+                p[1].close()
+            for f in files:
+                f.close()
+
+
+# --------------------------------------------------------------------
+
+class TestAsyncHttp( unittest.TestCase ):
+
+    def setUp(self):
+        # Create an artifact server, upload a project, and serve it via HTTP
+        self.server = TmpServer( REPO_NAME )
+        self.project = TmpProject( repeat=2 )
+        self.args = am_args_defaults( self.server, self.project )
+        mgr = am_mod.ArtifactManager( self.args )
+        mgr.upload_artifacts( self.args.project_dir, BRANCH_NAME )
+        self.http = TmpHttpServer( self.server.dir )
+        self.args.server_url = self.http.url
+        self.args.async_transfers = 2
+
+    def tearDown(self):
+        self.http.delete()
+        self.server.delete()
+        self.project.delete()
+
+    def check_download(self):
+        rdr = am_mod.ArtifactReader( self.args )
+        shutil.rmtree( os.path.join(self.project.dir,'dir1') )
+        r = rdr.download_artifacts( BRANCH_NAME, self.args.project_dir )
+        rdr._reset_lists()
+        l = rdr.local_print_changes( self.args.project_dir, BRANCH_NAME, False )
+        self.assertEquals( 0, len(l['only in server']), "all downloaded" )
+        return r
+
+
+    def test01_download(self):
+        """Download artifacts concurrently from a single thread"""
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertTrue( isinstance(rdr.reader,am_mod.SyncTransport),
+                         "async transport" )
+        self.http.reset()
+        self.assertEquals( 3, self.check_download(), "downloaded" )
+        self.assertTrue( self.http.connections <= 2, "connections" )
+
+
+    def test02_packed(self):
+        """Download packed objects"""
+        self.args.server_url = self.server.dir
+        am_mod.ArtifactManager( self.args ).repack( am_mod.PACK_OBJECT_SIZE )
+        self.args.server_url = self.http.url
+        self.http.reset()
+        self.assertEquals( 3, self.check_download(), "downloaded" )
+        reqs = [ r[2] for r in self.http.requests if r[1].endswith('.pack') ]
+        self.assertEquals( [206], reqs, "pack reads" )
+
+
+    def test03_sync(self):
+        """The synchronous interface to the asynchronous transport"""
+        rdr = am_mod.ArtifactReader( self.args )
+        self.assertTrue( rdr.reader.exists('branches'), "exists" )
+        self.assertFalse( rdr.reader.exists('nothing'), "does not exist" )
+        buf = StringIO.StringIO()
+        found, validator = rdr.reader.get_if_modified( 'branches', buf )
+        self.assertTrue( found, "found" )
+        self.assertEquals( BRANCH_NAME, buf.getvalue(), "contents" )
+        found, validator = rdr.reader.get_if_modified( 'branches', buf,
+                                                       validator )
+        self.assertEquals( None, found, "not modified" )
+        buf = StringIO.StringIO()
+        self.assertTrue( rdr.reader.get_range('branches',buf,1,3), "range" )
+        self.assertEquals( BRANCH_NAME[1:4], buf.getvalue(), "range" )
+        self.assertFalse( rdr.reader.get_if_exists('nothing',buf), "missing" )
+        self.assertRaises( SystemExit, rdr.reader.get, 'nothing', buf )
+        self.assertEquals( 1, self.http.connections, "connections" )
+
+
+    def test04_closed_connection(self):
+        """Recover from idle connections closed by the server"""
+        self.http.delete()
+        self.http = TmpHttpServer( self.server.dir, timeout=0.2 )
+        self.args.server_url = self.http.url
+        rdr = am_mod.ArtifactReader( self.args )
+        time.sleep( 0.5 )
+        self.assertEquals( [BRANCH_NAME], rdr._get_all_branches().keys(),
+                           "branches" )
+
+
+    def test05_fallback(self):
+        """Downloads through the object cache use parallel jobs"""
+        self.args.cache_dir = tempfile.mkdtemp()
+        self.args.cache_size = 10
+        try:
+            self.assertEquals( 3, self.check_download(), "downloaded" )
+            self.assertEquals( 2, len(glob.glob(os.path.join(
+                self.args.cache_dir,'objects','*','*'))), "cached" )
+        finally:
+            shutil.rmtree( self.args.cache_dir )
+
+
+    def test06_error_status(self):
+        """Responses with an error status release their connection once"""
+        rdr = am_mod.ArtifactReader( self.args )
+        idle = rdr.reader.transport._idle
+        buf = StringIO.StringIO()
+        self.assertRaises( SystemExit, rdr.reader.get_if_exists, 'branches',
+                           buf, 1000 )
+        self.assertTrue( rdr.reader.get_range('branches',buf,1000,10),
+                         "past the end" )
+        self.assertFalse( rdr.reader.get_range('nothing',buf,0,10), "missing" )
+        self.assertEquals( (False,None),
+                           rdr.reader.get_if_modified('nothing',buf), "missing" )
+        self.assertEquals( [1], [ len(c) for c in idle.itervalues() if c ],
+                           "idle connections" )
+        self.assertEquals( 1, self.http.connections, "connections" )
+
+
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,7 +15,8 @@ def am_args( values=None ):
     """
     defaults = { 'verbose' : 0,
                  'dry_run' : False,
-                 'subdir' : None }
+                 'subdir' : None,
+                 'cache_dir' : '' }
     if values is None:
         values = {}
     for n,v in defaults.iteritems():
@@ -0,0 +1,137 @@
+"""
+Serve a local artifact server folder over HTTP, for testing the HTTP transport
+"""
+
+import os
+import re
+import posixpath
+import urllib
+import threading
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+import StringIO
+
+
+# -------------------------------------------------------------------
+
+class _Handler( SimpleHTTPServer.SimpleHTTPRequestHandler ):
+    """A request handler serving files from the server root, with keep-alive"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def translate_path( self, path ):
+        path = posixpath.normpath( urllib.unquote(path.split('?',1)[0]) )
+        words = [ w for w in path.split('/') if w and w not in ('.','..') ]
+        return os.path.join( self.server.root, *words )
+
+    def handle( self ):
+        self.server.connections += 1
+        SimpleHTTPServer.SimpleHTTPRequestHandler.handle( self )
+
+    def send_response( self, code, message=None ):
+        self.server.requests.append( (self.command,self.path,code) )
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_response( self, code,
+                                                                 message )
+
+    def send_head( self ):
+        # Support conditional requests, through ETag & If-None-Match
+        path = self.translate_path( self.path )
+        if os.path.isfile( path ):
+            st = os.stat( path )
+            rng = re.match( r'bytes=(\d+)-(\d*)$',
+                            self.headers.get('Range') or '' )
+            if rng:
+                end = int(rng.group(2)) + 1 if rng.group(2) else st.st_size
+                return self.send_range( path, int(rng.group(1)),
+                                        min(end,st.st_size), st.st_size )
+            etag = '"%x-%x-%x"' % (st.st_ino, st.st_size, 
+                                   int(st.st_mtime*1000000))
+            if self.headers.get( 'If-None-Match' ) == etag:
+                self.send_response( 304 )
+                self.send_header( 'ETag', etag )
+                self.end_headers()
+                return None
+            self.etag = etag
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head( self )
+
+    def send_range( self, path, start, end, size ):
+        # Support single range requests ("bytes=N-" or "bytes=N-M")
+        if start >= size:
+            self.send_response( 416 )
+            self.send_header( 'Content-Range', 'bytes */%d' % size )
+            self.send_header( 'Content-Length', '0' )
+            self.end_headers()
+            return None
+        with open( path, 'rb' ) as f:
+            f.seek( start )
+            data = StringIO.StringIO( f.read(end-start) )
+        self.send_response( 206 )
+        self.send_header( 'Content-Type', 'application/octet-stream' )
+        self.send_header( 'Content-Range', 
+                          'bytes %d-%d/%d' % (start,end-1,size) )
+        self.send_header( 'Content-Length', str(end-start) )
+        self.end_headers()
+        return data
+
+    def end_headers( self ):
+        if getattr( self, 'etag', None ):
+            self.send_header( 'ETag', self.etag )
+            self.etag = None
+        SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers( self )
+
+    def send_error( self, code, message=None ):
+        # Unlike the default one, keep the connection alive
+        self.send_response( code, message )
+        self.send_header( 'Content-Length', '0' )
+        self.end_headers()
+
+    def log_message( self, format, *args ):
+        pass
+
+
+class _Server( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+    daemon_threads = True
+
+
+# -------------------------------------------------------------------
+
+class TmpHttpServer( object ):
+
+    def __init__( self, root, timeout=None ):
+        """
+        Start serving a local folder over HTTP, in a background thread
+          @param timeout (float): close idle connections after that time
+        """
+        class handler( _Handler ):
+            pass
+        handler.timeout = timeout
+        self.httpd = _Server( ('127.0.0.1',0), handler )
+        self.httpd.root = root
+        self.httpd.connections = 0
+        self.httpd.requests = []
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+        self.thread = threading.Thread( target=self.httpd.serve_forever,
+                                        args=(0.05,) )
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def connections( self ):
+        """Number of TCP connections received so far"""
+        return self.httpd.connections
+
+    @property
+    def requests( self ):
+        """List of (method,path,status) requests received so far"""
+        return self.httpd.requests
+
+    def reset( self ):
+        """Reset the connection & request counters"""
+        self.httpd.connections = 0
+        self.httpd.requests = []
+
+    def delete( self ):
+        """Stop the server"""
+        self.httpd.shutdown()
+        self.httpd.server_close()